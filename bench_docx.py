@@ -0,0 +1,96 @@
+"""Сравнение потокового извлечения текста из DOCX с python-docx.
+
+Запуск: python bench_docx.py [число абзацев ...]
+Нужен python-docx: pip install -r requirements-dev.txt
+Генерирует договоры с таблицами и колонтитулами, меряет время и пик памяти.
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Сервер при импорте поднимает состояние - уводим его во временный каталог
+BENCH_DIR = tempfile.mkdtemp(prefix='docscan-bench-')
+os.environ.setdefault('DOCSCAN_SQLITE_DB', os.path.join(BENCH_DIR, 'bench.db'))
+os.environ.setdefault('DOCSCAN_CACHE_DIR', os.path.join(BENCH_DIR, 'cache'))
+os.environ.setdefault('EXTRACTOR_WORKERS', '1')
+
+import docx
+import server
+
+
+def make_docx(path, paragraphs):
+    """Договор: абзацы текста, каждые 20 абзацев - таблица с условиями оплаты"""
+    doc = docx.Document()
+    doc.sections[0].header.paragraphs[0].text = 'ООО «Поставщик» - Договор поставки'
+    doc.sections[0].footer.paragraphs[0].text = 'Подписи сторон'
+    for i in range(paragraphs):
+        doc.add_paragraph(f'{i + 1}. Поставщик обязуется передать Покупателю товар надлежащего '
+                          f'качества в сроки, установленные спецификацией к настоящему договору.')
+        if i % 20 == 19:
+            table = doc.add_table(rows=3, cols=2)
+            for row, (name, value) in enumerate((('Сумма', '1 200 000 руб.'),
+                                                 ('Срок оплаты', '10 банковских дней'),
+                                                 ('Неустойка', '0,1% за день просрочки'))):
+                table.cell(row, 0).text = name
+                table.cell(row, 1).text = value
+    doc.save(path)
+
+
+def python_docx_paragraphs(path, max_chars):
+    """Прежний путь: только абзацы тела документа"""
+    text = ""
+    for paragraph in docx.Document(path).paragraphs:
+        text += paragraph.text + "\n"
+    return text[:max_chars]
+
+
+def python_docx_full(path, max_chars):
+    """python-docx с таблицами и колонтитулами - то, что теперь извлекается"""
+    doc = docx.Document(path)
+    parts = [paragraph.text for paragraph in doc.paragraphs]
+    for table in doc.tables:
+        for row in table.rows:
+            parts.append(' | '.join(cell.text for cell in row.cells))
+    for section in doc.sections:
+        parts += [paragraph.text for paragraph in section.header.paragraphs]
+        parts += [paragraph.text for paragraph in section.footer.paragraphs]
+    return '\n'.join(parts)[:max_chars]
+
+
+def measure(func, path, max_chars, repeat=3):
+    """Лучшее время из repeat запусков, пик памяти и длина текста"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path, max_chars)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    text = func(path, max_chars)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, len(text)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    extractors = (
+        ('python-docx (абзацы)', python_docx_paragraphs),
+        ('python-docx (всё)', python_docx_full),
+        ('потоковый', server.read_docx_text),
+    )
+    print(f"{'абзацев':>8} {'бюджет':>10} {'извлечение':<22} {'время, мс':>10} {'пик, КБ':>9} {'символов':>9}")
+    for paragraphs in sizes:
+        path = os.path.join(BENCH_DIR, f'contract_{paragraphs}.docx')
+        make_docx(path, paragraphs)
+        for max_chars in (server.ANALYSIS_CHAR_LIMIT, sys.maxsize):
+            budget = 'без лимита' if max_chars == sys.maxsize else str(max_chars)
+            for name, func in extractors:
+                elapsed, peak, chars = measure(func, path, max_chars)
+                print(f"{paragraphs:>8} {budget:>10} {name:<22} {elapsed * 1000:>10.1f} {peak // 1024:>9} {chars:>9}")
+
+
+if __name__ == '__main__':
+    main()
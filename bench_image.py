@@ -0,0 +1,64 @@
+"""Замеры подготовки фото перед Vision OCR по уровням качества.
+
+Запуск: python bench_image.py [фото.jpg ...]
+Без аргументов генерирует снимок документа 4032x3024. Если заданы
+YANDEX_API_KEY и YANDEX_FOLDER_ID, меряет и время ответа Vision API.
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+# Сервер при импорте поднимает состояние - уводим его во временный каталог
+BENCH_DIR = tempfile.mkdtemp(prefix='docscan-bench-')
+os.environ.setdefault('DOCSCAN_SQLITE_DB', os.path.join(BENCH_DIR, 'bench.db'))
+os.environ.setdefault('DOCSCAN_CACHE_DIR', os.path.join(BENCH_DIR, 'cache'))
+os.environ.setdefault('EXTRACTOR_WORKERS', '1')
+
+from PIL import Image, ImageDraw
+import server
+
+
+def make_photo():
+    """Страница договора, снятая телефоном: 12 Мп, поворот в EXIF, шум бумаги"""
+    page = Image.effect_noise((4032, 3024), 12).convert('RGB')
+    draw = ImageDraw.Draw(page)
+    for line in range(60):
+        draw.text((200, 150 + line * 45), f'{line + 1}. Арендатор обязуется вносить арендную плату '
+                                          f'не позднее 10 числа каждого месяца.', fill=(20, 20, 20))
+    exif = page.getexif()
+    exif[0x0112] = 6  # снято "боком"
+    output = io.BytesIO()
+    page.save(output, 'JPEG', quality=92, exif=exif)
+    return output.getvalue()
+
+
+def main():
+    photos = [(path, open(path, 'rb').read()) for path in sys.argv[1:]] or [('synthetic', make_photo())]
+    with_ocr = bool(server.YANDEX_API_KEY and server.YANDEX_FOLDER_ID)
+    if not with_ocr:
+        print("YANDEX_API_KEY не задан - время OCR не меряется")
+
+    print(f"{'фото':<16} {'уровень':<9} {'размер':>11} {'отправка, КБ':>13} {'подготовка, мс':>15} {'OCR, мс':>8}")
+    for name, photo in photos:
+        for tier, config in server.IMAGE_QUALITY_TIERS.items():
+            started = time.perf_counter()
+            if config:
+                data, _, size = server.prepare_image(photo, config['max_side'], config['quality'], config['grayscale'])
+            else:
+                data, size = photo, Image.open(io.BytesIO(photo)).size
+            prepare_ms = (time.perf_counter() - started) * 1000
+            body = server.Base64JsonBody({'content': server.Base64JsonBody.PLACEHOLDER}, data)
+
+            ocr_ms = '-'
+            if with_ocr:
+                started = time.perf_counter()
+                server.extract_text_from_image(photo, tier)
+                ocr_ms = f"{(time.perf_counter() - started) * 1000:.0f}"
+            print(f"{os.path.basename(name)[:16]:<16} {tier:<9} {size[0]:>5}x{size[1]:<5} "
+                  f"{len(body) // 1024:>13} {prepare_ms:>15.0f} {ocr_ms:>8}")
+
+
+if __name__ == '__main__':
+    main()
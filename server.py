@@ -1,18 +1,44 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, request, jsonify, session
 from flask_cors import CORS
 import PyPDF2
-import docx
 import requests
+from requests.adapters import HTTPAdapter
 import tempfile
 import os
 import uuid
 from datetime import datetime, date
 import secrets
+import shutil
 from functools import wraps
+from urllib.parse import urlsplit
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import json
 import base64
+import codecs
+import atexit
+import signal
 import logging
+import multiprocessing
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+import queue
+import resource
+import sqlite3
 import sys
+import threading
+import time
+import zlib
+import difflib
+import numpy as np
+from PIL import Image, ImageOps, ImageSequence
+import zipfile
+import io
+import mmap
+import hashlib
+import re
+from xml.etree import ElementTree
+import heapq
 
 # 🔧 УМНАЯ СИСТЕМА АНАЛИЗА ДОКУМЕНТОВ - ДОБАВЬТЕ ЭТОТ КОД
 SMART_ANALYSIS_CONFIG = {
@@ -91,40 +117,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Система лимитов по IP
-IP_LIMITS_FILE = '/tmp/docscan_ip_limits.json'
-
-def load_ip_limits():
-    """Загружает лимиты по IP из файла"""
-    try:
-        if os.path.exists(IP_LIMITS_FILE):
-            with open(IP_LIMITS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                # Очищаем старые записи (старше 1 дня)
-                today = date.today().isoformat()
-                clean_data = {}
-                for ip, ip_data in data.items():
-                    if ip_data.get('last_reset', today) >= today:
-                        clean_data[ip] = ip_data
-                
-                print(f"✅ Загружено {len(clean_data)} IP-адресов")
-                return clean_data
-    except Exception as e:
-        print(f"❌ Ошибка загрузки IP-лимитов: {e}")
-    
-    return {}
-
-def save_ip_limits():
-    """Сохраняет лимиты по IP в файл"""
-    try:
-        with open(IP_LIMITS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(ip_limits, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"❌ Ошибка сохранения IP-лимитов: {e}")
-
-# Загружаем IP лимиты при старте
-ip_limits = load_ip_limits()
 def get_client_ip():
     """Получаем реальный IP клиента на Render"""
     if request.headers.get('X-Forwarded-For'):
@@ -135,42 +127,6 @@ def get_client_ip():
     else:
         return request.remote_addr
 
-def can_analyze_by_ip(ip_address):
-    """Исправленная проверка по IP"""
-    # Получаем реальный IP
-    real_ip = get_client_ip()
-    print(f"🔍 IP клиента: {real_ip}")
-    
-    # Исключаем локальные IP для тестирования
-    if real_ip in ['127.0.0.1', 'localhost']:
-        print("✅ Локальный IP - пропускаем проверку")
-        return True
-        
-    if real_ip not in ip_limits:
-        ip_limits[real_ip] = {
-            'used_today': 0,
-            'last_reset': date.today().isoformat(),
-            'first_seen': datetime.now().isoformat()
-        }
-        print(f"➕ Новый IP добавлен: {real_ip}")
-    
-    ip_data = ip_limits[real_ip]
-    
-    # Сбрасываем лимит если новый день
-    if ip_data['last_reset'] < date.today().isoformat():
-        ip_data['used_today'] = 0
-        ip_data['last_reset'] = date.today().isoformat()
-        print(f"🔄 Сброшен лимит для IP {real_ip}")
-    
-    # МАКСИМУМ 1 БЕСПЛАТНЫЙ АНАЛИЗ В ДЕНЬ С ОДНОГО IP
-    can_analyze = ip_data['used_today'] < 1
-    
-    if can_analyze:
-        print(f"📡 IP {real_ip} может сделать анализ ({ip_data['used_today']}/1)")
-    else:
-        print(f"🚫 IP {real_ip} уже использовал бесплатный анализ сегодня ({ip_data['used_today']}/1)")
-    
-    return can_analyze
 app = Flask(__name__)
 # Добавляем секретный ключ для сессий
 app.secret_key = os.getenv('SECRET_KEY', secrets.token_hex(32))
@@ -187,30 +143,22 @@ YANDEX_API_KEY = os.getenv('YANDEX_API_KEY')
 YANDEX_FOLDER_ID = os.getenv('YANDEX_FOLDER_ID')
 
 # Система пользователей и лимитов
-# Файл для хранения пользователей (на Render используем /tmp)
+# Хранилище пользователей (на Render используем /tmp):
+# sqlite - база SQLite в режиме WAL, запись и чтение по одной строке
+# journal - JSON-снапшот + журнал изменений (прежний формат)
+STORAGE_BACKEND = os.getenv('DOCSCAN_STORAGE', 'sqlite')
+SQLITE_DB_FILE = os.getenv('DOCSCAN_SQLITE_DB', '/tmp/docscan.db')
 USER_DB_FILE = '/tmp/docscan_users.json'
+USER_JOURNAL_FILE = '/tmp/docscan_users.journal'
+IP_LIMITS_FILE = '/tmp/docscan_ip_limits.json'  # прежние дневные счетчики IP, переносятся в лимитер
 
-def load_users():
-    """Загружает пользователей из файла"""
-    try:
-        if os.path.exists(USER_DB_FILE):
-            with open(USER_DB_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                print(f"✅ Загружено {len(data)} пользователей из файла")
-                
-                # Восстанавливаем даты и сбрасываем лимиты если нужно
-                for user_id, user_data in data.items():
-                    if user_data['last_reset'] < date.today().isoformat():
-                        user_data['used_today'] = 0
-                        user_data['last_reset'] = date.today().isoformat()
-                        print(f"🔄 Сброшен лимит для пользователя {user_id}")
-                
-                return data
-    except Exception as e:
-        print(f"❌ Ошибка загрузки пользователей: {e}")
-    
-    # База по умолчанию если файла нет
-    default_db = {
+# Компактизация журнала в снапшот (в фоне)
+JOURNAL_COMPACT_THRESHOLD = int(os.getenv('JOURNAL_COMPACT_THRESHOLD', 1000))  # записей
+JOURNAL_COMPACT_INTERVAL = int(os.getenv('JOURNAL_COMPACT_INTERVAL', 60))  # секунд
+
+def create_default_db():
+    """База по умолчанию, если сохраненных пользователей нет"""
+    return {
         'default': {
             'plan': 'free',
             'used_today': 0,
@@ -220,21 +168,1210 @@ def load_users():
             'created_at': datetime.now().isoformat()
         }
     }
-    print("✅ Создана база по умолчанию")
-    return default_db
 
-def save_users():
-    """Сохраняет пользователей в файл"""
-    try:
-        with open(USER_DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users_db, f, ensure_ascii=False, indent=2)
-        print(f"💾 Сохранено {len(users_db)} пользователей")
-    except Exception as e:
-        print(f"❌ Ошибка сохранения пользователей: {e}")
+def replay_journal(data, journal_path):
+    """Применяет записи журнала к базе, возвращает число примененных записей"""
+    applied = 0
+    if not os.path.exists(journal_path):
+        return applied
+    
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                user_data = json.loads(line)
+            except ValueError:
+                # Недописанная последняя строка после падения - пропускаем
+                print(f"⚠️ Пропущена поврежденная запись журнала в {journal_path}")
+                continue
+            data[user_data['user_id']] = user_data
+            applied += 1
+    return applied
+
+def append_journal(source, target):
+    """Дописывает журнал source в конец журнала target"""
+    with open(target, 'ab') as out:
+        # Недописанную последнюю строку target закрываем, чтобы не склеить ее с первой записью source
+        if out.tell() > 0:
+            with open(target, 'rb') as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b'\n':
+                    out.write(b'\n')
+        with open(source, 'rb') as f:
+            shutil.copyfileobj(f, out)
+        out.flush()
+        os.fsync(out.fileno())
+
+def read_json_users():
+    """Читает пользователей из JSON-снапшота и журнала, возвращает (база, число записей журнала)"""
+    data = {}
+    if os.path.exists(USER_DB_FILE):
+        with open(USER_DB_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        print(f"✅ Загружено {len(data)} пользователей из снапшота")
+    
+    # Журнал прерванной компактизации идет раньше текущего
+    replayed = replay_journal(data, USER_JOURNAL_FILE + '.old')
+    journal_records = replay_journal(data, USER_JOURNAL_FILE)
+    replayed += journal_records
+    if replayed:
+        print(f"📜 Применено {replayed} записей журнала")
+    return data, journal_records
+
+class JournalStorage:
+    """Хранилище в памяти: JSON-снапшот + журнал изменений пользователей.
+    В памяти пользователи хранятся компактными записями UserRecord"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.journal_records = 0
+        self.users = self.load_users()
+        threading.Thread(target=self.compaction_worker, name='users-compaction', daemon=True).start()
+    
+    def load_users(self):
+        """Загружает пользователей: снапшот + журнал изменений"""
+        try:
+            data, self.journal_records = read_json_users()
+            if data:
+                # Восстанавливаем даты и сбрасываем лимиты если нужно
+                today = today_number()
+                users = {}
+                for user_id, user_data in data.items():
+                    user = UserRecord.from_dict(user_data)
+                    if user.last_reset < today:
+                        user.used_today = 0
+                        user.last_reset = today
+                        print(f"🔄 Сброшен лимит для пользователя {user_id}")
+                    users[user_id] = user
+                return users
+        except Exception as e:
+            print(f"❌ Ошибка загрузки пользователей: {e}")
+        
+        print("✅ Создана база по умолчанию")
+        return {user_id: UserRecord.from_dict(user) for user_id, user in create_default_db().items()}
+    
+    def get_user(self, user_id):
+        user = self.users.get(user_id)
+        return user.to_dict() if user is not None else None
+    
+    def put_users(self, users):
+        """Дописывает в журнал по одной записи с текущим состоянием каждого пользователя"""
+        for user in users:
+            self.users[user['user_id']] = UserRecord.from_dict(user)
+        lines = ''.join(json.dumps(user, ensure_ascii=False, separators=(',', ':')) + '\n' for user in users)
+        try:
+            with self.lock:
+                if self.journal_file is None:
+                    self.journal_file = open(USER_JOURNAL_FILE, 'a', encoding='utf-8')
+                self.journal_file.write(lines)
+                self.journal_file.flush()
+                self.journal_records += len(users)
+        except Exception as e:
+            print(f"❌ Ошибка записи в журнал пользователей: {e}")
+    
+    def all_users(self):
+        return {user_id: user.to_dict() for user_id, user in list(self.users.items())}
+    
+    def user_stats(self):
+        """Возвращает (всего пользователей, всего анализов, анализов сегодня)"""
+        today = today_number()
+        users = list(self.users.values())
+        return (len(users),
+                sum(user.total_used for user in users),
+                sum(user.used_today for user in users if user.last_reset == today))
+    
+    def reset_daily_usage(self, day):
+        """Обнуляет дневные счетчики всех пользователей за прошлые дни (day - номер дня).
+        В журнал не пишется: при загрузке счетчики сбрасываются так же"""
+        for user_id, user in list(self.users.items()):
+            if user.last_reset < day:
+                # Записи не меняем на месте - компактизация читает их без блокировки
+                user = user.copy()
+                user.used_today = 0
+                user.last_reset = day
+                self.users[user_id] = user
+    
+    def plan_expirations(self):
+        """Список (user_id, номер дня окончания) платных тарифов со сроком"""
+        return [(user.user_id, user.plan_expires) for user in list(self.users.values())
+                if user.plan_code != FREE_PLAN and user.plan_expires != NO_EXPIRY]
+    
+    def compact(self):
+        """Сворачивает журнал в новый снапшот базы пользователей"""
+        old_journal = USER_JOURNAL_FILE + '.old'
+        try:
+            # Под блокировкой только отцепляем журнал и копируем записи,
+            # сериализация снапшота идет без блокировки
+            with self.lock:
+                if self.journal_records == 0:
+                    return
+                if self.journal_file is not None:
+                    self.journal_file.close()
+                    self.journal_file = None
+                if os.path.exists(USER_JOURNAL_FILE):
+                    if os.path.exists(old_journal):
+                        # Прошлая компактизация не дошла до снапшота - ее .old еще нужен.
+                        # Текущий журнал дописывается к нему, а не заменяет его
+                        append_journal(USER_JOURNAL_FILE, old_journal)
+                        os.unlink(USER_JOURNAL_FILE)
+                    else:
+                        os.replace(USER_JOURNAL_FILE, old_journal)
+                compacted = self.journal_records
+                self.journal_records = 0
+                snapshot = list(self.users.values())
+            snapshot = {user.user_id: user.to_dict() for user in snapshot}
+            
+            temp_path = USER_DB_FILE + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, USER_DB_FILE)
+            
+            if os.path.exists(old_journal):
+                os.unlink(old_journal)
+            print(f"🗜️ Журнал свернут: {compacted} записей, в снапшоте {len(snapshot)} пользователей")
+        except Exception as e:
+            print(f"❌ Ошибка компактизации базы пользователей: {e}")
+    
+    def compaction_worker(self):
+        """Фоновый поток: периодически сворачивает разросшийся журнал"""
+        while True:
+            time.sleep(JOURNAL_COMPACT_INTERVAL)
+            if self.journal_records >= JOURNAL_COMPACT_THRESHOLD:
+                self.compact()
+
+USER_COLUMNS = ('user_id', 'plan', 'used_today', 'last_reset', 'total_used', 'created_at', 'plan_expires')
+
+class SQLiteStorage:
+    """Хранилище в SQLite (WAL): каждая операция читает или пишет одну строку"""
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.create_schema()
+        self.migrate_json()
+    
+    def conn(self):
+        """Соединение SQLite для текущего потока"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=10)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+    
+    def create_schema(self):
+        with self.conn() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    plan TEXT NOT NULL DEFAULT 'free',
+                    used_today INTEGER NOT NULL DEFAULT 0,
+                    last_reset TEXT NOT NULL,
+                    total_used INTEGER NOT NULL DEFAULT 0,
+                    created_at TEXT,
+                    plan_expires TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_users_plan ON users(plan);
+                CREATE INDEX IF NOT EXISTS idx_users_plan_expires ON users(plan_expires);
+                CREATE INDEX IF NOT EXISTS idx_users_last_reset ON users(last_reset);
+            """)
+    
+    def migrate_json(self):
+        """Однократно переносит пользователей из прежних JSON-файлов"""
+        json_files = [path for path in (USER_DB_FILE, USER_JOURNAL_FILE, USER_JOURNAL_FILE + '.old')
+                      if os.path.exists(path)]
+        if not json_files:
+            return
+        
+        try:
+            users, _ = read_json_users()
+            with self.conn() as db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [self.user_row(user) for user in users.values()]
+                )
+            
+            # Переименовываем, чтобы не импортировать повторно
+            for path in json_files:
+                os.replace(path, path + '.migrated')
+            print(f"📦 Миграция в SQLite: {len(users)} пользователей")
+        except Exception as e:
+            print(f"❌ Ошибка миграции JSON в SQLite: {e}")
+    
+    def take_ip_limits(self, day):
+        """Забирает дневные счетчики IP из таблицы ip_limits прежней версии за день day
+        (ISO-дата) и удаляет таблицу: лимиты по IP теперь ведет RateLimiter"""
+        with self.conn() as db:
+            if not db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ip_limits'").fetchone():
+                return {}
+            rows = db.execute("SELECT ip, used_today FROM ip_limits WHERE last_reset = ?", (day,)).fetchall()
+            db.execute("DROP TABLE ip_limits")
+        return {row['ip']: row['used_today'] for row in rows}
+    
+    @staticmethod
+    def user_row(user):
+        return (
+            user['user_id'],
+            user.get('plan', 'free'),
+            user.get('used_today', 0),
+            user.get('last_reset') or date.today().isoformat(),
+            user.get('total_used', 0),
+            user.get('created_at'),
+            user.get('plan_expires')
+        )
+    
+    def get_user(self, user_id):
+        row = self.conn().execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def put_users(self, users):
+        with self.conn() as db:
+            db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [self.user_row(user) for user in users])
+    
+    def all_users(self):
+        rows = self.conn().execute("SELECT * FROM users ORDER BY created_at").fetchall()
+        return {row['user_id']: dict(row) for row in rows}
+    
+    def user_stats(self):
+        """Возвращает (всего пользователей, всего анализов, анализов сегодня)"""
+        row = self.conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(total_used), 0), "
+            "COALESCE(SUM(CASE WHEN last_reset = ? THEN used_today ELSE 0 END), 0) FROM users",
+            (date.today().isoformat(),)
+        ).fetchone()
+        return tuple(row)
+    
+    def reset_daily_usage(self, day):
+        """Одним UPDATE обнуляет дневные счетчики за прошлые дни"""
+        with self.conn() as db:
+            db.execute("UPDATE users SET used_today = 0, last_reset = ? WHERE last_reset < ?",
+                       (day_iso(day), day_iso(day)))
+    
+    def plan_expirations(self):
+        rows = self.conn().execute(
+            "SELECT user_id, plan_expires FROM users WHERE plan != 'free' AND plan_expires IS NOT NULL"
+        ).fetchall()
+        return [(row['user_id'], day_number(row['plan_expires'])) for row in rows]
+
+def create_storage():
+    """Создает хранилище по настройке DOCSCAN_STORAGE"""
+    if STORAGE_BACKEND == 'journal':
+        return JournalStorage()
+    return SQLiteStorage(SQLITE_DB_FILE)
+
+# Компактная запись пользователя в памяти: вместо словаря с семью строковыми
+# ключами - объект со слотами, даты - номера дней (date.toordinal), тариф - код.
+# Наружу (JSON, SQLite, Redis, API) пользователь по-прежнему отдается словарем
+PLAN_CODES = ('free', 'basic', 'premium', 'unlimited')
+PLAN_CODE = {plan: code for code, plan in enumerate(PLAN_CODES)}
+FREE_PLAN = PLAN_CODE['free']
+NO_EXPIRY = 0
+
+def day_number(value):
+    """ISO-дата ('2024-05-01' или с временем) -> номер дня"""
+    return date.fromisoformat(value[:10]).toordinal()
+
+def day_iso(number):
+    return date.fromordinal(number).isoformat()
+
+def today_number():
+    return date.today().toordinal()
+
+class UserRecord:
+    __slots__ = ('user_id', 'plan_code', 'used_today', 'last_reset', 'total_used', 'created_at', 'plan_expires')
+    
+    def __init__(self, user_id, plan_code, used_today, last_reset, total_used, created_at, plan_expires):
+        self.user_id = user_id
+        self.plan_code = plan_code
+        self.used_today = used_today
+        self.last_reset = last_reset
+        self.total_used = total_used
+        self.created_at = created_at
+        self.plan_expires = plan_expires  # NO_EXPIRY - без срока
+    
+    @classmethod
+    def from_dict(cls, user):
+        """Запись из словаря в формате JSON-базы"""
+        return cls(
+            user['user_id'],
+            PLAN_CODE[user.get('plan') or 'free'],
+            int(user.get('used_today') or 0),
+            day_number(user['last_reset']) if user.get('last_reset') else today_number(),
+            int(user.get('total_used') or 0),
+            user.get('created_at'),
+            day_number(user['plan_expires']) if user.get('plan_expires') else NO_EXPIRY
+        )
+    
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'plan': self.plan,
+            'used_today': self.used_today,
+            'last_reset': day_iso(self.last_reset),
+            'total_used': self.total_used,
+            'created_at': self.created_at,
+            'plan_expires': day_iso(self.plan_expires) if self.plan_expires else None
+        }
+    
+    @property
+    def plan(self):
+        return PLAN_CODES[self.plan_code]
+    
+    def update(self, fields):
+        """Применяет изменения в формате JSON-базы"""
+        for key, value in fields.items():
+            if key == 'plan':
+                self.plan_code = PLAN_CODE[value]
+            elif key == 'last_reset':
+                self.last_reset = day_number(value)
+            elif key == 'plan_expires':
+                self.plan_expires = day_number(value) if value else NO_EXPIRY
+            else:
+                setattr(self, key, value)
+    
+    def values(self):
+        return (self.user_id, self.plan_code, self.used_today, self.last_reset,
+                self.total_used, self.created_at, self.plan_expires)
+    
+    def copy(self):
+        return UserRecord(*self.values())
 
-# Загружаем базу при старте сервера
-users_db = load_users()
-print(f"🚀 Сервер запущен. Всего пользователей: {len(users_db)}")
+# Пользователи в памяти разбиты на шарды по хэшу user_id, у каждого шарда своя
+# блокировка - запросы разных пользователей не ждут друг друга
+USER_STORE_SHARDS = int(os.getenv('USER_STORE_SHARDS', 64))
+
+class UserShard:
+    __slots__ = ('lock', 'records', 'dirty')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.dirty = set()
+
+class UserStore:
+    """Потокобезопасное хранилище записей пользователей с блокировкой на шард.
+    Наружу отдаются только копии, менять запись можно лишь через update/compare_and_update"""
+    
+    def __init__(self, shards=USER_STORE_SHARDS, on_change=None):
+        self.shards = [UserShard() for _ in range(shards)]
+        self.on_change = on_change
+    
+    def shard(self, user_id):
+        return self.shards[zlib.crc32(user_id.encode('utf-8')) % len(self.shards)]
+    
+    def changed(self, shard, user_id):
+        """Вызывается под блокировкой шарда"""
+        shard.dirty.add(user_id)
+        if self.on_change:
+            self.on_change()
+    
+    def get(self, user_id):
+        """Копия записи UserRecord или None"""
+        shard = self.shard(user_id)
+        with shard.lock:
+            user = shard.records.get(user_id)
+            return user.copy() if user is not None else None
+    
+    def insert(self, user, dirty=True):
+        """Добавляет запись (словарь), если ее еще нет. Возвращает True, если добавлена"""
+        record = UserRecord.from_dict(user)
+        shard = self.shard(record.user_id)
+        with shard.lock:
+            if record.user_id in shard.records:
+                return False
+            shard.records[record.user_id] = record
+            if dirty:
+                self.changed(shard, record.user_id)
+            return True
+    
+    def update(self, user_id, mutate):
+        """Применяет mutate(запись) под блокировкой шарда и возвращает ее результат.
+        None, если пользователя нет"""
+        shard = self.shard(user_id)
+        with shard.lock:
+            user = shard.records.get(user_id)
+            if user is None:
+                return None
+            before = user.values()
+            result = mutate(user)
+            if user.values() != before:
+                self.changed(shard, user_id)
+            return result
+    
+    def update_all(self, mutate):
+        """Применяет mutate ко всем записям, шард за шардом"""
+        for shard in self.shards:
+            with shard.lock:
+                for user_id, user in shard.records.items():
+                    before = user.values()
+                    mutate(user)
+                    if user.values() != before:
+                        self.changed(shard, user_id)
+    
+    def compare_and_update(self, user_id, expected, changes):
+        """Применяет changes, только если поля записи совпадают с expected (в формате JSON-базы)"""
+        shard = self.shard(user_id)
+        with shard.lock:
+            user = shard.records.get(user_id)
+            if user is None:
+                return False
+            current = user.to_dict()
+            if any(current.get(key) != value for key, value in expected.items()):
+                return False
+            user.update(changes)
+            self.changed(shard, user_id)
+            return True
+    
+    def take_dirty(self):
+        """Забирает словари всех измененных записей и очищает отметки"""
+        users = []
+        for shard in self.shards:
+            with shard.lock:
+                if shard.dirty:
+                    users.extend(shard.records[user_id].to_dict() for user_id in shard.dirty)
+                    shard.dirty = set()
+        return users
+    
+    def mark_dirty(self, user_ids):
+        for user_id in user_ids:
+            shard = self.shard(user_id)
+            with shard.lock:
+                self.changed(shard, user_id)
+
+# Отложенная запись: изменения копятся в памяти и сбрасываются в хранилище пачкой
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', 1.0))  # секунд тишины до записи
+STORAGE_FLUSH_MAX_LATENCY = float(os.getenv('STORAGE_FLUSH_MAX_LATENCY', 5.0))  # максимум секунд до записи
+
+class WriteBehindStorage:
+    """Кэш поверх хранилища: чтения из памяти, изменения помечаются грязными
+    и записываются фоновым потоком одной пачкой"""
+    
+    def __init__(self, backend, interval=STORAGE_FLUSH_INTERVAL, max_latency=STORAGE_FLUSH_MAX_LATENCY):
+        self.backend = backend
+        self.interval = interval
+        self.max_latency = max_latency
+        self.users = UserStore(on_change=self.mark_dirty)
+        self.first_dirty_at = None
+        self.last_dirty_at = None
+        self.dirty_lock = threading.Lock()  # защищает first_dirty_at и last_dirty_at
+        self.wakeup = threading.Event()
+        self.flush_lock = threading.Lock()
+        threading.Thread(target=self.flush_worker, name='storage-flusher', daemon=True).start()
+    
+    def load(self, user_id):
+        """Подтягивает запись из хранилища в кэш при первом обращении, возвращает копию UserRecord"""
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.backend.get_user(user_id)
+            if user is not None:
+                self.users.insert(user, dirty=False)
+                user = self.users.get(user_id)
+        return user
+    
+    def get_user(self, user_id):
+        return self.load(user_id)
+    
+    def insert_user(self, user):
+        """Создает пользователя, если его нет ни в кэше, ни в хранилище"""
+        if self.load(user['user_id']) is not None:
+            return False
+        return self.users.insert(user)
+    
+    def update_user(self, user_id, mutate):
+        self.load(user_id)
+        return self.users.update(user_id, mutate)
+    
+    def compare_and_update(self, user_id, expected, changes):
+        self.load(user_id)
+        return self.users.compare_and_update(user_id, expected, changes)
+    
+    def mark_dirty(self):
+        now = time.monotonic()
+        with self.dirty_lock:
+            if self.first_dirty_at is None:
+                self.first_dirty_at = now
+            self.last_dirty_at = now
+            self.wakeup.set()
+    
+    def all_users(self):
+        self.flush()
+        return self.backend.all_users()
+    
+    def user_stats(self):
+        self.flush()
+        return self.backend.user_stats()
+    
+    def reset_daily_usage(self, day):
+        """Массовый сброс дневных счетчиков: в хранилище одним запросом, в кэше - по шардам"""
+        def reset(user):
+            if user.last_reset < day:
+                user.used_today = 0
+                user.last_reset = day
+        self.flush()
+        with self.flush_lock:
+            self.backend.reset_daily_usage(day)
+        # Измененные записи кэша помечаются грязными - на случай, если их старая
+        # версия успела записаться в хранилище после сброса
+        self.users.update_all(reset)
+    
+    def plan_expirations(self):
+        self.flush()
+        return self.backend.plan_expirations()
+    
+    def flush(self):
+        """Записывает все накопленные изменения в хранилище"""
+        with self.flush_lock:
+            with self.dirty_lock:
+                self.first_dirty_at = None
+                self.last_dirty_at = None
+            self.wakeup.clear()
+            users = self.users.take_dirty()
+            if not users:
+                return
+            
+            try:
+                self.backend.put_users(users)
+            except Exception as e:
+                # Возвращаем в очередь, чтобы не потерять изменения
+                print(f"❌ Ошибка записи в хранилище: {e}")
+                self.users.mark_dirty(user['user_id'] for user in users)
+    
+    def flush_worker(self):
+        """Фоновый поток: пишет после паузы в изменениях, но не позже max_latency"""
+        while True:
+            self.wakeup.wait()
+            try:
+                # flush() из другого потока может обнулить отметки между чтениями
+                with self.dirty_lock:
+                    first_dirty_at, last_dirty_at = self.first_dirty_at, self.last_dirty_at
+                    if first_dirty_at is None or last_dirty_at is None:
+                        self.wakeup.clear()
+                if first_dirty_at is None or last_dirty_at is None:
+                    continue
+                deadline = min(last_dirty_at + self.interval, first_dirty_at + self.max_latency)
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                    continue
+                self.flush()
+            except Exception as e:
+                # Поток не должен умирать молча: без него изменения перестанут сохраняться
+                print(f"❌ Ошибка фоновой записи в хранилище: {e}")
+            # Не крутимся вхолостую, если запись упала
+            time.sleep(0.05)
+
+# Система лимитов по IP
+# Token bucket на каждый ключ "тариф|IP": емкость capacity анализов,
+# полностью восстанавливается за period секунд. Правила задаются по тарифам,
+# тарифы без правила по IP не ограничиваются
+IP_RATE_RULES = json.loads(os.getenv('IP_RATE_RULES', '{"free": {"capacity": 1, "period": 86400}}'))
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+# Сохранение корзин на диск необязательно: пустой путь - только память
+RATE_LIMIT_PERSIST_FILE = os.getenv('RATE_LIMIT_PERSIST_FILE', '')
+RATE_LIMIT_PERSIST_INTERVAL = int(os.getenv('RATE_LIMIT_PERSIST_INTERVAL', 30))  # секунд
+
+# Локальные IP не ограничиваем (для тестирования)
+LOCAL_IPS = ['127.0.0.1', 'localhost']
+
+class RateLimiter:
+    """Token bucket с ограниченным числом ключей.
+    Корзина, не трогавшаяся period секунд, снова полна и ничем не отличается
+    от отсутствующей - такие удаляются (TTL), а при переполнении вытесняются
+    самые давно использованные (LRU). Все операции O(1)"""
+    
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS, persist_path=RATE_LIMIT_PERSIST_FILE,
+                 persist_interval=RATE_LIMIT_PERSIST_INTERVAL):
+        self.max_keys = max_keys
+        self.persist_path = persist_path
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # ключ -> [токены, время обновления, period]
+        self.dirty = False
+        if persist_path:
+            self.load()
+            threading.Thread(target=self.persist_worker, args=(persist_interval,),
+                             name='rate-limiter-persist', daemon=True).start()
+            atexit.register(self.save)
+    
+    def bucket(self, key, capacity, period, now):
+        """Возвращает корзину ключа с начисленными токенами (вызывается под self.lock)"""
+        self.evict(now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [float(capacity), now, period]
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            tokens, updated_at, _ = bucket
+            bucket[0] = min(float(capacity), tokens + (now - updated_at) * capacity / period)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        return bucket
+    
+    def evict(self, now):
+        """Удаляет истекшие корзины из начала LRU-очереди"""
+        while self.buckets:
+            key, (_, updated_at, period) = next(iter(self.buckets.items()))
+            if now - updated_at < period:
+                break
+            del self.buckets[key]
+    
+    def available(self, key, capacity, period):
+        with self.lock:
+            return self.bucket(key, capacity, period, time.time())[0]
+    
+    def try_acquire(self, key, capacity, period):
+        """Забирает один токен, если он есть"""
+        with self.lock:
+            bucket = self.bucket(key, capacity, period, time.time())
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            self.dirty = True
+            return True
+    
+    def refund(self, key, capacity, period):
+        """Возвращает ранее забранный токен"""
+        with self.lock:
+            bucket = self.bucket(key, capacity, period, time.time())
+            bucket[0] = min(float(capacity), bucket[0] + 1)
+            self.dirty = True
+    
+    def __len__(self):
+        return len(self.buckets)
+    
+    def load(self):
+        """Загружает сохраненные корзины, пропуская истекшие"""
+        try:
+            if os.path.exists(self.persist_path):
+                with open(self.persist_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                now = time.time()
+                for key, bucket in sorted(data.items(), key=lambda item: item[1][1]):
+                    if now - bucket[1] < bucket[2]:
+                        self.buckets[key] = bucket
+                print(f"✅ Загружено {len(self.buckets)} IP-корзин")
+        except Exception as e:
+            print(f"❌ Ошибка загрузки IP-лимитов: {e}")
+    
+    def save(self):
+        """Сохраняет все корзины одной записью, если были изменения"""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.evict(time.time())
+            data = {key: list(bucket) for key, bucket in self.buckets.items()}
+            self.dirty = False
+        try:
+            temp_path = self.persist_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(temp_path, self.persist_path)
+        except Exception as e:
+            print(f"❌ Ошибка сохранения IP-лимитов: {e}")
+    
+    def persist_worker(self, interval):
+        while True:
+            time.sleep(interval)
+            self.save()
+
+def migrate_ip_limits(state, storage=None):
+    """Однократно переносит сегодняшние счетчики IP прежних версий (JSON-файл и таблица
+    ip_limits в SQLite) в корзины бесплатного тарифа: сколько анализов IP уже сделал
+    сегодня, столько токенов и забирается"""
+    today = date.today().isoformat()
+    counts = {}
+    if os.path.exists(IP_LIMITS_FILE):
+        try:
+            with open(IP_LIMITS_FILE, 'r', encoding='utf-8') as f:
+                for ip, ip_data in json.load(f).items():
+                    if ip_data.get('last_reset') == today:
+                        counts[ip] = int(ip_data.get('used_today') or 0)
+            # Переименовываем, чтобы не импортировать повторно
+            os.replace(IP_LIMITS_FILE, IP_LIMITS_FILE + '.migrated')
+        except Exception as e:
+            print(f"❌ Ошибка переноса IP-лимитов из JSON: {e}")
+    if hasattr(storage, 'take_ip_limits'):
+        try:
+            for ip, used in storage.take_ip_limits(today).items():
+                counts[ip] = max(counts.get(ip, 0), used)
+        except Exception as e:
+            print(f"❌ Ошибка переноса IP-лимитов из SQLite: {e}")
+    
+    rule = get_ip_rule('free')
+    if rule is None or not counts:
+        return
+    for ip, used in counts.items():
+        for _ in range(min(used, rule[0])):
+            state.try_acquire_ip(f"free|{ip}", *rule)
+    print(f"📦 IP-лимиты прежней версии перенесены в лимитер: {len(counts)} адресов")
+
+# Планировщик: дневные лимиты сбрасываются разом в полночь, платные тарифы
+# переводятся на бесплатный в полночь после даты окончания. Запросы сами даты не проверяют
+def day_start(day):
+    """Timestamp локальной полуночи, с которой начинается день с номером day"""
+    return time.mktime(date.fromordinal(day).timetuple())
+
+class Scheduler:
+    """Куча сроков: задачи выполняются одним фоновым потоком в назначенное время"""
+    
+    def __init__(self, name='scheduler', clock=time.time):
+        self.clock = clock  # источник текущего времени; в тестах - подменные часы
+        self.heap = []  # (время, порядковый номер, функция, аргументы)
+        self.counter = 0
+        self.cond = threading.Condition()
+        threading.Thread(target=self.worker, name=name, daemon=True).start()
+    
+    def schedule(self, when, func, *args):
+        """Ставит func(*args) на момент when (timestamp). Прошедшее время - выполнить сразу"""
+        with self.cond:
+            self.counter += 1
+            heapq.heappush(self.heap, (when, self.counter, func, args))
+            self.cond.notify()
+    
+    def __len__(self):
+        return len(self.heap)
+    
+    def wake(self):
+        """Будит поток, чтобы он заново сверил сроки с часами (после перевода подменных часов)"""
+        with self.cond:
+            self.cond.notify()
+    
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > self.clock():
+                    self.cond.wait(self.heap[0][0] - self.clock() if self.heap else None)
+                _, _, func, args = heapq.heappop(self.heap)
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"❌ Ошибка задачи планировщика {getattr(func, '__name__', func)}: {e}")
+
+# Общее состояние сервиса: пользователи, счетчики, IP-лимиты и сессии админов.
+# local - в памяти процесса (поверх хранилища выше), годится для одного инстанса
+# redis - в Redis, общее для всех процессов и инстансов за балансировщиком
+STATE_BACKEND = os.getenv('DOCSCAN_STATE_BACKEND', 'local')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+ADMIN_SESSION_TTL = int(os.getenv('ADMIN_SESSION_TTL', 12 * 3600))  # секунд
+
+class LocalState:
+    """Состояние в памяти процесса"""
+    
+    def __init__(self):
+        self.storage = WriteBehindStorage(create_storage())
+        self.ip_limiter = RateLimiter()
+        migrate_ip_limits(self, self.storage.backend)
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        atexit.register(self.storage.flush)
+        
+        # Счетчики для админки ведутся на лету, без обхода пользователей
+        self.stats_lock = threading.Lock()
+        self.total_users, self.total_analyses, self.today_analyses = self.storage.user_stats()
+        self.day = today_number()
+        
+        # Сброс за пропущенные дни и уже истекшие тарифы обрабатываются сразу при старте
+        self.scheduler = Scheduler()
+        self.reset_day()
+        for user_id, expires in self.storage.plan_expirations():
+            self.schedule_expiry(user_id, expires)
+    
+    def get_user(self, user_id):
+        user = self.storage.get_user(user_id)
+        return user.to_dict() if user is not None else None
+    
+    def create_user(self, user):
+        """Создает пользователя, если его еще нет. Возвращает True, если создан"""
+        created = self.storage.insert_user(user)
+        if created:
+            with self.stats_lock:
+                self.total_users += 1
+        return created
+    
+    def update_user(self, user_id, **fields):
+        def apply(user):
+            user.update(fields)
+            return user.to_dict()
+        user = self.storage.update_user(user_id, apply)
+        if user is not None and fields.get('plan_expires'):
+            self.schedule_expiry(user_id, day_number(fields['plan_expires']))
+        return user
+    
+    def compare_and_update_user(self, user_id, expected, changes):
+        return self.storage.compare_and_update(user_id, expected, changes)
+    
+    def reset_day(self):
+        """Задача планировщика: массовый сброс дневных счетчиков, следующий - в полночь"""
+        today = today_number()
+        self.storage.reset_daily_usage(today)
+        with self.stats_lock:
+            if self.day != today:
+                self.today_analyses = 0
+                self.day = today
+        self.scheduler.schedule(day_start(today + 1), self.reset_day)
+        print(f"🔄 Дневные лимиты сброшены на {day_iso(today)}")
+    
+    def schedule_expiry(self, user_id, expires):
+        """Тариф действует по день expires включительно и снимается в следующую полночь"""
+        self.scheduler.schedule(day_start(expires + 1), self.expire_plan, user_id, expires)
+    
+    def expire_plan(self, user_id, expires):
+        """Задача планировщика: переводит на бесплатный тариф, если срок не продлили.
+        Продленный тариф получил другую дату окончания - сравнение не пройдет"""
+        expected = {'plan_expires': day_iso(expires)}
+        if self.compare_and_update_user(user_id, expected, {'plan': 'free', 'plan_expires': None}):
+            print(f"🔄 Тариф пользователя {user_id} сброшен на бесплатный (истек)")
+    
+    def reserve_usage(self, user_id, day, limit):
+        """Атомарно увеличивает used_today, если лимит не исчерпан. Возвращает новое значение или None"""
+        def reserve(user):
+            # Страховка на случай запроса в момент полуночи до срабатывания планировщика
+            if user.last_reset < day:
+                user.used_today = 0
+                user.last_reset = day
+            if user.used_today >= limit:
+                return None
+            user.used_today += 1
+            return user.used_today
+        return self.storage.update_user(user_id, reserve)
+    
+    def refund_usage(self, user_id, day):
+        """Возвращает один анализ, если счетчик еще за тот же день"""
+        def refund(user):
+            if user.last_reset == day and user.used_today > 0:
+                user.used_today -= 1
+        self.storage.update_user(user_id, refund)
+    
+    def commit_usage(self, user_id):
+        def commit(user):
+            user.total_used += 1
+            return user.to_dict()
+        user = self.storage.update_user(user_id, commit)
+        with self.stats_lock:
+            self.total_analyses += 1
+            self.today_analyses += 1
+        return user
+    
+    def all_users(self):
+        return self.storage.all_users()
+    
+    def user_stats(self):
+        """Возвращает (всего пользователей, всего анализов, анализов сегодня)"""
+        with self.stats_lock:
+            return self.total_users, self.total_analyses, self.today_analyses
+    
+    def ip_available(self, key, capacity, period):
+        return self.ip_limiter.available(key, capacity, period)
+    
+    def try_acquire_ip(self, key, capacity, period):
+        return self.ip_limiter.try_acquire(key, capacity, period)
+    
+    def refund_ip(self, key, capacity, period):
+        self.ip_limiter.refund(key, capacity, period)
+    
+    def tracked_ips(self):
+        return len(self.ip_limiter)
+    
+    def create_session(self, session_id, data, ttl=ADMIN_SESSION_TTL):
+        now = time.time()
+        with self.sessions_lock:
+            self.sessions = {sid: item for sid, item in self.sessions.items() if item[1] > now}
+            self.sessions[session_id] = (data, now + ttl)
+    
+    def get_session(self, session_id):
+        item = self.sessions.get(session_id)
+        if item is None or item[1] <= time.time():
+            return None
+        return item[0]
+
+# Lua-скрипты выполняются в Redis атомарно
+REDIS_CREATE_USER = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('HINCRBY', KEYS[3], 'users', 1)
+return 1
+"""
+
+# ARGV = число проверяемых полей, пары (поле, ожидаемое значение), затем пары новых значений
+REDIS_COMPARE_AND_UPDATE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local n = tonumber(ARGV[1])
+for i = 0, n - 1 do
+    local value = redis.call('HGET', KEYS[1], ARGV[2 + i * 2]) or ''
+    if value ~= ARGV[3 + i * 2] then return 0 end
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2 + n * 2))
+return 1
+"""
+
+REDIS_RESET_DAY = """
+local last = redis.call('HGET', KEYS[1], 'last_reset')
+if last and last < ARGV[1] then
+    redis.call('HSET', KEYS[1], 'used_today', 0, 'last_reset', ARGV[1])
+end
+return 1
+"""
+
+REDIS_RESERVE_USAGE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local last = redis.call('HGET', KEYS[1], 'last_reset')
+if (not last) or last < ARGV[1] then
+    redis.call('HSET', KEYS[1], 'used_today', 0, 'last_reset', ARGV[1])
+end
+local used = tonumber(redis.call('HGET', KEYS[1], 'used_today') or '0')
+if used >= tonumber(ARGV[2]) then return -1 end
+return redis.call('HINCRBY', KEYS[1], 'used_today', 1)
+"""
+
+REDIS_REFUND_USAGE = """
+local used = tonumber(redis.call('HGET', KEYS[1], 'used_today') or '0')
+if redis.call('HGET', KEYS[1], 'last_reset') == ARGV[1] and used > 0 then
+    return redis.call('HINCRBY', KEYS[1], 'used_today', -1)
+end
+return used
+"""
+
+# Token bucket с серверным временем Redis: ARGV = capacity, period, delta
+# (delta -1 - забрать токен, +1 - вернуть, 0 - только посмотреть)
+REDIS_TOKEN_BUCKET = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local delta = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * capacity / period)
+if delta < 0 and tokens < 1 then return {0, tostring(tokens)} end
+tokens = math.min(capacity, tokens + delta)
+if delta ~= 0 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(period * 1000))
+end
+return {1, tostring(tokens)}
+"""
+
+class RedisState:
+    """Состояние в Redis: пользователь - хэш, счетчики меняются атомарными
+    HINCRBY/Lua, IP-корзины и сессии живут с TTL"""
+    
+    PREFIX = 'docscan:'
+    INT_FIELDS = ('used_today', 'total_used')
+    
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.redis.ping()
+        self.create_user_script = self.redis.register_script(REDIS_CREATE_USER)
+        self.compare_and_update_script = self.redis.register_script(REDIS_COMPARE_AND_UPDATE)
+        self.reset_day_script = self.redis.register_script(REDIS_RESET_DAY)
+        self.reserve_script = self.redis.register_script(REDIS_RESERVE_USAGE)
+        self.refund_script = self.redis.register_script(REDIS_REFUND_USAGE)
+        self.bucket_script = self.redis.register_script(REDIS_TOKEN_BUCKET)
+        if not self.redis.exists(self.stats_key):
+            self.rebuild_indexes()
+        migrate_ip_limits(self)
+        
+        # Каждый инстанс запускает сброс в полночь: скрипты идемпотентны,
+        # повторный проход другого инстанса ничего не меняет
+        self.scheduler = Scheduler()
+        self.reset_day()
+    
+    def user_key(self, user_id):
+        return f"{self.PREFIX}user:{user_id}"
+    
+    @property
+    def users_key(self):
+        return f"{self.PREFIX}users"
+    
+    @property
+    def stats_key(self):
+        return f"{self.PREFIX}stats"
+    
+    @property
+    def expirations_key(self):
+        """Sorted set: user_id с номером дня окончания тарифа в качестве score"""
+        return f"{self.PREFIX}plan_expires"
+    
+    def day_stats_key(self, day):
+        return f"{self.PREFIX}stats:day:{day_iso(day)}"
+    
+    def rebuild_indexes(self):
+        """Однократно строит счетчики и индекс сроков по уже существующим пользователям"""
+        users = list(self.all_users().values())
+        pipe = self.redis.pipeline()
+        pipe.hsetnx(self.stats_key, 'users', len(users))
+        pipe.hsetnx(self.stats_key, 'analyses', sum(user['total_used'] for user in users))
+        for user in users:
+            if user['plan'] != 'free' and user['plan_expires']:
+                pipe.zadd(self.expirations_key, {user['user_id']: day_number(user['plan_expires'])})
+        pipe.execute()
+    
+    def decode_user(self, data):
+        if not data:
+            return None
+        user = dict(data)
+        for field in self.INT_FIELDS:
+            user[field] = int(user.get(field, 0))
+        user['plan_expires'] = user.get('plan_expires') or None
+        return user
+    
+    @staticmethod
+    def encode_fields(fields):
+        return {key: '' if value is None else value for key, value in fields.items()}
+    
+    def get_user(self, user_id):
+        return self.decode_user(self.redis.hgetall(self.user_key(user_id)))
+    
+    def create_user(self, user):
+        args = [user['user_id']]
+        for key, value in self.encode_fields(user).items():
+            args += [key, value]
+        keys = [self.user_key(user['user_id']), self.users_key, self.stats_key]
+        return bool(self.create_user_script(keys=keys, args=args))
+    
+    def update_user(self, user_id, **fields):
+        key = self.user_key(user_id)
+        if not self.redis.exists(key):
+            return None
+        self.redis.hset(key, mapping=self.encode_fields(fields))
+        if fields.get('plan_expires'):
+            self.redis.zadd(self.expirations_key, {user_id: day_number(fields['plan_expires'])})
+        return self.get_user(user_id)
+    
+    def compare_and_update_user(self, user_id, expected, changes):
+        args = [len(expected)]
+        for fields in (expected, changes):
+            for key, value in self.encode_fields(fields).items():
+                args += [key, value]
+        return bool(self.compare_and_update_script(keys=[self.user_key(user_id)], args=args))
+    
+    def reset_day(self):
+        """Задача планировщика: сброс дневных счетчиков и снятие истекших тарифов"""
+        today = today_number()
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in self.redis.sscan_iter(self.users_key, count=1000):
+            self.reset_day_script(keys=[self.user_key(user_id)], args=[day_iso(today)], client=pipe)
+            if len(pipe) >= 1000:
+                pipe.execute()
+        pipe.execute()
+        
+        # Тариф действует по день окончания включительно
+        for user_id, expires in self.redis.zrangebyscore(self.expirations_key, '-inf', today - 1, withscores=True):
+            expected = {'plan_expires': day_iso(int(expires))}
+            if self.compare_and_update_user(user_id, expected, {'plan': 'free', 'plan_expires': None}):
+                print(f"🔄 Тариф пользователя {user_id} сброшен на бесплатный (истек)")
+        # Продленные тарифы получили новый score и под удаление не попадают
+        self.redis.zremrangebyscore(self.expirations_key, '-inf', today - 1)
+        
+        self.scheduler.schedule(day_start(today + 1), self.reset_day)
+        print(f"🔄 Дневные лимиты сброшены на {day_iso(today)}")
+    
+    def reserve_usage(self, user_id, day, limit):
+        used = self.reserve_script(keys=[self.user_key(user_id)], args=[day_iso(day), limit])
+        return None if used < 0 else used
+    
+    def refund_usage(self, user_id, day):
+        self.refund_script(keys=[self.user_key(user_id)], args=[day_iso(day)])
+    
+    def commit_usage(self, user_id):
+        day_key = self.day_stats_key(today_number())
+        pipe = self.redis.pipeline()
+        pipe.hincrby(self.user_key(user_id), 'total_used', 1)
+        pipe.hincrby(self.stats_key, 'analyses', 1)
+        pipe.incr(day_key)
+        pipe.expire(day_key, 2 * 86400)
+        pipe.execute()
+        return self.get_user(user_id)
+    
+    def all_users(self):
+        user_ids = list(self.redis.sscan_iter(self.users_key))
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(self.user_key(user_id))
+        users = (self.decode_user(data) for data in pipe.execute())
+        return {user['user_id']: user for user in users if user}
+    
+    def user_stats(self):
+        """Возвращает (всего пользователей, всего анализов, анализов сегодня)"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.stats_key, 'users', 'analyses')
+        pipe.get(self.day_stats_key(today_number()))
+        (users, analyses), today = pipe.execute()
+        return int(users or 0), int(analyses or 0), int(today or 0)
+    
+    def bucket(self, key, capacity, period, delta):
+        ok, tokens = self.bucket_script(keys=[f"{self.PREFIX}ip:{key}"], args=[capacity, period, delta])
+        return bool(ok), float(tokens)
+    
+    def ip_available(self, key, capacity, period):
+        return self.bucket(key, capacity, period, 0)[1]
+    
+    def try_acquire_ip(self, key, capacity, period):
+        return self.bucket(key, capacity, period, -1)[0]
+    
+    def refund_ip(self, key, capacity, period):
+        self.bucket(key, capacity, period, 1)
+    
+    def tracked_ips(self):
+        return sum(1 for _ in self.redis.scan_iter(f"{self.PREFIX}ip:*", count=1000))
+    
+    def create_session(self, session_id, data, ttl=ADMIN_SESSION_TTL):
+        self.redis.set(f"{self.PREFIX}session:{session_id}", json.dumps(data), ex=ttl)
+    
+    def get_session(self, session_id):
+        data = self.redis.get(f"{self.PREFIX}session:{session_id}")
+        return json.loads(data) if data else None
+
+def create_state():
+    """Создает общее состояние по настройке DOCSCAN_STATE_BACKEND"""
+    if STATE_BACKEND == 'redis':
+        return RedisState(REDIS_URL)
+    return LocalState()
+
+# Само состояние создается после пула извлечения (см. extractor_pool): хранилище,
+# лимитер и планировщик запускают фоновые потоки
+
+def get_ip_rule(plan):
+    """Возвращает (capacity, period) правила тарифа по IP или None"""
+    rule = IP_RATE_RULES.get(plan)
+    if not rule:
+        return None
+    return rule['capacity'], rule['period']
+
+def can_analyze_by_ip(ip_address, plan='free'):
+    """Исправленная проверка по IP"""
+    print(f"🔍 IP клиента: {ip_address}")
+    
+    rule = get_ip_rule(plan)
+    if rule is None:
+        return True
+    
+    if ip_address in LOCAL_IPS:
+        print("✅ Локальный IP - пропускаем проверку")
+        return True
+    
+    capacity, period = rule
+    available = state.ip_available(f"{plan}|{ip_address}", capacity, period)
+    can_analyze = available >= 1
+    
+    if can_analyze:
+        print(f"📡 IP {ip_address} может сделать анализ (доступно {int(available)}/{capacity})")
+    else:
+        print(f"🚫 IP {ip_address} уже использовал бесплатный анализ ({int(available)}/{capacity})")
+    
+    return can_analyze
 
 # Добавляем администраторов
 ADMINS = {
@@ -242,9 +1379,6 @@ ADMINS = {
     'superuser': 'super123'
 }
 
-# Глобальная переменная для хранения сессий
-admin_sessions = {}
-
 # ОБНОВЛЕННЫЕ ТАРИФЫ - 1 бесплатный, потом платные
 PLANS = {
     'free': {
@@ -281,8 +1415,9 @@ def get_user(user_id=None):
     if not user_id:
         user_id = generate_user_id()
     
-    if user_id not in users_db:
-        users_db[user_id] = {
+    user = state.get_user(user_id)
+    if user is None:
+        new_user = {
             'user_id': user_id,
             'plan': 'free',
             'used_today': 0,
@@ -291,169 +1426,1378 @@ def get_user(user_id=None):
             'created_at': datetime.now().isoformat(),
             'plan_expires': None  # ДОБАВИЛИ
         }
-        save_users()
-        print(f"👤 Создан новый пользователь: {user_id}")
-    
-    user = users_db[user_id]
+        if state.create_user(new_user):
+            print(f"👤 Создан новый пользователь: {user_id}")
+        user = state.get_user(user_id)
     
-    # Сбрасываем дневной лимит если новый день
-    if user['last_reset'] < date.today().isoformat():
-        user['used_today'] = 0
-        user['last_reset'] = date.today().isoformat()
+    # Дневной сброс и просрочку тарифа выполняет планировщик состояния
+    return user
+
+# Резервирование квоты: анализ списывается ДО извлечения текста и вызова AI,
+# поэтому параллельные запросы одного пользователя или IP не проходят проверку разом
+
+class QuotaReservation:
+    """Зарезервированный анализ: подтверждается после успеха, иначе возвращается"""
     
-    # ПРОВЕРЯЕМ ПРОСРОЧКУ ТАРИФА - ДОБАВИЛИ
-    if user['plan'] != 'free' and user.get('plan_expires'):
-        if user['plan_expires'] < date.today().isoformat():
-            user['plan'] = 'free'
-            user['plan_expires'] = None
-            print(f"🔄 Тариф пользователя {user_id} сброшен на бесплатный (истек)")
+    def __init__(self, user_id, ip_key, ip_rule, day):
+        self.user_id = user_id
+        self.ip_key = ip_key  # None, если IP не списывался
+        self.ip_rule = ip_rule
+        self.day = day
+        self.committed = False
+        self.released = False
+        self.lock = threading.Lock()
     
-    save_users()
-    return user
+    def finish(self, commit):
+        """Отмечает резерв подтвержденным или возвращенным. False, если он уже завершен"""
+        with self.lock:
+            if self.committed or self.released:
+                return False
+            if commit:
+                self.committed = True
+            else:
+                self.released = True
+            return True
 
-def can_analyze(user_id='default'):
+def reserve_quota(user_id, ip_address):
+    """Атомарно списывает один анализ у пользователя (и токен IP, если для тарифа есть правило).
+    Возвращает QuotaReservation или None, если лимит исчерпан"""
     user = get_user(user_id)
+    limit = PLANS[user['plan']]['daily_limit']
+    today = today_number()
     
-    # Дополнительная проверка (на всякий случай)
-    if user['plan'] != 'free' and user.get('plan_expires'):
-        if user['plan_expires'] < date.today().isoformat():
-            user['plan'] = 'free'
-            user['plan_expires'] = None
-            save_users()
-    
-    # ПРОВЕРКА ПО IP - ТОЛЬКО ДЛЯ БЕСПЛАТНЫХ
-    if user['plan'] == 'free':
-        real_ip = get_client_ip()  # Используем исправленную функцию
-        print(f"🔍 Проверка IP лимита для {real_ip}")
-        if not can_analyze_by_ip(real_ip):  # Передаем правильный IP
-            print(f"🚫 IP {real_ip} превысил лимит")
-            return False
+    # ПРОВЕРКА ПО IP - ПО ПРАВИЛАМ ТАРИФА (по умолчанию только бесплатный)
+    ip_rule = get_ip_rule(user['plan'])
+    ip_key = None
+    if ip_rule is not None and ip_address not in LOCAL_IPS:
+        ip_key = f"{user['plan']}|{ip_address}"
+        print(f"🔍 Проверка IP лимита для {ip_address}")
+        if not state.try_acquire_ip(ip_key, *ip_rule):
+            print(f"🚫 IP {ip_address} превысил лимит")
+            return None
     
-    can_user_analyze = user['used_today'] < PLANS[user['plan']]['daily_limit']
-    print(f"🔍 Результат проверки: {can_user_analyze} (использовано {user['used_today']} из {PLANS[user['plan']]['daily_limit']})")
-    return can_user_analyze
-def record_usage(user_id='default'):
-    """Записывает использование для пользователя и IP"""
-    user = get_user(user_id)
-    user['used_today'] += 1
-    user['total_used'] += 1
-    
-    # 🔽 ИСПРАВЛЕННАЯ ЗАПИСЬ ДЛЯ IP 🔽
-    if user['plan'] == 'free':
-        real_ip = get_client_ip()  # Используем правильный IP
-        
-        if real_ip not in ip_limits:
-            ip_limits[real_ip] = {
-                'used_today': 0,
-                'last_reset': date.today().isoformat(),
-                'first_seen': datetime.now().isoformat()
-            }
+    used_today = state.reserve_usage(user_id, today, limit)
+    if used_today is None:
+        print(f"🔍 Лимит исчерпан: использовано {user['used_today']} из {limit}")
+        if ip_key:
+            state.refund_ip(ip_key, *ip_rule)
+        return None
+    
+    print(f"🎫 Зарезервирован анализ для {user_id}: {used_today}/{limit}")
+    return QuotaReservation(user_id, ip_key, ip_rule, today)
+
+def commit_quota(reservation):
+    """Подтверждает зарезервированный анализ"""
+    if not reservation.finish(commit=True):
+        return
+    user = state.commit_usage(reservation.user_id)
+    print(f"📊 Записан анализ для {reservation.user_id}. Сегодня: {user['used_today']}, Всего: {user['total_used']}")
+
+def release_quota(reservation):
+    """Возвращает зарезервированный анализ, если он не был подтвержден"""
+    if not reservation.finish(commit=False):
+        return
+    
+    # После смены дня счетчики уже сброшены - возвращать нечего
+    state.refund_usage(reservation.user_id, reservation.day)
+    if reservation.ip_key:
+        state.refund_ip(reservation.ip_key, *reservation.ip_rule)
+    print(f"↩️ Возвращен зарезервированный анализ для {reservation.user_id}")
+
+# Кэш результатов по содержимому: память (LRU) + диск, оба ограничены по размеру.
+# Значения хранятся как JSON, поэтому каждый get возвращает независимую копию
+CACHE_DIR = os.getenv('DOCSCAN_CACHE_DIR', '/tmp/docscan_cache')
+CACHE_MEMORY_MB = int(os.getenv('CACHE_MEMORY_MB', 64))
+CACHE_DISK_MB = int(os.getenv('CACHE_DISK_MB', 512))  # 0 - без дискового уровня
+
+class TieredCache:
+    """Двухуровневый LRU-кэш: горячие записи в памяти, вытесненные - на диске"""
+    
+    def __init__(self, name, memory_bytes=CACHE_MEMORY_MB * 1024 * 1024,
+                 disk_bytes=CACHE_DISK_MB * 1024 * 1024, cache_dir=CACHE_DIR):
+        self.name = name
+        self.memory_limit = memory_bytes
+        self.disk_limit = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # ключ -> JSON (bytes)
+        self.memory_size = 0
+        self.disk = OrderedDict()  # ключ -> размер файла, от давних к свежим
+        self.disk_size = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.dir = os.path.join(cache_dir, name) if disk_bytes else None
+        if self.dir:
+            self.load_disk_index()
+    
+    def load_disk_index(self):
+        """Восстанавливает индекс дискового уровня по файлам, в порядке последнего доступа"""
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.dir):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+            for _, key, size in sorted(entries):
+                self.disk[key] = size
+                self.disk_size += size
+            if entries:
+                print(f"🗄️ Кэш {self.name}: на диске {len(entries)} записей")
+        except Exception as e:
+            print(f"❌ Ошибка чтения дискового кэша {self.name}: {e}")
+            self.dir = None
+    
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256('\x00'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                # Горячая запись не должна первой терять копию на диске
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                self.hits_memory += 1
+                return json.loads(data)
+            on_disk = key in self.disk
         
-        # Сбрасываем лимит IP если новый день
-        if ip_limits[real_ip]['last_reset'] < date.today().isoformat():
-            ip_limits[real_ip]['used_today'] = 0
-            ip_limits[real_ip]['last_reset'] = date.today().isoformat()
+        if on_disk:
+            try:
+                path = os.path.join(self.dir, key)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+                with self.lock:
+                    if key in self.disk:
+                        self.disk.move_to_end(key)
+                    self.hits_disk += 1
+                    self.put_memory(key, data)
+                return json.loads(data)
+            except Exception as e:
+                print(f"❌ Ошибка чтения кэша {self.name}: {e}")
         
-        ip_limits[real_ip]['used_today'] += 1
-        save_ip_limits()
-        print(f"📡 Записано использование для IP {real_ip}: {ip_limits[real_ip]['used_today']}/1")
+        with self.lock:
+            self.misses += 1
+        return None
     
-    save_users()
-    print(f"📊 Записан анализ для {user_id}. Сегодня: {user['used_today']}, Всего: {user['total_used']}")
+    def put(self, key, value):
+        data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        with self.lock:
+            self.put_memory(key, data)
+        if self.dir and len(data) <= self.disk_limit:
+            self.put_disk(key, data)
+    
+    def put_memory(self, key, data):
+        """Вызывается под self.lock"""
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_size -= len(old)
+        if len(data) > self.memory_limit:
+            return
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_limit:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+    
+    def put_disk(self, key, data):
+        path = os.path.join(self.dir, key)
+        try:
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f"❌ Ошибка записи кэша {self.name}: {e}")
+            return
+        
+        evicted = []
+        with self.lock:
+            self.disk_size -= self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+            self.disk_size += len(data)
+            while self.disk_size > self.disk_limit:
+                old_key, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.unlink(os.path.join(self.dir, old_key))
+            except OSError:
+                pass
+    
+    def stats(self):
+        with self.lock:
+            hits = self.hits_memory + self.hits_disk
+            total = hits + self.misses
+            return {
+                'memory_items': len(self.memory),
+                'memory_bytes': self.memory_size,
+                'disk_items': len(self.disk),
+                'disk_bytes': self.disk_size,
+                'hits_memory': self.hits_memory,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+                'hit_rate': round(hits / total, 3) if total else 0.0
+            }
+
+# Текст, извлеченный из файла (включая OCR), - по sha256 загруженных байт
+text_cache = TieredCache('text')
+# Итоговый анализ - по нормализованному тексту, типу документа и версии промпта
+analysis_cache = TieredCache('analysis')
+
+# Почти-дубликаты: один и тот же шаблон договора с другими именами, датами и суммами.
+# MinHash по шинглам из слов + LSH по полосам сигнатуры находят документ того же типа,
+# похожий не меньше чем на порог. Его анализ берется, только если тексты отличаются
+# короткими заменами слов и чисел: замены переносятся в анализ (см. patch_analysis)
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.9))  # 0 - выключено
+NEAR_DUPLICATE_MAX_DOCS = int(os.getenv('NEAR_DUPLICATE_MAX_DOCS', 10000))
+NEAR_DUPLICATE_MAX_EDIT = int(os.getenv('NEAR_DUPLICATE_MAX_EDIT', 4))  # слов в одной замене
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 32  # по 4 значения в полосе: кандидаты от ~0.4 схожести
+MINHASH_SHINGLE = 5  # слов в шингле
+MINHASH_PRIME = np.uint64((1 << 61) - 1)
+# Фиксированное зерно: сигнатуры одного текста совпадают между перезапусками
+minhash_random = np.random.RandomState(20240501)
+MINHASH_A = minhash_random.randint(1, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = minhash_random.randint(0, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+# Слова и числа целиком: дата "01.02.2026" и сумма "50000.00" - один токен
+PATCH_TOKEN = re.compile(r'\d+(?:[.,/-]\d+)*|\w+')
+
+def minhash_signature(text):
+    """MinHash-сигнатура текста (numpy-массив) или None, если текст слишком короткий.
+    Числа остаются в шинглах: договоры с разными суммами и датами - разные документы"""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < MINHASH_SHINGLE:
+        return None
+    tokens = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in words), dtype=np.uint64, count=len(words))
+    
+    # Хэши всех шинглов разом: полиномиальная свертка соседних слов по модулю 2^32
+    count = len(tokens) - MINHASH_SHINGLE + 1
+    shingles = np.zeros(count, dtype=np.uint64)
+    for offset in range(MINHASH_SHINGLE):
+        shingles = (shingles * np.uint64(1000003) + tokens[offset:offset + count]) & np.uint64(0xFFFFFFFF)
+    shingles = np.unique(shingles)
+    
+    # Все перестановки для всех шинглов одной матрицей: (a * x + b) mod p, минимум по шинглам
+    return ((np.outer(shingles, MINHASH_A) + MINHASH_B) % MINHASH_PRIME).min(axis=0)
+
+def document_patch(source, text):
+    """Замены токенов, превращающие source в text: {старый токен: новый}. None, если
+    документы отличаются не только заменами слово в слово (вставка или удаление -
+    уже другой договор) или один токен заменен в разных местах по-разному"""
+    old = PATCH_TOKEN.findall(source)
+    new = PATCH_TOKEN.findall(text)
+    replacements = {}
+    for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if op == 'equal':
+            continue
+        if op != 'replace' or i2 - i1 != j2 - j1 or i2 - i1 > NEAR_DUPLICATE_MAX_EDIT:
+            return None
+        for before, after in zip(old[i1:i2], new[j1:j2]):
+            if replacements.setdefault(before, after) != after:
+                return None
+    return replacements
+
+def token_pattern(token):
+    """Вхождение токена в текст анализа: целиком, в числах допускаются пробелы между разрядами"""
+    pattern = ''
+    for char, following in zip(token, token[1:] + ' '):
+        pattern += re.escape(char)
+        if char.isdigit() and following.isdigit():
+            pattern += '[ \u00a0]?'
+    return re.compile(r'(?<!\w)(?<!\d[.,/-])' + pattern + r'(?!\w|[.,/-]\d)')
+
+def stem_pattern(token):
+    """Любая форма слова (Иванов, Иванову, Ивановым) без учета регистра"""
+    return re.compile(r'(?<!\w)' + re.escape(token[:max(3, len(token) - 2)]), re.IGNORECASE)
+
+def map_strings(value, func):
+    """Применяет func ко всем строкам вложенных словарей и списков"""
+    if isinstance(value, str):
+        return func(value)
+    if isinstance(value, dict):
+        return {key: map_strings(item, func) for key, item in value.items()}
+    if isinstance(value, list):
+        return [map_strings(item, func) for item in value]
+    return value
+
+def patch_analysis(result, source, text):
+    """Анализ документа source, переписанный под text, или None, если переписать
+    его надежно нельзя. Старые имена и числа заменяются новыми; если после замены
+    в анализе осталась другая форма старого слова или в нем упомянут токен, который
+    в text заменен только местами, анализ не переиспользуется"""
+    replacements = document_patch(source, text)
+    if replacements is None:
+        return None
+    remaining = set(PATCH_TOKEN.findall(text))
+    strings = []
+    map_strings(result, strings.append)
+    analysis_text = '\n'.join(strings)
+    
+    patterns = []
+    for before, after in replacements.items():
+        pattern = token_pattern(before)
+        if before in remaining:
+            # Токен остался в документе и в другом месте - не понять, какое вхождение в анализе имелось в виду
+            if pattern.search(analysis_text):
+                return None
+            continue
+        patterns.append((pattern, after))
+    
+    def patch(string):
+        for pattern, after in patterns:
+            string = pattern.sub(lambda match: after, string)
+        return string
+    patched = map_strings(result, patch)
+    
+    strings = []
+    map_strings(patched, strings.append)
+    patched_text = '\n'.join(strings)
+    for before in replacements:
+        # Числа заменены полностью, а слово могло остаться в другом падеже
+        if before not in remaining and not before[0].isdigit() and stem_pattern(before).search(patched_text):
+            return None
+    return patched
+
+class NearDuplicateIndex:
+    """LSH-индекс MinHash-сигнатур проанализированных документов.
+    Хранит ключ анализа в analysis_cache; самые старые документы вытесняются.
+    kind - вид анализа (тип документа и потолок ответа тарифа), похожие ищутся только среди такого же"""
+    
+    def __init__(self, max_docs=NEAR_DUPLICATE_MAX_DOCS, bands=MINHASH_BANDS):
+        self.max_docs = max_docs
+        self.bands = bands
+        self.rows = MINHASH_PERMUTATIONS // bands
+        self.lock = threading.Lock()
+        self.docs = OrderedDict()  # ключ анализа -> (вид анализа, сигнатура)
+        self.buckets = {}  # (вид, номер полосы, значения полосы) -> ключи анализов
+        self.lookups = 0
+        self.hits = 0
+    
+    def band_keys(self, kind, signature):
+        for band in range(self.bands):
+            yield kind, band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+    
+    def find(self, kind, signature):
+        """(ключ анализа, схожесть) лучшего документа выше порога или None"""
+        with self.lock:
+            self.lookups += 1
+            candidates = set()
+            for band_key in self.band_keys(kind, signature):
+                candidates.update(self.buckets.get(band_key, ()))
+            best = None
+            for key in candidates:
+                similarity = float(np.mean(self.docs[key][1] == signature))
+                if similarity >= NEAR_DUPLICATE_THRESHOLD and (best is None or similarity > best[1]):
+                    best = (key, similarity)
+            return best
+    
+    def record_hit(self):
+        with self.lock:
+            self.hits += 1
+    
+    def add(self, key, kind, signature):
+        with self.lock:
+            if key in self.docs:
+                return
+            self.docs[key] = (kind, signature)
+            for band_key in self.band_keys(kind, signature):
+                self.buckets.setdefault(band_key, set()).add(key)
+            while len(self.docs) > self.max_docs:
+                self.remove(*self.docs.popitem(last=False))
+    
+    def remove(self, key, doc):
+        """Вызывается под self.lock"""
+        for band_key in self.band_keys(*doc):
+            bucket = self.buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[band_key]
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'documents': len(self.docs),
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+                'threshold': NEAR_DUPLICATE_THRESHOLD
+            }
+
+near_duplicates = NearDuplicateIndex()
+
 # Функции анализа документов
-def extract_text_from_pdf(file_path):
-    text = ""
+# В модель уходит не больше ANALYSIS_CHAR_LIMIT символов текста,
+# поэтому извлечение останавливается, как только бюджет набран
+ANALYSIS_CHAR_LIMIT = int(os.getenv('ANALYSIS_CHAR_LIMIT', 15000))
+
+def iter_pdf_pages(reader):
+    """Лениво отдает текст страниц PDF по одной"""
+    for page in reader.pages:
+        yield (page.extract_text() or "") + "\n"
+
+def take_chunks(chunks, max_chars):
+    """Набирает куски из генератора, пока в них не наберется max_chars символов.
+    Возвращает список прочитанных кусков; остальные куски не извлекаются"""
+    parts = []
+    size = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size >= max_chars:
+            break
+    return parts
+
+def take_text(chunks, max_chars):
+    """Как take_chunks, но возвращает (текст, число прочитанных кусков)"""
+    parts = take_chunks(chunks, max_chars)
+    return ''.join(parts)[:max_chars], len(parts)
+
+# Разбор PDF и DOCX идет не в процессе сервера, а в заранее запущенных воркерах
+# с уже импортированными библиотеками. У задачи есть лимит времени, у воркера -
+# лимиты памяти (RLIMIT_AS) и процессорного времени на задачу (RLIMIT_CPU).
+# Воркер, нарушивший лимит, убивается и заменяется новым.
+# Воркеров форкает однопоточный шаблонный процесс, а не сервер: форк из многопоточного
+# процесса может унести в потомка блокировки, захваченные другими потоками.
+# spawn/forkserver не подходят - сервер запускается как __main__ и каждый воркер
+# заново выполнял бы весь модуль
+EXTRACTOR_WORKERS = int(os.getenv('EXTRACTOR_WORKERS', max(2, os.cpu_count() or 1)))
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', 30))  # секунд на задачу
+EXTRACT_CPU_LIMIT = int(os.getenv('EXTRACT_CPU_LIMIT', 20))  # секунд процессора на задачу
+EXTRACT_MEMORY_LIMIT_MB = int(os.getenv('EXTRACT_MEMORY_LIMIT_MB', 1024))
+EXTRACTOR_PARENT_CHECK_INTERVAL = 1.0  # секунд между проверками, жив ли сервер
+
+class ExtractionError(Exception):
+    """Разбор файла прерван лимитами песочницы"""
+
+def process_vm_size():
+    """Размер адресного пространства текущего процесса в байтах, 0 - если /proc недоступен"""
     try:
-        with open(file_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def extractor_worker(conn, memory_limit_mb, cpu_limit):
+    """Цикл воркера: получает (имя функции, аргументы, есть ли содержимое файла),
+    содержимое - следующим сообщением без pickle. Возвращает (статус, результат)"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_limit_mb:
+        # RLIMIT_AS считает все адресное пространство, включая унаследованное от сервера
+        # (библиотеки, стеки потоков) - бюджет задачи отсчитывается от размера на старте
+        limit = process_vm_size() + memory_limit_mb * 1024 * 1024
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    while True:
+        try:
+            name, args, has_payload = conn.recv()
+            if has_payload:
+                args = (conn.recv_bytes(),) + args
+        except EOFError:
+            return
+        
+        # RLIMIT_CPU считает время всего процесса - сдвигаем порог перед каждой задачей
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = int(usage.ru_utime + usage.ru_stime) + cpu_limit
+        resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+        
+        try:
+            conn.send(('ok', EXTRACTORS[name](*args)))
+        except MemoryError:
+            # После нехватки памяти процесс лучше не переиспользовать
+            conn.send(('memory', None))
+            return
+        except ExtractionError as e:
+            # Файл отклонен проверками (например, zip-бомба) - воркер в порядке
+            conn.send(('rejected', str(e)))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+def extractor_template(control, server_control, memory_limit_mb, cpu_limit):
+    """Цикл шаблонного процесса: по команде ('start', None) форкает воркера и возвращает
+    его pid и дескриптор канала к нему, по ('wait', pid) - дожидается воркера
+    и возвращает код завершения (минус номер сигнала, как у multiprocessing).
+    server_control - конец канала на стороне сервера, унаследованный при форке"""
+    # Пока у шаблона открыт конец сервера, recv не получит EOF, даже если сервер умер
+    server_control.close()
+    server_pid = os.getppid()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        # Канал может остаться открытым и после смерти сервера (его конец унаследовал
+        # другой процесс) - тогда шаблон замечает, что его усыновил init, и выходит
+        if not control.poll(EXTRACTOR_PARENT_CHECK_INTERVAL):
+            if os.getppid() != server_pid:
+                return
+            continue
+        try:
+            command, pid = control.recv()
+        except EOFError:
+            return
+        
+        if command == 'start':
+            conn, child_conn = multiprocessing.Pipe()
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                control.close()
+                code = 0
+                try:
+                    extractor_worker(child_conn, memory_limit_mb, cpu_limit)
+                except BaseException:
+                    code = 1
+                os._exit(code)
+            child_conn.close()
+            control.send(pid)
+            reduction.send_handle(control, conn.fileno(), None)
+            conn.close()
+        elif command == 'wait':
+            _, status = os.waitpid(pid, 0)
+            control.send(-os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status))
+
+class ExtractorTemplate:
+    """Шаблонный процесс пула и канал к нему. Потоки пула обращаются к нему по очереди"""
+    
+    def __init__(self, context):
+        self.control, child_control = context.Pipe()
+        self.process = context.Process(target=extractor_template, name='extractor-template', daemon=True,
+                                       args=(child_control, self.control, EXTRACT_MEMORY_LIMIT_MB, EXTRACT_CPU_LIMIT))
+        self.process.start()
+        child_control.close()
+        self.lock = threading.Lock()
+    
+    def start_worker(self):
+        """Новый воркер: (pid, канал к нему)"""
+        with self.lock:
+            self.control.send(('start', None))
+            pid = self.control.recv()
+            return pid, Connection(reduction.recv_handle(self.control))
+    
+    def wait(self, pid):
+        with self.lock:
+            self.control.send(('wait', pid))
+            return self.control.recv()
+
+class ExtractorWorker:
+    """Процесс-воркер и канал к нему. Используется только своим потоком пула"""
+    
+    def __init__(self, template):
+        self.template = template
+        self.restarts = 0
+        self.start()
+    
+    def start(self):
+        self.pid, self.conn = self.template.start_worker()
+    
+    def stop(self):
+        """Убивает воркера, если он еще жив, и возвращает код его завершения"""
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.conn.close()
+        exitcode = self.template.wait(self.pid)
+        self.pid = None
+        return exitcode
+    
+    def restart(self, reason):
+        if self.pid is not None:
+            self.stop()
+        self.restarts += 1
+        print(f"💀 Воркер извлечения заменен: {reason}")
+        self.start()
+    
+    def run(self, name, args, payload, timeout):
+        # Между задачами воркер ничего не пишет - данные в канале означают его EOF
+        if self.conn.poll():
+            self.restart("процесс завершился")
+        self.conn.send((name, args, payload is not None))
+        if payload is not None:
+            # send_bytes пишет буфер (memoryview, mmap) в канал без промежуточной копии
+            self.conn.send_bytes(payload)
+        if not self.conn.poll(timeout):
+            error = f"превышено время обработки ({timeout:g} с)"
+            self.restart(error)
+            raise ExtractionError(error)
+        try:
+            status, result = self.conn.recv()
+        except EOFError:
+            exitcode = self.stop()
+            if exitcode == -signal.SIGXCPU:
+                error = "превышен лимит процессорного времени"
+            else:
+                error = f"обработчик файла аварийно завершился (код {exitcode})"
+            self.restart(error)
+            raise ExtractionError(error)
+        if status == 'memory':
+            self.restart("превышен лимит памяти")
+            raise ExtractionError("превышен лимит памяти")
+        if status == 'rejected':
+            raise ExtractionError(result)
+        if status == 'error':
+            raise RuntimeError(result)
+        return result
+
+class ExtractorPool:
+    """Пул воркеров-песочниц: задачи из общей очереди, у каждого воркера свой поток-диспетчер"""
+    
+    def __init__(self, workers=EXTRACTOR_WORKERS, timeout=EXTRACT_TIMEOUT):
+        self.timeout = timeout
+        self.jobs = queue.Queue()
+        self.workers = []
+        # fork: шаблон и воркеры получают уже импортированные PyPDF2 и Pillow и не поднимают
+        # состояние сервера. Из сервера форкается только шаблон, воркеры и их замены - из шаблона
+        self.template = ExtractorTemplate(multiprocessing.get_context('fork'))
+        for i in range(workers):
+            worker = ExtractorWorker(self.template)
+            self.workers.append(worker)
+            threading.Thread(target=self.dispatch, args=(worker,), name=f'extractor-{i}', daemon=True).start()
+        print(f"⚙️ Пул извлечения текста: {workers} процессов, лимиты {timeout:g} с / "
+              f"{EXTRACT_CPU_LIMIT} с CPU / {EXTRACT_MEMORY_LIMIT_MB} МБ")
+    
+    def dispatch(self, worker):
+        while True:
+            future, name, args, payload = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(worker.run(name, args, payload, self.timeout))
+            except Exception as e:
+                future.set_exception(e)
+    
+    @property
+    def restarts(self):
+        return sum(worker.restarts for worker in self.workers)
+    
+    def submit(self, name, *args, payload=None):
+        """Ставит задачу EXTRACTORS[name]. Если передан payload (байты файла),
+        функция получит его первым аргументом"""
+        future = Future()
+        self.jobs.put((future, name, args, payload))
+        return future
+    
+    def run(self, name, *args, payload=None):
+        return self.submit(name, *args, payload=payload).result()
+
+def open_source(source):
+    """Файловый объект для чтения: путь открывается через mmap, байты - через BytesIO"""
+    if isinstance(source, str):
+        with open(source, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return io.BytesIO()
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return io.BytesIO(source)
+
+def submit_source(name, source, *args):
+    """Задача по файлу: путь уходит аргументом, содержимое в памяти - отдельным сообщением"""
+    if isinstance(source, str):
+        return extractor_pool.submit(name, source, *args)
+    return extractor_pool.submit(name, *args, payload=source)
+
+# Большие PDF разбираются параллельно: диапазоны страниц раздаются воркерам пула,
+# каждый открывает файл своим PdfReader. Маленькие - одной задачей
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', os.cpu_count() or 1))
+PDF_PARALLEL_MIN_BYTES = int(os.getenv('PDF_PARALLEL_MIN_BYTES', 1024 * 1024))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 8))
+
+# Страницы без текстового слоя (сканы) распознаются через Vision, если тариф это позволяет.
+# В OCR уходят только картинки таких страниц, мелкие картинки (логотипы, печати) пропускаются
+PDF_OCR_MIN_CHARS = int(os.getenv('PDF_OCR_MIN_CHARS', 20))
+PDF_OCR_MAX_PAGES = int(os.getenv('PDF_OCR_MAX_PAGES', 20))
+PDF_OCR_MIN_IMAGE_SIDE = int(os.getenv('PDF_OCR_MIN_IMAGE_SIDE', 300))
+
+# Открытый PdfReader воркера: следующие диапазоны того же файла не разбирают
+# дерево страниц заново. Глобальный - у каждого процесса пула свой
+worker_pdf = None  # (ключ файла, reader)
+
+def worker_pdf_reader(source, key):
+    global worker_pdf
+    if worker_pdf is None or worker_pdf[0] != key:
+        worker_pdf = None
+        worker_pdf = (key, PyPDF2.PdfReader(open_source(source)))
+    return worker_pdf[1]
+
+def extract_pdf_page_range(source, key, start, stop):
+    """Выполняется в воркере: текст страниц [start, stop)"""
+    reader = worker_pdf_reader(source, key)
+    return [(reader.pages[i].extract_text() or "") + "\n" for i in range(start, stop)]
+
+def extract_pdf_page_images(source, key, indexes, max_side, quality, grayscale):
+    """Выполняется в воркере: встроенные картинки страниц indexes, пережатые в JPEG
+    с учетом поворота страницы. Возвращает список (номер страницы, JPEG-байты)"""
+    reader = worker_pdf_reader(source, key)
+    images = []
+    for index in indexes:
+        page = reader.pages[index]
+        try:
+            files = page.images
+        except Exception as e:
+            print(f"⚠️ Не удалось достать картинки страницы {index + 1}: {e}")
+            continue
+        rotation = page.get('/Rotate', 0) or 0
+        for file in files:
+            try:
+                image = Image.open(io.BytesIO(file.data))
+            except Exception:
+                continue
+            if min(image.size) < PDF_OCR_MIN_IMAGE_SIDE:
+                continue
+            if rotation:
+                image = image.rotate(-rotation, expand=True)
+            images.append((index, compress_image(image, max_side, quality, grayscale)[0]))
+    return images
+
+def count_pdf_pages(source):
+    """Выполняется в воркере"""
+    return len(PyPDF2.PdfReader(open_source(source)).pages)
+
+def read_pdf_text(source, max_chars):
+    """Выполняется в воркере: (тексты прочитанных страниц, всего страниц)"""
+    reader = PyPDF2.PdfReader(open_source(source))
+    return take_chunks(iter_pdf_pages(reader), max_chars), len(reader.pages)
+
+def iter_pdf_pages_parallel(source, key, total):
+    """Отдает текст страниц по порядку. В работе не больше 2 * PDF_WORKERS диапазонов,
+    так что при остановке по бюджету дальние страницы не разбираются"""
+    ranges = iter([(start, min(start + PDF_PAGES_PER_TASK, total))
+                   for start in range(0, total, PDF_PAGES_PER_TASK)])
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < 2 * PDF_WORKERS:
+                page_range = next(ranges, None)
+                if page_range is None:
+                    break
+                pending.append(submit_source('pdf_pages', source, key, *page_range))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def source_size(source):
+    return os.path.getsize(source) if isinstance(source, str) else len(source)
+
+def spool_source(source):
+    """Пишет содержимое во временный файл и возвращает путь; удаляет файл вызывающий.
+    Задачи по пути открывают файл через mmap, а не получают по копии содержимого"""
+    with tempfile.NamedTemporaryFile(prefix='docscan_', suffix='.pdf', delete=False) as file:
+        file.write(source)
+    return file.name
+
+def ocr_pdf_pages(source, key, pages, indexes, tier):
+    """Распознает страницы без текстового слоя: картинки страниц достаются в пуле,
+    распознаются пачками через Vision и подставляются на место пустых страниц в pages.
+    Возвращает число распознанных страниц"""
+    config = IMAGE_QUALITY_TIERS.get(tier) or TIFF_ORIGINAL_CONFIG
+    futures = [submit_source('pdf_images', source, key, indexes[start:start + PDF_PAGES_PER_TASK],
+                             config['max_side'], config['quality'], config['grayscale'])
+               for start in range(0, len(indexes), PDF_PAGES_PER_TASK)]
+    images = [image for future in futures for image in future.result()]
+    if not images:
+        return 0
+    
+    recognized = {}
+    for (index, _), text in zip(images, recognize_pages([jpeg for _, jpeg in images])):
+        if text:
+            recognized.setdefault(index, []).append(text)
+    for index, texts in recognized.items():
+        pages[index] = '\n'.join(texts) + '\n'
+    return len(recognized)
+
+def extract_text_from_pdf(source, max_chars=ANALYSIS_CHAR_LIMIT, key=None, ocr_tier=None):
+    """source - путь к файлу или содержимое (bytes, memoryview, mmap).
+    key - идентификатор содержимого для кэша PdfReader в воркерах (по умолчанию sha256).
+    ocr_tier - уровень качества для OCR страниц-сканов, None - без OCR"""
+    spooled = None
+    try:
+        if key is None:
+            key = source if isinstance(source, str) else hashlib.sha256(source).hexdigest()
+        parallel = PDF_WORKERS > 1 and source_size(source) >= PDF_PARALLEL_MIN_BYTES
+        if parallel and not isinstance(source, str):
+            # Иначе каждая задача диапазона страниц получила бы файл целиком заново
+            source = spooled = spool_source(source)
+        if parallel:
+            total = submit_source('pdf_count', source).result()
+            parallel = total > PDF_PAGES_PER_TASK
+        if parallel:
+            page_texts = iter_pdf_pages_parallel(source, key, total)
+            pages = take_chunks(page_texts, max_chars)
+            page_texts.close()
+        else:
+            pages, total = submit_source('pdf', source, max_chars).result()
+        mode = f"параллельно, до {PDF_WORKERS} задач" if parallel else "одной задачей"
+        print(f"📄 PDF ({mode}): прочитано страниц {len(pages)} из {total}, пропущено {total - len(pages)}")
+        
+        # Сканы без текстового слоя: OCR только для них, остальные страницы остаются как есть
+        empty = [index for index, page in enumerate(pages) if len(page.strip()) < PDF_OCR_MIN_CHARS]
+        if empty:
+            print(f"🔎 PDF: страниц без текстового слоя {len(empty)}" + ("" if ocr_tier else ", OCR недоступен по тарифу"))
+        if empty and ocr_tier:
+            try:
+                if len(empty[:PDF_OCR_MAX_PAGES]) > PDF_PAGES_PER_TASK and not isinstance(source, str):
+                    source = spooled = spool_source(source)
+                started = time.perf_counter()
+                recognized = ocr_pdf_pages(source, key, pages, empty[:PDF_OCR_MAX_PAGES], ocr_tier)
+                print(f"🖼️ PDF: распознано страниц-сканов {recognized} из {len(empty)} "
+                      f"за {(time.perf_counter() - started) * 1000:.0f} мс")
+            except ExtractionError:
+                raise
+            except Exception as e:
+                print(f"⚠️ OCR страниц PDF не удался, остается текстовый слой: {e}")
+        text = ''.join(pages)[:max_chars]
+    except ExtractionError:
+        raise
     except Exception as e:
         return f"Ошибка чтения PDF: {str(e)}"
+    finally:
+        if spooled:
+            os.unlink(spooled)
+    return text
+
+# DOCX читается напрямую: zip + потоковый разбор XML частей документа.
+# Порядок частей - основной текст (с таблицами), сноски, колонтитулы
+DOCX_MAX_PART_BYTES = int(os.getenv('DOCX_MAX_PART_BYTES', 64 * 1024 * 1024))  # распакованный размер части
+DOCX_MAX_RATIO = int(os.getenv('DOCX_MAX_RATIO', 200))  # допустимая степень сжатия
+DOCX_MAX_ENTRIES = int(os.getenv('DOCX_MAX_ENTRIES', 10000))
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DOCX_BLOCKS = (WORD_NS + 'p', WORD_NS + 'tbl')
+
+class BoundedReader:
+    """Обертка над потоком из zip: не дает распаковать больше limit байт,
+    даже если размер в заголовке архива подделан"""
+    
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.read_bytes = 0
+    
+    def read(self, size=-1):
+        data = self.stream.read(size if size >= 0 else self.limit + 1)
+        self.read_bytes += len(data)
+        if self.read_bytes > self.limit:
+            raise ExtractionError("файл DOCX распаковывается в слишком большой объем")
+        return data
+
+def docx_parts(archive):
+    """Имена XML частей с текстом в порядке чтения, с проверкой на zip-бомбу"""
+    entries = archive.infolist()
+    if len(entries) > DOCX_MAX_ENTRIES:
+        raise ExtractionError("в архиве DOCX слишком много файлов")
+    for info in entries:
+        if info.file_size > DOCX_MAX_PART_BYTES or info.file_size > max(info.compress_size, 1) * DOCX_MAX_RATIO:
+            raise ExtractionError("файл DOCX похож на zip-бомбу")
+    names = {info.filename for info in entries}
+    if 'word/document.xml' not in names:
+        raise ValueError("в архиве нет word/document.xml")
+    order = ('footnotes', 'endnotes', 'header', 'footer')
+    extra = []
+    for name in names:
+        match = re.match(r'word/(footnotes|endnotes|header|footer)(\d*)\.xml$', name)
+        if match:
+            extra.append((order.index(match.group(1)), int(match.group(2) or 0), name))
+    return ['word/document.xml'] + [name for _, _, name in sorted(extra)]
+
+def iter_docx_blocks(stream):
+    """Отдает текст абзацев и строк таблиц одной XML части по мере разбора.
+    Разобранные блоки удаляются из дерева, память не растет с размером документа"""
+    path = []  # открытые элементы
+    parts = []  # текст текущего абзаца
+    rows = []  # открытые строки таблиц (вложенные таблицы - глубже), строка - список ячеек
+    depth = 0  # вложенность абзацев и таблиц
+    for event, elem in ElementTree.iterparse(stream, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            path.append(elem)
+            if tag in DOCX_BLOCKS:
+                depth += 1
+            elif tag == WORD_NS + 'tr':
+                rows.append([])
+            elif tag == WORD_NS + 'tc' and rows:
+                rows[-1].append([])
+            continue
+        
+        path.pop()
+        line = None
+        if tag == WORD_NS + 't':
+            parts.append(elem.text or '')
+        elif tag == WORD_NS + 'tab':
+            parts.append('\t')
+        elif tag in (WORD_NS + 'br', WORD_NS + 'cr'):
+            parts.append('\n')
+        elif tag == WORD_NS + 'p':
+            line = ''.join(parts).strip()
+            parts = []
+        elif tag == WORD_NS + 'tr' and rows:
+            line = ' | '.join(' '.join(cell) for cell in rows.pop() if cell)
+        
+        if line:
+            # Внутри таблицы текст копится в ячейке, строка отдается целиком
+            if rows and rows[-1]:
+                rows[-1][-1].append(line)
+            else:
+                yield line + '\n'
+        
+        if tag in DOCX_BLOCKS:
+            depth -= 1
+            if depth == 0 and path:
+                path[-1].clear()
+
+def read_docx_text(source, max_chars):
+    """Выполняется в воркере"""
+    def blocks():
+        # zipfile нужен seekable(), которого у mmap до Python 3.13 нет - файл открывается обычным образом
+        file = open(source, 'rb') if isinstance(source, str) else io.BytesIO(source)
+        with file, zipfile.ZipFile(file) as archive:
+            for name in docx_parts(archive):
+                with archive.open(name) as part:
+                    yield from iter_docx_blocks(BoundedReader(part, DOCX_MAX_PART_BYTES))
+    text, _ = take_text(blocks(), max_chars)
     return text
 
-def extract_text_from_docx(file_path):
-    text = ""
+def extract_text_from_docx(source, max_chars=ANALYSIS_CHAR_LIMIT):
+    """source - путь к файлу или содержимое (bytes, memoryview, mmap)"""
     try:
-        doc = docx.Document(file_path)
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
+        return submit_source('docx', source, max_chars).result()
+    except ExtractionError:
+        raise
     except Exception as e:
         return f"Ошибка чтения DOCX: {str(e)}"
-    return text
 
-def extract_text_from_image(file_path):
-    """Извлекает текст с фото через Yandex Vision API"""
+# TXT декодируется в процессе сервера по кускам: кодировка угадывается по началу файла
+# (BOM, UTF-16 без BOM, UTF-8, иначе cp1251 или koi8-r), чтение останавливается на бюджете
+TEXT_SNIFF_BYTES = 64 * 1024
+TEXT_CHUNK_BYTES = 64 * 1024
+TEXT_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),  # раньше UTF-16: начинается с тех же FF FE
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# Самые частые буквы русского текста - около двух третей всех букв
+RUSSIAN_FREQUENT_LETTERS = 'оеаинтсрвл'
+
+def russian_letter_score(head, encoding):
+    """Сколько частых русских букв получится, если прочитать head в encoding.
+    Регистр не важен: в cp1251 и koi8-r строчные и заглавные лежат в разных половинах"""
+    text = head.decode(encoding, errors='ignore').lower()
+    return sum(text.count(letter) for letter in RUSSIAN_FREQUENT_LETTERS)
+
+def detect_text_encoding(head, complete=False):
+    """Кодировка по первым байтам файла. complete - head содержит файл целиком"""
+    for bom, encoding in TEXT_BOMS:
+        if head.startswith(bom):
+            return encoding
+    
+    # UTF-16 без BOM: старший байт латиницы - 00, кириллицы - 04
+    if len(head) >= 4:
+        even = len(head[0::2]) - len(head[0::2].translate(None, b'\x00\x04'))
+        odd = len(head[1::2]) - len(head[1::2].translate(None, b'\x00\x04'))
+        half = len(head) // 2
+        if odd > half * 0.6 and even < half * 0.1:
+            return 'utf-16-le'
+        if even > half * 0.6 and odd < half * 0.1:
+            return 'utf-16-be'
+    
     try:
-        print("🖼️ Начинаем распознавание фото...")
-        
-        # Кодируем изображение в base64
-        with open(file_path, 'rb') as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        headers = {
-            "Authorization": f"Api-Key {YANDEX_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=complete)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    
+    # В неверной кодировке буквы превращаются в другие, и частых среди них заметно меньше
+    cp1251 = russian_letter_score(head, 'cp1251')
+    koi8r = russian_letter_score(head, 'koi8-r')
+    return 'cp1251' if cp1251 >= koi8r else 'koi8-r'
+
+def extract_text_from_txt(data, max_chars=ANALYSIS_CHAR_LIMIT):
+    """data - содержимое (bytes, memoryview, mmap). Декодирует кусками по TEXT_CHUNK_BYTES
+    и останавливается, набрав max_chars символов - память не зависит от размера файла"""
+    head = bytes(data[:TEXT_SNIFF_BYTES])
+    encoding = detect_text_encoding(head, complete=len(data) <= TEXT_SNIFF_BYTES)
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    
+    def chunks():
+        for start in range(0, len(data), TEXT_CHUNK_BYTES):
+            yield decoder.decode(data[start:start + TEXT_CHUNK_BYTES])
+        yield decoder.decode(b'', final=True)
+    
+    text, read = take_text(chunks(), max_chars)
+    print(f"📝 TXT в кодировке {encoding}: прочитано {min(read * TEXT_CHUNK_BYTES, len(data))} из {len(data)} байт")
+    return text
+
+# Фото перед OCR готовится в воркере пула: поворот по EXIF, уменьшение до разрешения,
+# достаточного для распознавания, оттенки серого и пережатие в JPEG.
+# Уровни качества задаются настройкой, уровень выбирается по тарифу
+IMAGE_QUALITY_TIERS = json.loads(os.getenv('IMAGE_QUALITY_TIERS', json.dumps({
+    'economy': {'max_side': 1600, 'quality': 70, 'grayscale': True},
+    'standard': {'max_side': 2200, 'quality': 80, 'grayscale': True},
+    'high': {'max_side': 3000, 'quality': 88, 'grayscale': False},
+    'original': None,  # отправлять как есть
+})))
+IMAGE_TIER_BY_PLAN = json.loads(os.getenv('IMAGE_TIER_BY_PLAN', '{"premium": "high", "unlimited": "high"}'))
+IMAGE_DEFAULT_TIER = os.getenv('IMAGE_DEFAULT_TIER', 'standard')
+
+def image_tier(plan):
+    return IMAGE_TIER_BY_PLAN.get(plan, IMAGE_DEFAULT_TIER)
+
+def compress_image(image, max_side, quality, grayscale):
+    """Поворот по EXIF, уменьшение и пережатие в JPEG. Возвращает (JPEG-байты, итоговый размер)"""
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    image = image.convert('L' if grayscale else 'RGB')
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue(), image.size
+
+def prepare_image(data, max_side, quality, grayscale):
+    """Выполняется в воркере: (JPEG-байты, исходный размер в пикселях, итоговый)"""
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    # JPEG сразу декодируется в уменьшенном масштабе - быстрее и меньше памяти
+    image.draft('L' if grayscale else 'RGB', (max_side, max_side))
+    jpeg, size = compress_image(image, max_side, quality, grayscale)
+    return jpeg, original_size, size
+
+def prepare_image_pages(data, max_side, quality, grayscale, max_pages):
+    """Выполняется в воркере: страницы файла (многостраничный TIFF - по кадру на страницу)
+    в виде списка (JPEG-байты, исходный размер, итоговый)"""
+    image = Image.open(io.BytesIO(data))
+    frames = getattr(image, 'n_frames', 1)
+    if frames > max_pages:
+        raise ExtractionError(f"в файле {frames} страниц, допускается не больше {max_pages}")
+    if frames == 1:
+        return [prepare_image(data, max_side, quality, grayscale)]
+    pages = []
+    for frame in ImageSequence.Iterator(image):
+        jpeg, size = compress_image(frame, max_side, quality, grayscale)
+        pages.append((jpeg, frame.size, size))
+    return pages
+
+def is_tiff(data):
+    return bytes(data[:4]) in (b'II*\x00', b'MM\x00*')
+
+class Base64JsonBody:
+    """Тело JSON-запроса, в котором картинки кодируются в base64 кусками прямо при отправке.
+    Длина известна заранее, поэтому requests шлет Content-Length, а не chunked.
+    На место каждого PLACEHOLDER в payload по порядку подставляется очередной contents"""
+    
+    PLACEHOLDER = '@@CONTENT@@'
+    CHUNK = 3 * 64 * 1024  # кратно 3 - куски base64 склеиваются без '=' внутри
+    
+    def __init__(self, payload, *contents):
+        self.parts = [part.encode('utf-8') for part in json.dumps(payload).split(self.PLACEHOLDER)]
+        if len(self.parts) != len(contents) + 1:
+            raise ValueError(f"в payload {len(self.parts) - 1} мест для содержимого, передано {len(contents)}")
+        self.contents = contents
+    
+    def __len__(self):
+        return sum(len(part) for part in self.parts) + sum((len(content) + 2) // 3 * 4 for content in self.contents)
+    
+    def __iter__(self):
+        for part, content in zip(self.parts, self.contents):
+            yield part
+            for start in range(0, len(content), self.CHUNK):
+                yield base64.b64encode(content[start:start + self.CHUNK])
+        yield self.parts[-1]
+
+# Замеры OCR для админки: сколько байт пришло, сколько ушло в API и за сколько
+ocr_stats = {'requests': 0, 'pages': 0, 'original_bytes': 0, 'sent_bytes': 0, 'prepare_ms': 0.0, 'ocr_ms': 0.0}
+ocr_stats_lock = threading.Lock()
+
+def ocr_stats_summary():
+    with ocr_stats_lock:
+        stats = dict(ocr_stats)
+    count = stats['requests'] or 1
+    return {
+        'requests': stats['requests'],
+        'pages': stats['pages'],
+        'avg_pages_per_request': round(stats['pages'] / count, 1),
+        'avg_original_kb': round(stats['original_bytes'] / count / 1024, 1),
+        'avg_sent_kb': round(stats['sent_bytes'] / count / 1024, 1),
+        'avg_prepare_ms': round(stats['prepare_ms'] / count, 1),
+        'avg_ocr_ms': round(stats['ocr_ms'] / count, 1)
+    }
+
+# Запросы к API Яндекса идут через общие сессии: у каждого хоста свой пул keep-alive
+# соединений, так что DNS, TCP и TLS оплачиваются один раз, а не на каждый анализ.
+# Пулы прогреваются при старте, чтобы и первый анализ не ждал рукопожатия
+YANDEX_GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+VISION_URL = "https://vision.api.cloud.yandex.net/vision/v1/batchAnalyze"
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 16))  # соединений на хост
+UPSTREAM_PREWARM = os.getenv('UPSTREAM_PREWARM', '1') == '1'
+
+class UpstreamClient:
+    """requests.Session на каждый хост с пулом соединений и счетчиками для админки"""
+    
+    def __init__(self, pool_size=UPSTREAM_POOL_SIZE):
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+    
+    def session_for(self, host):
+        with self.lock:
+            http_session = self.sessions.get(host)
+            if http_session is None:
+                http_session = requests.Session()
+                # pool_block=False: при всплеске сверх пула лишнее соединение откроется и закроется
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+                http_session.mount('https://', adapter)
+                http_session.mount('http://', adapter)
+                self.sessions[host] = http_session
+                self.counters[host] = {'requests': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0, 'total_ms': 0.0}
+            return http_session
+    
+    def request(self, method, url, **kwargs):
+        host = urlsplit(url).netloc
+        http_session = self.session_for(host)
+        counters = self.counters[host]
+        with self.lock:
+            counters['in_flight'] += 1
+            counters['max_in_flight'] = max(counters['max_in_flight'], counters['in_flight'])
+        started = time.perf_counter()
+        try:
+            return http_session.request(method, url, **kwargs)
+        except Exception:
+            with self.lock:
+                counters['errors'] += 1
+            raise
+        finally:
+            with self.lock:
+                counters['in_flight'] -= 1
+                counters['requests'] += 1
+                counters['total_ms'] += (time.perf_counter() - started) * 1000
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def prewarm(self, *urls):
+        """Открывает по соединению к каждому хосту в фоне - они остаются в пуле"""
+        def warm(url):
+            try:
+                self.request('HEAD', url, timeout=10)
+                print(f"🔥 Соединение с {urlsplit(url).netloc} прогрето")
+            except Exception as e:
+                print(f"⚠️ Не удалось прогреть соединение с {urlsplit(url).netloc}: {e}")
+        for url in urls:
+            threading.Thread(target=warm, args=(url,), name='upstream-prewarm', daemon=True).start()
+    
+    def stats(self):
+        """Счетчики по хостам. Соединения берутся из пулов urllib3: reused - запросы,
+        которым не понадобилось новое соединение"""
+        with self.lock:
+            sessions = dict(self.sessions)
+            counters = {host: dict(values) for host, values in self.counters.items()}
+        result = {}
+        for host, http_session in sessions.items():
+            values = counters[host]
+            opened = served = idle = 0
+            pools = http_session.get_adapter(f'https://{host}').poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    served += pool.num_requests
+                    idle += pool.pool.qsize() if pool.pool else 0
+            result[host] = {
+                'requests': values['requests'],
+                'errors': values['errors'],
+                'in_flight': values['in_flight'],
+                'max_in_flight': values['max_in_flight'],
+                'avg_ms': round(values['total_ms'] / (values['requests'] or 1), 1),
+                'connections_opened': opened,
+                'connections_reused': max(served - opened, 0),
+                'pool_size': self.pool_size,
+            }
+        return result
+
+upstream = UpstreamClient()
+
+# Страницы уходят в Vision пачками: в одном batchAnalyze до VISION_BATCH_SIZE analyzeSpecs,
+# пачки отправляются параллельно. TIFF Vision не принимает - его кадры (как и картинки
+# сканов из PDF) пережимаются в JPEG даже на уровне original
+VISION_BATCH_SIZE = int(os.getenv('VISION_BATCH_SIZE', 8))
+VISION_BATCH_CONCURRENCY = int(os.getenv('VISION_BATCH_CONCURRENCY', 4))
+IMAGE_MAX_PAGES = int(os.getenv('IMAGE_MAX_PAGES', 20))
+TIFF_ORIGINAL_CONFIG = {'max_side': 10000, 'quality': 95, 'grayscale': False}
+
+vision_executor = ThreadPoolExecutor(max_workers=VISION_BATCH_CONCURRENCY, thread_name_prefix='vision')
+
+class VisionError(Exception):
+    """Vision API вернул ошибку или ответ без распознанного текста"""
+
+def recognize_batch(pages):
+    """Один запрос batchAnalyze на несколько страниц. Возвращает тексты страниц в том же порядке"""
+    headers = {
+        "Authorization": f"Api-Key {YANDEX_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    
+    spec = {
+        "content": Base64JsonBody.PLACEHOLDER,
+        "features": [{
+            "type": "TEXT_DETECTION",
+            "text_detection_config": {
+                "language_codes": ["ru", "en"],
+                "model": "page"
+            }
+        }]
+    }
+    data = {
+        "folderId": YANDEX_FOLDER_ID,
+        "analyzeSpecs": [spec] * len(pages)
+    }
+    
+    body = Base64JsonBody(data, *pages)
+    started = time.perf_counter()
+    response = upstream.post(VISION_URL, headers=headers, data=body, timeout=30 + 5 * len(pages))
+    ocr_ms = (time.perf_counter() - started) * 1000
+    print(f"📨 Vision API: {len(pages)} стр., отправлено {len(body) // 1024} КБ, ответ за {ocr_ms:.0f} мс")
+    with ocr_stats_lock:
+        ocr_stats['requests'] += 1
+        ocr_stats['pages'] += len(pages)
+        ocr_stats['sent_bytes'] += len(body)
+        ocr_stats['ocr_ms'] += ocr_ms
+    
+    if response.status_code != 200:
+        raise VisionError(f"Ошибка Vision API: {response.status_code} - {response.text}")
+    
+    results = response.json().get('results', [])
+    texts = []
+    for index in range(len(pages)):
+        page_results = results[index].get('results', []) if index < len(results) else []
+        if not page_results or 'textDetection' not in page_results[0]:
+            texts.append(None)
+            continue
         
-        data = {
-            "folderId": YANDEX_FOLDER_ID,
-            "analyzeSpecs": [{
-                "content": image_data,
-                 "features": [{
-                    "type": "TEXT_DETECTION",
-                    "text_detection_config": {
-                        "language_codes": ["ru", "en"],
-                        "model": "page"
-                    }
-                }]
-            }]
-        }
+        # Извлекаем весь распознанный текст страницы
+        text_blocks = []
+        for page in page_results[0]['textDetection']['pages']:
+            for block in page['blocks']:
+                for line in block['lines']:
+                    text_blocks.append(' '.join([word['text'] for word in line['words']]))
+        texts.append('\n'.join(text_blocks))
+    return texts
+
+def recognize_pages(pages):
+    """Распознает страницы пачками по VISION_BATCH_SIZE, пачки - параллельно.
+    Возвращает тексты в порядке страниц (None - для страницы нет textDetection)"""
+    batches = [pages[start:start + VISION_BATCH_SIZE] for start in range(0, len(pages), VISION_BATCH_SIZE)]
+    if len(batches) == 1:
+        results = [recognize_batch(batches[0])]
+    else:
+        results = list(vision_executor.map(recognize_batch, batches))
+    return [text for batch in results for text in batch]
+
+def prepare_ocr_pages(sources, tier):
+    """Готовит все файлы в пуле параллельно. Возвращает (страницы по порядку, байт пришло)"""
+    config = IMAGE_QUALITY_TIERS.get(tier)
+    tasks = []
+    original_bytes = 0
+    for source in sources:
+        if isinstance(source, str):
+            with open(source, 'rb') as image_file:
+                source = image_file.read()
+        original_bytes += len(source)
+        settings = config or (TIFF_ORIGINAL_CONFIG if is_tiff(source) else None)
+        future = None
+        if settings:
+            future = submit_source('image_pages', source, settings['max_side'], settings['quality'],
+                                   settings['grayscale'], IMAGE_MAX_PAGES)
+        tasks.append((source, future))
+    
+    pages = []
+    for source, future in tasks:
+        if future is None:
+            pages.append(source)
+            continue
+        # Если картинку не удалось разобрать - отправляем как есть
+        try:
+            prepared = future.result()
+        except ExtractionError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Не удалось подготовить фото, отправляем оригинал: {e}")
+            pages.append(source)
+            continue
+        for jpeg, original_size, size in prepared:
+            print(f"🖼️ Страница {len(pages) + 1} ({tier}): {original_size[0]}x{original_size[1]} → "
+                  f"{size[0]}x{size[1]}, {len(jpeg) // 1024} КБ")
+            pages.append(jpeg)
+    if len(pages) > IMAGE_MAX_PAGES:
+        raise ExtractionError(f"в загрузке {len(pages)} страниц, допускается не больше {IMAGE_MAX_PAGES}")
+    return pages, original_bytes
+
+def extract_text_from_images(sources, tier=IMAGE_DEFAULT_TIER):
+    """Распознает несколько фото (и многостраничные TIFF) как один документ.
+    Страницы упаковываются в пачки по VISION_BATCH_SIZE, текст собирается в порядке страниц"""
+    try:
+        print(f"🖼️ Начинаем распознавание: файлов {len(sources)}...")
         
-        #print(f"📨 Отправляем запрос в Vision API...")
-        response = requests.post(
-            "https://vision.api.cloud.yandex.net/vision/v1/batchAnalyze",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
+        started = time.perf_counter()
+        pages, original_bytes = prepare_ocr_pages(sources, tier)
+        prepare_ms = (time.perf_counter() - started) * 1000
+        with ocr_stats_lock:
+            ocr_stats['original_bytes'] += original_bytes
+            ocr_stats['prepare_ms'] += prepare_ms
         
-       # print(f"📊 Ответ API: статус {response.status_code}")
+        texts = recognize_pages(pages)
         
-        if response.status_code == 200:
-            result = response.json()
-            #print(f"📄 Полный ответ API: {json.dumps(result, indent=2, ensure_ascii=False)}")
-            
-            # Проверяем наличие textDetection в ответе
-            if ('results' in result and len(result['results']) > 0 and
-                'results' in result['results'][0] and len(result['results'][0]['results']) > 0 and
-                'textDetection' in result['results'][0]['results'][0]):
-                
-                # Извлекаем весь распознанный текст
-                text_blocks = []
-                for page in result['results'][0]['results'][0]['textDetection']['pages']:
-                    for block in page['blocks']:
-                        for line in block['lines']:
-                            line_text = ' '.join([word['text'] for word in line['words']])
-                            text_blocks.append(line_text)
-                
-                recognized_text = '\n'.join(text_blocks)
-                print(f"✅ Распознано {len(recognized_text)} символов с фото")
-                return recognized_text
-            else:
-                error_msg = "❌ В ответе API нет textDetection"
-                print(error_msg)
-                return error_msg
-        else:
-            error_msg = f"❌ Ошибка Vision API: {response.status_code} - {response.text}"
-            print(error_msg)
-            return error_msg
-            
+        if all(text is None for text in texts):
+            raise VisionError("В ответе API нет textDetection")
+        recognized_text = '\n\n'.join(text for text in texts if text)
+        print(f"✅ Распознано {len(recognized_text)} символов с {len(pages)} стр.")
+        return recognized_text
+    
+    except ExtractionError:
+        raise
+    except VisionError as e:
+        error_msg = f"❌ {e}"
+        print(error_msg)
+        return error_msg
     except Exception as e:
         error_msg = f"❌ Ошибка распознавания: {str(e)}"
         print(f"❌ {error_msg}")
         return error_msg
 
+def extract_text_from_image(source, tier=IMAGE_DEFAULT_TIER):
+    """Извлекает текст с фото через Yandex Vision API.
+    source - путь к файлу или содержимое (bytes, memoryview, mmap), tier - уровень качества"""
+    return extract_text_from_images([source], tier)
+
+# Функции, которые можно вызвать в воркере пула по имени
+EXTRACTORS = {
+    'pdf': read_pdf_text,
+    'pdf_pages': extract_pdf_page_range,
+    'pdf_count': count_pdf_pages,
+    'pdf_images': extract_pdf_page_images,
+    'docx': read_docx_text,
+    'image': prepare_image,
+    'image_pages': prepare_image_pages,
+}
+
+# Пул создается при импорте, пока у сервера еще нет фоновых потоков: шаблон форкается
+# из однопоточного процесса. Все, что запускает потоки (состояние, прогрев), - ниже
+extractor_pool = ExtractorPool()
+
+state = create_state()
+print(f"🚀 Сервер запущен. Состояние: {STATE_BACKEND}, всего пользователей: {state.user_stats()[0]}")
+
+# Прогрев - после запуска пула, чтобы воркеры не унаследовали открытые сокеты
+if UPSTREAM_PREWARM and YANDEX_API_KEY:
+    upstream.prewarm(YANDEX_GPT_URL, VISION_URL)
+
 def parse_fallback_response(ai_response):
     """Резервный парсинг для неструктурированных ответов"""
     risks = []
@@ -484,13 +2828,118 @@ def parse_fallback_response(ai_response):
     
     return risks, recommendations
 
-def analyze_with_yandexgpt(text, document_type='general'):
-    """Умный комплексный анализ документа с расширенной экспертизой"""
-    try:
-        doc_config = SMART_ANALYSIS_CONFIG[document_type]
-        
-        # Умный промпт для комплексного анализа
-        system_prompt = f"""Ты - ведущий юридический эксперт с многолетним опытом. Проведи комплексный анализ документа и предоставь развернутую экспертизу:
+# Версия промпта входит в ключ кэша анализов - при изменении промпта увеличить
+PROMPT_VERSION = 2
+
+# Бюджет токенов. Токены оцениваются локально по числу символов разных классов: русское
+# слово - около двух токенов, латиница плотнее, цифры и знаки - почти по токену на символ.
+# По оценке входа выбирается maxTokens ответа: база по типу документа плюс доля от входа,
+# не выше потолка тарифа. Оценка сверяется с usage из ответов (см. /admin/stats)
+TOKEN_CHARS = json.loads(os.getenv('TOKEN_CHARS', '{"cyrillic": 3.2, "latin": 4.0, "digit": 2.0, "other": 1.5}'))
+OUTPUT_TOKENS_BY_TYPE = json.loads(os.getenv('OUTPUT_TOKENS_BY_TYPE', json.dumps({
+    'general': 1800, 'lease': 1800, 'employment': 1800, 'sale': 2000,
+    'service': 1800, 'nda': 1400, 'loan': 2200, 'partnership': 2200,
+})))
+MAX_TOKENS_BY_PLAN = json.loads(os.getenv('MAX_TOKENS_BY_PLAN', '{"free": 2000, "basic": 3000, "premium": 4000, "unlimited": 4000}'))
+OUTPUT_TOKENS_PER_INPUT = float(os.getenv('OUTPUT_TOKENS_PER_INPUT', 0.1))
+MIN_OUTPUT_TOKENS = int(os.getenv('MIN_OUTPUT_TOKENS', 1000))
+
+TOKEN_CLASSES = (
+    ('cyrillic', re.compile(r'[а-яё]', re.IGNORECASE)),
+    ('latin', re.compile(r'[a-z]', re.IGNORECASE)),
+    ('digit', re.compile(r'\d')),
+    ('other', re.compile(r'[^\w\s]')),
+)
+
+def estimate_tokens(text):
+    """Оценка числа токенов YandexGPT для текста (в основном русского)"""
+    return int(sum(len(pattern.findall(text)) / TOKEN_CHARS[name] for name, pattern in TOKEN_CLASSES)) + 1
+
+def plan_output_cap(plan=None):
+    """Потолок maxTokens тарифа. Входит в ключ кэша анализа: ответ, обрезанный потолком
+    бесплатного тарифа, не должен доставаться платным"""
+    return MAX_TOKENS_BY_PLAN.get(plan, max(MAX_TOKENS_BY_PLAN.values()))
+
+def choose_max_tokens(input_tokens, document_type, plan=None):
+    """maxTokens ответа по типу документа, объему входа и тарифу"""
+    base = OUTPUT_TOKENS_BY_TYPE.get(document_type, OUTPUT_TOKENS_BY_TYPE['general'])
+    return max(MIN_OUTPUT_TOKENS, min(plan_output_cap(plan), base + int(input_tokens * OUTPUT_TOKENS_PER_INPUT)))
+
+# Шум, который не нужен модели: номера страниц ("- 5 -", "Стр. 3 из 10"), линии для подписи
+# и точки оглавления, колонтитулы, повторяющиеся на каждой странице.
+# Строка из одного числа не удаляется: это может быть ячейка таблицы
+PAGE_NUMBER_LINE = re.compile(r'^(?:-\s*\d+\s*-|(?:стр\.?|страница|page)\s*\d+(?:\s*(?:из|of)\s*\d+)?)$', re.IGNORECASE)
+FILLER_RUN = re.compile(r'([._\-–—])\1{3,}')
+BOILERPLATE_MIN_REPEATS = 3
+BOILERPLATE_MIN_LENGTH = 15
+
+def compact_text(text):
+    """Сжимает текст перед отправкой в модель без потери содержания"""
+    lines = [FILLER_RUN.sub(r'\1\1\1', ' '.join(line.split())) for line in text.split('\n')]
+    counts = Counter(lines)
+    seen = set()
+    kept = []
+    for line in lines:
+        if not line:
+            # Подряд идущие пустые строки - в одну
+            if kept and kept[-1]:
+                kept.append('')
+            continue
+        if PAGE_NUMBER_LINE.match(line):
+            continue
+        if counts[line] >= BOILERPLATE_MIN_REPEATS and len(line) >= BOILERPLATE_MIN_LENGTH:
+            if line in seen:
+                continue
+            seen.add(line)
+        kept.append(line)
+    compacted = '\n'.join(kept).strip()
+    if len(compacted) < len(text):
+        print(f"✂️ Текст сжат перед анализом: {len(text)} → {len(compacted)} символов")
+    return compacted
+
+# Оценка против фактического usage из ответов YandexGPT - для админки
+token_stats = {'requests': 0, 'estimated_input': 0, 'actual_input': 0, 'max_tokens': 0, 'completion': 0}
+token_stats_lock = threading.Lock()
+
+def record_token_usage(estimated, max_tokens, usage):
+    """Пишет в лог и в статистику оценку входа и фактический расход токенов"""
+    actual_input = int(usage.get('inputTextTokens', 0))
+    completion = int(usage.get('completionTokens', 0))
+    print(f"🧮 Токены: вход ~{estimated} (факт {actual_input}), ответ {completion} из maxTokens {max_tokens}")
+    if not actual_input:
+        return
+    with token_stats_lock:
+        token_stats['requests'] += 1
+        token_stats['estimated_input'] += estimated
+        token_stats['actual_input'] += actual_input
+        token_stats['max_tokens'] += max_tokens
+        token_stats['completion'] += completion
+
+def token_stats_summary():
+    with token_stats_lock:
+        stats = dict(token_stats)
+    count = stats['requests'] or 1
+    return {
+        'requests': stats['requests'],
+        'avg_estimated_input': round(stats['estimated_input'] / count),
+        'avg_actual_input': round(stats['actual_input'] / count),
+        'estimate_ratio': round(stats['estimated_input'] / stats['actual_input'], 3) if stats['actual_input'] else None,
+        'avg_max_tokens': round(stats['max_tokens'] / count),
+        'avg_completion': round(stats['completion'] / count),
+        'max_tokens_used': round(stats['completion'] / stats['max_tokens'], 3) if stats['max_tokens'] else None
+    }
+
+def build_analysis_request(text, document_type, stream=False, part=None, plan=None):
+    """Заголовки, тело запроса к YandexGPT для комплексного анализа и оценка токенов входа.
+    part - (номер части, всего частей) для фрагмента длинного документа"""
+    doc_config = SMART_ANALYSIS_CONFIG[document_type]
+    fragment = ""
+    if part:
+        fragment = (f"Это часть {part[0]} из {part[1]} документа. Анализируй только ее и не считай "
+                    f"риском отсутствие условий, которые могут быть в других частях.\n\n")
+    
+    # Умный промпт для комплексного анализа
+    system_prompt = f"""Ты - ведущий юридический эксперт с многолетним опытом. Проведи комплексный анализ документа и предоставь развернутую экспертизу:
 
 ЭКСПЕРТНАЯ ОЦЕНКА ДОКУМЕНТА:
 
@@ -546,150 +2995,229 @@ MEDIUM|Умеренный риск|Описание
 ЭКСПЕРТНОЕ ЗАКЛЮЧЕНИЕ:
 [общая оценка и выводы]"""
 
-        headers = {
-            "Authorization": f"Api-Key {YANDEX_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt/latest",
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.1,
-                "maxTokens": 4000
-            },
-            "messages": [
-                {
-                    "role": "system", 
-                    "text": system_prompt
-                },
-                {
-                    "role": "user",
-                    "text": f"""Проведи комплексный экспертный анализ этого {doc_config['name']}:
+    headers = {
+        "Authorization": f"Api-Key {YANDEX_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    
+    user_text = f"""{fragment}Проведи комплексный экспертный анализ этого {doc_config['name']}:
 
-{text[:15000]}
+{text[:ANALYSIS_CHAR_LIMIT]}
 
 Проанализируй с позиций: {', '.join(doc_config['expert_areas'])}.
 Будь максимально конкретен и практичен в рекомендациях."""
-                }
-            ]
-        }
-        
+    input_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_text)
+    
+    data = {
+        "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt/latest",
+        "completionOptions": {
+            "stream": stream,
+            "temperature": 0.1,
+            "maxTokens": choose_max_tokens(input_tokens, document_type, plan)
+        },
+        "messages": [
+            {
+                "role": "system", 
+                "text": system_prompt
+            },
+            {
+                "role": "user",
+                "text": user_text
+            }
+        ]
+    }
+    return headers, data, input_tokens
+
+class YandexGPTError(Exception):
+    """YandexGPT ответил ошибкой"""
+
+def request_completion(text, document_type, part=None, plan=None):
+    """Один запрос к YandexGPT, возвращает текст ответа. part - (номер части, всего частей)"""
+    headers, data, input_tokens = build_analysis_request(text, document_type, part=part, plan=plan)
+    response = upstream.post(
+        YANDEX_GPT_URL,
+        headers=headers,
+        json=data,
+        timeout=60
+    )
+    if response.status_code != 200:
+        raise YandexGPTError(f"Ошибка YandexGPT: {response.status_code}")
+    result = response.json()['result']
+    record_token_usage(input_tokens, data['completionOptions']['maxTokens'], result.get('usage', {}))
+    return result['alternatives'][0]['message']['text']
+
+def analyze_with_yandexgpt(text, document_type='general', plan=None):
+    """Умный комплексный анализ документа с расширенной экспертизой"""
+    try:
+        doc_config = SMART_ANALYSIS_CONFIG[document_type]
         print(f"🧠 Запускаем умный анализ для {doc_config['name']}")
-        response = requests.post(
-            "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-            headers=headers,
-            json=data,
-            timeout=60
-        )
+        ai_response = request_completion(text, document_type, plan=plan)
         
-        if response.status_code == 200:
-            result = response.json()
-            ai_response = result['result']['alternatives'][0]['message']['text']
-            
-            print(f"✅ Получен развернутый анализ от YandexGPT")
-            return parse_smart_analysis(ai_response, document_type)
-        else:
-            error_msg = f"Ошибка YandexGPT: {response.status_code}"
-            return create_fallback_analysis(document_type, error_msg)
-            
+        print(f"✅ Получен развернутый анализ от YandexGPT")
+        return parse_smart_analysis(ai_response, document_type)
+    
+    except YandexGPTError as e:
+        return create_fallback_analysis(document_type, str(e))
     except Exception as e:
         error_msg = f"Ошибка соединения: {str(e)}"
         return create_fallback_analysis(document_type, error_msg)
         
-def parse_smart_analysis(ai_response, document_type):
-    """Парсинг комплексного анализа от AI"""
-    doc_config = SMART_ANALYSIS_CONFIG[document_type]
+class SmartAnalysisParser:
+    """Разбор ответа AI по мере поступления текста. feed() принимает очередной кусок
+    и возвращает имена разделов, которые уже закончились (начался следующий раздел),
+    finish() - оставшийся последний. Разобранное копится в sections"""
     
-    sections = {
-        'legal_expertise': '',
-        'financial_analysis': '', 
-        'operational_risks': '',
-        'strategic_assessment': '',
-        'key_risks': [],
-        'practical_recommendations': [],
-        'alternative_solutions': [],
-        'expert_conclusion': ''
-    }
+    HEADERS = (
+        ('юридическая экспертиза', 'legal_expertise'),
+        ('финансовый анализ', 'financial_analysis'),
+        ('операционные риски', 'operational_risks'),
+        ('стратегическая оценка', 'strategic_assessment'),
+        ('ключевые риски', 'key_risks'),
+        ('практические рекомендации', 'practical_recommendations'),
+        ('альтернативные решения', 'alternative_solutions'),
+        ('экспертное заключение', 'expert_conclusion'),
+    )
+    TEXT_SECTIONS = ('legal_expertise', 'financial_analysis', 'operational_risks',
+                     'strategic_assessment', 'expert_conclusion')
     
-    current_section = None
-    lines = [line.strip() for line in ai_response.split('\n') if line.strip()]
+    def __init__(self):
+        self.sections = {
+            'legal_expertise': '',
+            'financial_analysis': '', 
+            'operational_risks': '',
+            'strategic_assessment': '',
+            'key_risks': [],
+            'practical_recommendations': [],
+            'alternative_solutions': [],
+            'expert_conclusion': ''
+        }
+        self.current_section = None
+        self.buffer = ''
     
-    for line in lines:
+    def feed(self, chunk):
+        self.buffer += chunk
+        *lines, self.buffer = self.buffer.split('\n')
+        completed = []
+        for line in lines:
+            finished = self.add_line(line.strip())
+            if finished:
+                completed.append(finished)
+        return completed
+    
+    def finish(self):
+        completed = self.feed('\n')
+        if self.current_section:
+            completed.append(self.current_section)
+            self.current_section = None
+        return completed
+    
+    def add_line(self, line):
+        """Обрабатывает строку. Если она открывает новый раздел - возвращает закончившийся"""
+        if not line:
+            return None
         line_lower = line.lower()
         
         # Определяем разделы
-        if 'юридическая экспертиза' in line_lower:
-            current_section = 'legal_expertise'
-            continue
-        elif 'финансовый анализ' in line_lower:
-            current_section = 'financial_analysis'
-            continue
-        elif 'операционные риски' in line_lower:
-            current_section = 'operational_risks'
-            continue
-        elif 'стратегическая оценка' in line_lower:
-            current_section = 'strategic_assessment'
-            continue
-        elif 'ключевые риски' in line_lower:
-            current_section = 'key_risks'
-            continue
-        elif 'практические рекомендации' in line_lower:
-            current_section = 'practical_recommendations'
-            continue
-        elif 'альтернативные решения' in line_lower:
-            current_section = 'alternative_solutions'
-            continue
-        elif 'экспертное заключение' in line_lower:
-            current_section = 'expert_conclusion'
-            continue
+        for header, section in self.HEADERS:
+            if header in line_lower:
+                finished = self.current_section if self.current_section != section else None
+                self.current_section = section
+                return finished
         
         # Обрабатываем содержимое разделов
-        if current_section:
-            if current_section in ['legal_expertise', 'financial_analysis', 'operational_risks', 
-                                 'strategic_assessment', 'expert_conclusion']:
-                if line and not line.startswith(('CRITICAL', 'HIGH', 'MEDIUM', 'LOW', '-', '•')):
-                    if sections[current_section]:
-                        sections[current_section] += ' ' + line
-                    else:
-                        sections[current_section] = line
-            
-            elif current_section == 'key_risks' and '|' in line:
-                parts = line.split('|')
-                if len(parts) >= 3:
-                    risk_level = parts[0].strip()
-                    risk_title = parts[1].strip()
-                    risk_description = parts[2].strip()
-                    
-                    if risk_level in RISK_LEVELS:
-                        sections['key_risks'].append({
-                            'level': risk_level,
-                            'title': risk_title,
-                            'description': risk_description,
-                            'color': RISK_LEVELS[risk_level]['color'],
-                            'icon': RISK_LEVELS[risk_level]['icon']
-                        })
-            
-            elif current_section == 'practical_recommendations' and '|' in line:
-                parts = line.split('|')
-                if len(parts) >= 3:
-                    sections['practical_recommendations'].append({
-                        'action': parts[0].strip().lstrip('-• '),
-                        'effect': parts[1].strip(),
-                        'urgency': parts[2].strip()
-                    })
-            
-            elif current_section == 'alternative_solutions' and '|' in line:
-                parts = line.split('|')
-                if len(parts) >= 3:
-                    sections['alternative_solutions'].append({
-                        'solution': parts[0].strip().lstrip('-• '),
-                        'advantages': parts[1].strip(),
-                        'disadvantages': parts[2].strip()
+        current_section = self.current_section
+        sections = self.sections
+        if current_section in self.TEXT_SECTIONS:
+            if not line.startswith(('CRITICAL', 'HIGH', 'MEDIUM', 'LOW', '-', '•')):
+                if sections[current_section]:
+                    sections[current_section] += ' ' + line
+                else:
+                    sections[current_section] = line
+        
+        elif current_section == 'key_risks' and '|' in line:
+            parts = line.split('|')
+            if len(parts) >= 3:
+                risk_level = parts[0].strip()
+                risk_title = parts[1].strip()
+                risk_description = parts[2].strip()
+                
+                if risk_level in RISK_LEVELS:
+                    sections['key_risks'].append({
+                        'level': risk_level,
+                        'title': risk_title,
+                        'description': risk_description,
+                        'color': RISK_LEVELS[risk_level]['color'],
+                        'icon': RISK_LEVELS[risk_level]['icon']
                     })
+        
+        elif current_section == 'practical_recommendations' and '|' in line:
+            parts = line.split('|')
+            if len(parts) >= 3:
+                sections['practical_recommendations'].append({
+                    'action': parts[0].strip().lstrip('-• '),
+                    'effect': parts[1].strip(),
+                    'urgency': parts[2].strip()
+                })
+        
+        elif current_section == 'alternative_solutions' and '|' in line:
+            parts = line.split('|')
+            if len(parts) >= 3:
+                sections['alternative_solutions'].append({
+                    'solution': parts[0].strip().lstrip('-• '),
+                    'advantages': parts[1].strip(),
+                    'disadvantages': parts[2].strip()
+                })
+        return None
+
+def parse_smart_analysis(ai_response, document_type):
+    """Парсинг комплексного анализа от AI"""
+    parser = SmartAnalysisParser()
+    parser.feed(ai_response)
+    parser.finish()
     
     # Создаем итоговый результат
-    return create_smart_analysis_result(sections, document_type)
+    return create_smart_analysis_result(parser.sections, document_type)
+
+def stream_yandexgpt(text, document_type='general', plan=None):
+    """Потоковый анализ: YandexGPT отдает ответ частями (строки JSON с накопленным текстом).
+    Отдает ('section', {'name', 'value'}) по мере готовности разделов и в конце ('result', анализ)"""
+    doc_config = SMART_ANALYSIS_CONFIG[document_type]
+    parser = SmartAnalysisParser()
+    
+    def sections(names):
+        return [('section', {'name': name, 'value': parser.sections[name]}) for name in names]
+    
+    try:
+        headers, data, input_tokens = build_analysis_request(text, document_type, stream=True, plan=plan)
+        print(f"🧠 Запускаем потоковый анализ для {doc_config['name']}")
+        started = time.perf_counter()
+        first_chunk = None
+        with upstream.post(YANDEX_GPT_URL, headers=headers, json=data, timeout=60, stream=True) as response:
+            if response.status_code != 200:
+                yield 'result', create_fallback_analysis(document_type, f"Ошибка YandexGPT: {response.status_code}")
+                return
+            
+            received = ''
+            usage = {}
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)['result']
+                usage = result.get('usage', usage)
+                current = result['alternatives'][0]['message']['text']
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                yield from sections(parser.feed(current[len(received):]))
+                received = current
+        
+        yield from sections(parser.finish())
+        record_token_usage(input_tokens, data['completionOptions']['maxTokens'], usage)
+        print(f"✅ Потоковый анализ от YandexGPT: первый фрагмент через {(first_chunk or 0) * 1000:.0f} мс, "
+              f"всего {(time.perf_counter() - started) * 1000:.0f} мс")
+        yield 'result', create_smart_analysis_result(parser.sections, document_type)
+    
+    except Exception as e:
+        yield 'result', create_fallback_analysis(document_type, f"Ошибка соединения: {str(e)}")
 
 def create_smart_analysis_result(sections, document_type):
     """Создает структурированный результат умного анализа"""
@@ -811,9 +3339,178 @@ def create_fallback_analysis(document_type, error_msg):
         }
     }
 
+# Длинные документы анализируются целиком по схеме map-reduce: текст режется по границам
+# пунктов на части по ANALYSIS_CHAR_LIMIT символов, части анализируются параллельно
+# (не больше LONG_DOCUMENT_CONCURRENCY запросов сразу), риски и рекомендации частей
+# сливаются в один результат без повторов. Объем документа ограничен тарифом
+LONG_DOCUMENT_CHARS_BY_PLAN = json.loads(os.getenv('LONG_DOCUMENT_CHARS_BY_PLAN',
+                                                   '{"basic": 60000, "premium": 150000, "unlimited": 300000}'))
+LONG_DOCUMENT_CONCURRENCY = int(os.getenv('LONG_DOCUMENT_CONCURRENCY', 4))
+LONG_DOCUMENT_SIMILARITY = float(os.getenv('LONG_DOCUMENT_SIMILARITY', 0.6))  # порог повтора по словам
+
+long_document_executor = ThreadPoolExecutor(max_workers=LONG_DOCUMENT_CONCURRENCY, thread_name_prefix='long-doc')
+
+# Начало пункта: "5.", "5.2.", "5.2)", "Статья 5", "Раздел II", "Глава 3", "§ 4"
+CLAUSE_START = re.compile(r'^\s*(?:\d+(?:\.\d+)*[.)]\s|(?:статья|раздел|глава)\s+[\dIVXLC]+|§\s*\d)', re.IGNORECASE | re.MULTILINE)
+RISK_ORDER = {'CRITICAL': 0, 'HIGH': 1, 'MEDIUM': 2, 'LOW': 3, 'INFO': 4}
+
+def document_char_limit(plan):
+    """Сколько символов документа извлекать и анализировать на тарифе"""
+    return max(ANALYSIS_CHAR_LIMIT, LONG_DOCUMENT_CHARS_BY_PLAN.get(plan, ANALYSIS_CHAR_LIMIT))
+
+def split_long_piece(piece, max_chars):
+    """Пункт длиннее части режется по абзацам, затем по предложениям, в крайнем случае - по длине"""
+    for separator in ('\n\n', '\n', '. '):
+        parts = piece.split(separator)
+        parts = [part + separator for part in parts[:-1]] + [parts[-1]]
+        parts = [part for part in parts if part]
+        # Разрез помогает, только если каждая часть короче исходного куска - иначе
+        # (например, разделитель лишь в конце) кусок вернулся бы целиком и зациклился
+        if len(parts) > 1 and all(len(part) < len(piece) for part in parts):
+            return parts
+    return [piece[start:start + max_chars] for start in range(0, len(piece), max_chars)]
+
+def split_into_chunks(text, max_chars=ANALYSIS_CHAR_LIMIT):
+    """Делит текст на части не длиннее max_chars, стараясь не разрывать пункты договора"""
+    starts = [match.start() for match in CLAUSE_START.finditer(text)]
+    bounds = sorted(set([0] + starts + [len(text)]))
+    pieces = [text[start:stop] for start, stop in zip(bounds, bounds[1:])]
+    
+    chunks = []
+    current = ''
+    while pieces:
+        piece = pieces.pop(0)
+        if len(piece) > max_chars:
+            pieces[:0] = split_long_piece(piece, max_chars)
+            continue
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ''
+        current += piece
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+def words_of(text):
+    """Значимые слова для сравнения: короткие служебные отбрасываются, номера пунктов - нет"""
+    return {word for word in re.findall(r'\w+', text.lower()) if len(word) > 2 or word.isdigit()}
+
+def merge_unique(items, key, prefer=None):
+    """Убирает повторы: элементы с похожим (по словам) key считаются одним.
+    prefer(новый, старый) - True, если из двух повторов оставить новый"""
+    kept = []
+    for item in items:
+        words = words_of(key(item))
+        for index, (other_words, other) in enumerate(kept):
+            union = words | other_words
+            if union and len(words & other_words) / len(union) >= LONG_DOCUMENT_SIMILARITY:
+                if prefer and prefer(item, other):
+                    kept[index] = (words, item)
+                break
+        else:
+            kept.append((words, item))
+    return [item for _, item in kept]
+
+def merge_sections(parts):
+    """Reduce: сводит разделы анализа частей в один набор разделов"""
+    merged = {}
+    for name in SmartAnalysisParser.TEXT_SECTIONS:
+        texts = merge_unique([part[name] for part in parts if part[name]], key=lambda text: text)
+        merged[name] = ' '.join(texts)
+    
+    risks = merge_unique(
+        [risk for part in parts for risk in part['key_risks']],
+        key=lambda risk: f"{risk['title']} {risk['description']}",
+        prefer=lambda new, old: RISK_ORDER[new['level']] < RISK_ORDER[old['level']])
+    merged['key_risks'] = sorted(risks, key=lambda risk: RISK_ORDER[risk['level']])
+    merged['practical_recommendations'] = merge_unique(
+        [rec for part in parts for rec in part['practical_recommendations']], key=lambda rec: rec['action'])
+    merged['alternative_solutions'] = merge_unique(
+        [sol for part in parts for sol in part['alternative_solutions']], key=lambda sol: sol['solution'])
+    return merged
+
+def analyze_chunk(chunk, document_type, part, plan=None):
+    parser = SmartAnalysisParser()
+    parser.feed(request_completion(chunk, document_type, part=part, plan=plan))
+    parser.finish()
+    return parser.sections
+
+def analyze_long_document(text, document_type, plan=None):
+    """Map-reduce анализ документа длиннее ANALYSIS_CHAR_LIMIT"""
+    chunks = split_into_chunks(text)
+    total = len(chunks)
+    print(f"📚 Длинный документ: {len(text)} символов, {total} частей, параллельно до {LONG_DOCUMENT_CONCURRENCY}")
+    
+    started = time.perf_counter()
+    futures = [long_document_executor.submit(analyze_chunk, chunk, document_type, (index + 1, total), plan)
+               for index, chunk in enumerate(chunks)]
+    parts = []
+    errors = []
+    for future in futures:
+        try:
+            parts.append(future.result())
+        except Exception as e:
+            errors.append(str(e))
+    if not parts:
+        return create_fallback_analysis(document_type, errors[0])
+    print(f"✅ Проанализировано частей {len(parts)} из {total} за {(time.perf_counter() - started) * 1000:.0f} мс")
+    
+    result = create_smart_analysis_result(merge_sections(parts), document_type)
+    result['long_document'] = {'chars': len(text), 'chunks': total, 'analyzed_chunks': len(parts)}
+    fact = f"Документ проанализирован целиком: {len(text)} символов, {total} частей"
+    if errors:
+        fact = f"Проанализировано {len(parts)} из {total} частей документа - часть запросов не удалась"
+    result['executive_summary']['quick_facts'].insert(0, fact)
+    return result
+
+def lookup_analysis(text, document_type, plan=None):
+    """Ищет готовый анализ в кэше. Возвращает (анализ или None, ключ кэша,
+    отпечаток для индекса похожих: (вид анализа, MinHash-подпись, текст) или None)"""
+    # Тот же текст с точностью до пробелов уже анализировали с тем же потолком ответа - берем из кэша
+    normalized = ' '.join(text.split())
+    output_cap = plan_output_cap(plan)
+    cache_key = TieredCache.make_key(normalized, document_type, PROMPT_VERSION, output_cap)
+    result = analysis_cache.get(cache_key)
+    if result is not None:
+        print("⚡ Анализ взят из кэша")
+        return result, cache_key, None
+    
+    # Почти такой же документ (тот же шаблон) уже анализировали - переписываем его анализ
+    signature = minhash_signature(normalized) if NEAR_DUPLICATE_THRESHOLD > 0 else None
+    fingerprint = None
+    if signature is not None:
+        kind = (document_type, output_cap)
+        fingerprint = (kind, signature, normalized)
+        match = near_duplicates.find(kind, signature)
+        if match:
+            source = analysis_cache.get(TieredCache.make_key(match[0], 'source'))
+            previous = analysis_cache.get(match[0])
+            if source is not None and previous is not None:
+                result = patch_analysis(previous, source, normalized)
+        if result is not None:
+            near_duplicates.record_hit()
+            similarity = round(match[1] * 100)
+            print(f"⚡ Анализ взят у похожего документа (совпадение {similarity}%)")
+            result['near_duplicate'] = {'similarity': match[1]}
+            result['executive_summary']['quick_facts'].insert(
+                0, f"Анализ выполнен по документу того же шаблона (совпадение текста {similarity}%)")
+            # Переписанный анализ описывает ровно этот текст - его можно отдавать по точному совпадению
+            analysis_cache.put(cache_key, result)
+    return result, cache_key, fingerprint
+
+def store_analysis(cache_key, fingerprint, result):
+    """Кэширует успешный анализ AI и добавляет документ в индекс похожих.
+    Текст документа хранится рядом с анализом: по нему строятся замены для похожих"""
+    analysis_cache.put(cache_key, result)
+    if fingerprint is not None:
+        kind, signature, source = fingerprint
+        analysis_cache.put(TieredCache.make_key(cache_key, 'source'), source)
+        near_duplicates.add(cache_key, kind, signature)
+
 def analyze_text(text, user_id='default'):
     """Умная функция анализа с определением типа документа"""
     user = get_user(user_id)
+    text = compact_text(text)
     
     # Определяем тип документа
     document_type = detect_document_type(text)
@@ -823,13 +3520,53 @@ def analyze_text(text, user_id='default'):
     
     # Проверяем доступ к AI по тарифу
     if PLANS[user['plan']]['ai_access']:
-        result = analyze_with_yandexgpt(text, document_type)
+        result, cache_key, fingerprint = lookup_analysis(text, document_type, user['plan'])
+        if result is not None:
+            return result
+        
+        if len(text) > ANALYSIS_CHAR_LIMIT:
+            result = analyze_long_document(text, document_type, user['plan'])
+        else:
+            result = analyze_with_yandexgpt(text, document_type, plan=user['plan'])
         if result['ai_used']:
+            store_analysis(cache_key, fingerprint, result)
             return result
     
     # Если AI недоступен, используем улучшенный локальный анализ
     return create_basic_analysis(text, document_type)
 
+def analyze_text_stream(text, user_id='default'):
+    """Как analyze_text, но генератор событий: ('meta', тип документа),
+    ('section', раздел) по мере генерации и последним - ('result', анализ)"""
+    user = get_user(user_id)
+    text = compact_text(text)
+    document_type = detect_document_type(text)
+    doc_config = SMART_ANALYSIS_CONFIG[document_type]
+    yield 'meta', {'document_type': document_type, 'document_type_name': doc_config['name']}
+    
+    print(f"🔍 Анализируем документ типа: {doc_config['name']} (поток)")
+    
+    if PLANS[user['plan']]['ai_access']:
+        result, cache_key, fingerprint = lookup_analysis(text, document_type, user['plan'])
+        if result is not None:
+            yield 'result', result
+            return
+        
+        # Длинный документ разбирается частями параллельно - разделы появятся только в итоге
+        events = [('result', analyze_long_document(text, document_type, user['plan']))] if len(text) > ANALYSIS_CHAR_LIMIT \
+            else stream_yandexgpt(text, document_type, user['plan'])
+        for event, data in events:
+            if event == 'result':
+                result = data
+            else:
+                yield event, data
+        if result['ai_used']:
+            store_analysis(cache_key, fingerprint, result)
+            yield 'result', result
+            return
+    
+    yield 'result', create_basic_analysis(text, document_type)
+
 def create_basic_analysis(text, document_type):
     """Базовый анализ для случаев когда AI недоступен"""
     doc_config = SMART_ANALYSIS_CONFIG[document_type]
@@ -1024,12 +3761,12 @@ def home():
                 <p><strong>Нажмите чтобы выбрать документ</strong></p>
                 <p style="color: #718096; margin-top: 15px;">
     PDF, DOCX, TXT 
-    <span style="color: #e53e3e; font-weight: bold;">• ФОТО (только для платных тарифов)</span>
+    <span style="color: #e53e3e; font-weight: bold;">• ФОТО, можно несколько страниц (только для платных тарифов)</span>
     (до 10MB)
 </p>
             </div>
 
-            <input type="file" id="fileInput" style="display: none;" accept=".pdf,.docx,.txt,.jpg,.jpeg,.png,.webp" onchange="handleFileSelect(event)">
+            <input type="file" id="fileInput" style="display: none;" accept=".pdf,.docx,.txt,.jpg,.jpeg,.png,.webp,.tif,.tiff" multiple onchange="handleFileSelect(event)">
             
             <div class="file-info" id="fileInfo" style="display: none;">
                 <strong>Выбран файл:</strong> <span id="fileName"></span>
@@ -1079,7 +3816,7 @@ def home():
             </div>
 
         <script>
-            let selectedFile = null;
+            let selectedFiles = [];
             let currentUserId = null;
 
             // Загружаем или создаем ID пользователя
@@ -1137,37 +3874,48 @@ def home():
             }
 
             function handleFileSelect(event) {
-                const file = event.target.files[0];
-                if (!file) return;
+                const files = Array.from(event.target.files);
+                if (files.length === 0) return;
                 
-                if (!file.name.match(/\.(pdf|docx|txt|jpg|jpeg|png|webp)$/i)) {
-                    alert('Пожалуйста, выберите файл в формате PDF, DOCX, TXT, JPG или PNG');
-                    return;
+                for (const file of files) {
+                    if (!file.name.match(/\.(pdf|docx|txt|jpg|jpeg|png|webp|tif|tiff)$/i)) {
+                        alert('Пожалуйста, выберите файл в формате PDF, DOCX, TXT, JPG, PNG или TIFF');
+                        return;
+                    }
+
+                    if (file.size > 10 * 1024 * 1024) {
+                        alert('Файл слишком большой. Максимальный размер: 10MB');
+                        return;
+                    }
                 }
 
-                if (file.size > 10 * 1024 * 1024) {
-                    alert('Файл слишком большой. Максимальный размер: 10MB');
+                // Несколько файлов - это фото страниц одного документа
+                if (files.length > 1 && !files.every(file => file.name.match(/\.(jpg|jpeg|png|webp|tif|tiff)$/i))) {
+                    alert('Несколько файлов можно выбрать только для фото страниц документа');
                     return;
                 }
 
-                selectedFile = file;
-                document.getElementById('fileName').textContent = file.name;
+                selectedFiles = files;
+                document.getElementById('fileName').textContent = files.map(file => file.name).join(', ');
                 document.getElementById('fileInfo').style.display = 'block';
                 document.getElementById('analyzeBtn').disabled = false;
             }
 
             async function analyzeDocument() {
-                if (!selectedFile || !currentUserId) return;
+                if (selectedFiles.length === 0 || !currentUserId) return;
 
                 document.getElementById('loading').style.display = 'block';
+                document.querySelector('#loading p').textContent = 'Анализируем документ...';
                 document.getElementById('analyzeBtn').disabled = true;
 
                 try {
                     const formData = new FormData();
-                    formData.append('file', selectedFile);
+                    selectedFiles.forEach(file => formData.append('file', file));
                     formData.append('user_id', currentUserId);
 
-                    const response = await fetch(window.location.origin + '/analyze', {
+                    // Разделы анализа приходят потоком (SSE); без ReadableStream - фоновая задача с опросом
+                    const streaming = !!(window.ReadableStream && window.TextDecoder);
+                    const response = await fetch(window.location.origin + (streaming ? '/analyze/stream' : '/analyze?async=1'), {
                         method: 'POST',
                         body: formData
                     });
@@ -1176,7 +3924,7 @@ def home():
                         throw new Error(`HTTP error! status: ${response.status}`);
                     }
 
-                    const data = await response.json();
+                    const data = streaming ? await readAnalysisStream(response) : await waitForJob((await response.json()).job_id);
 
                     document.getElementById('loading').style.display = 'none';
 
@@ -1201,6 +3949,108 @@ def home():
                 }
             }
 
+            const sectionTitles = {
+                legal_expertise: '🧑‍⚖️ Юридическая экспертиза',
+                financial_analysis: '💰 Финансовый анализ',
+                operational_risks: '⚙️ Операционные риски',
+                strategic_assessment: '🎯 Стратегическая оценка',
+                key_risks: '⚠️ Ключевые риски',
+                practical_recommendations: '✅ Практические рекомендации',
+                alternative_solutions: '🔄 Альтернативные решения',
+                expert_conclusion: '📋 Экспертное заключение'
+            };
+
+            // Разделы анализа показываются по мере генерации, итог заменяет их полным отчетом
+            function startPartialResult(meta) {
+                const resultDiv = document.getElementById('result');
+                document.getElementById('resultContent').innerHTML =
+                    `<div class="executive-summary"><h3 style="margin: 0; color: white;">${meta.document_type_name}</h3></div>`;
+                resultDiv.style.display = 'block';
+                document.querySelector('#loading p').textContent = 'Эксперт пишет заключение...';
+            }
+
+            function showPartialSection(section) {
+                const value = section.value;
+                let body = '';
+                if (!Array.isArray(value)) {
+                    body = `<p>${value}</p>`;
+                } else if (section.name === 'key_risks') {
+                    body = value.map(risk => `
+                        <div style="background: ${risk.color}20; padding: 12px; margin: 8px 0; border-radius: 8px; border-left: 4px solid ${risk.color};">
+                            <span class="risk-badge risk-${risk.level.toLowerCase()}">${risk.icon} ${risk.level}</span>
+                            <strong style="margin-left: 10px;">${risk.title}</strong>
+                            <p style="margin: 8px 0 0 0; color: #4a5568;">${risk.description}</p>
+                        </div>`).join('');
+                } else if (section.name === 'practical_recommendations') {
+                    body = value.map(rec => `
+                        <div class="recommendation-card">
+                            <strong>📝 ${rec.action}</strong>
+                            <p style="margin: 0; color: #2d3748;"><strong>Эффект:</strong> ${rec.effect}</p>
+                        </div>`).join('');
+                } else {
+                    body = value.map(sol => `
+                        <div class="alternative-card"><strong>💡 ${sol.solution}</strong></div>`).join('');
+                }
+                if (!body) return;
+                document.getElementById('resultContent').insertAdjacentHTML('beforeend',
+                    `<div class="expert-section"><h4>${sectionTitles[section.name] || section.name}</h4>${body}</div>`);
+            }
+
+            async function readAnalysisStream(response) {
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let result = null;
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const events = buffer.split('\\n\\n');
+                    buffer = events.pop();
+                    for (const raw of events) {
+                        let event = 'message';
+                        let data = '';
+                        raw.split('\\n').forEach(line => {
+                            if (line.startsWith('event: ')) event = line.slice(7);
+                            else if (line.startsWith('data: ')) data += line.slice(6);
+                        });
+                        if (!data) continue;
+                        const payload = JSON.parse(data);
+                        if (event === 'meta') startPartialResult(payload);
+                        else if (event === 'section') showPartialSection(payload);
+                        else if (event === 'result' || event === 'error') result = payload;
+                    }
+                }
+                if (!result) {
+                    throw new Error('Соединение прервано до завершения анализа');
+                }
+                return result;
+            }
+
+            const stageNames = {
+                queued: 'В очереди на анализ...',
+                extracting: 'Извлекаем текст...',
+                analyzing: 'Анализируем документ...'
+            };
+
+            async function waitForJob(jobId) {
+                const status = document.querySelector('#loading p');
+                while (true) {
+                    await new Promise(resolve => setTimeout(resolve, 1000));
+                    const response = await fetch(window.location.origin + '/jobs/' + jobId);
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! status: ${response.status}`);
+                    }
+                    const job = await response.json();
+                    if (job.status === 'queued' || job.status === 'running') {
+                        status.textContent = stageNames[job.stage] || stageNames.analyzing;
+                        continue;
+                    }
+                    status.textContent = stageNames.analyzing;
+                    return job;
+                }
+            }
+
             function showResult(data) {
     const resultDiv = document.getElementById('result');
     const resultContent = document.getElementById('resultContent');
@@ -1688,48 +4538,249 @@ def create_user():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+# Загрузки держим в памяти, на диск уходят только файлы больше UPLOAD_SPOOL_MAX_BYTES.
+# sha256 и тип по сигнатуре считаются за тот же проход чтения
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv('UPLOAD_SPOOL_MAX_BYTES', 16 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = 256 * 1024
+SNIFF_BYTES = 1024
+
+FILE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image'),
+    (b'\xff\xd8\xff', 'image'),
+    (b'II*\x00', 'image'),  # TIFF, в том числе многостраничный скан
+    (b'MM\x00*', 'image'),
+    (b'PK\x03\x04', 'docx'),
+)
+FILE_EXTENSIONS = {
+    '.pdf': 'pdf',
+    '.docx': 'docx',
+    '.txt': 'txt',
+    '.jpg': 'image', '.jpeg': 'image', '.png': 'image', '.webp': 'image',
+    '.tif': 'image', '.tiff': 'image',
+}
+
+def sniff_kind(head, filename):
+    """Тип файла по сигнатуре, без сигнатуры - по расширению. None - не поддерживается"""
+    if b'%PDF-' in head:
+        return 'pdf'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image'
+    for signature, kind in FILE_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    return FILE_EXTENSIONS.get(os.path.splitext(filename.lower())[1])
+
+class Upload:
+    """Загруженный файл в памяти или, если он слишком большой, во временном файле"""
+    
+    def __init__(self, file_storage, spool_max=UPLOAD_SPOOL_MAX_BYTES):
+        self.filename = file_storage.filename
+        self.buffer = io.BytesIO()
+        self.path = None
+        self.file = None
+        self.mapped = None
+        digest = hashlib.sha256()
+        head = b''
+        self.size = 0
+        
+        stream = file_storage.stream
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if len(head) < SNIFF_BYTES:
+                head += chunk[:SNIFF_BYTES - len(head)]
+            self.size += len(chunk)
+            if self.file is None and self.size > spool_max:
+                self.spill()
+            (self.file or self.buffer).write(chunk)
+        if self.file is not None:
+            self.file.flush()
+        
+        self.sha256 = digest.hexdigest()
+        self.kind = sniff_kind(head, self.filename)
+    
+    def spill(self):
+        """Переносит уже прочитанное во временный файл"""
+        self.file = tempfile.NamedTemporaryFile(prefix='docscan_', delete=False)
+        self.path = self.file.name
+        self.file.write(self.buffer.getbuffer())
+        self.buffer = None
+        print(f"💾 Загрузка {self.filename} больше {UPLOAD_SPOOL_MAX_BYTES} байт - пишем на диск")
+    
+    def data(self):
+        """Содержимое без копирования: memoryview буфера или mmap временного файла"""
+        if self.buffer is not None:
+            return self.buffer.getbuffer()
+        if self.mapped is None and self.size:
+            self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapped if self.mapped is not None else b''
+    
+    def source(self):
+        """Что передавать извлекателям: путь для файла на диске, иначе содержимое"""
+        return self.path if self.path else self.data()
+    
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+        if self.file is not None:
+            self.file.close()
+            os.unlink(self.path)
+
+def extract_cached(uploads, extract, variant=None, max_chars=ANALYSIS_CHAR_LIMIT):
+    """Текст файлов из кэша по sha256 содержимого, иначе extract() с сохранением в кэш.
+    Несколько фото страниц кэшируются как один документ. variant - то, от чего еще зависит
+    текст (например, уровень OCR), max_chars - бюджет извлечения. Сообщения об ошибках не кэшируются"""
+    key = TieredCache.make_key(*(upload.sha256 for upload in uploads), uploads[0].kind, max_chars,
+                               *([variant] if variant else []))
+    text = text_cache.get(key)
+    if text is not None:
+        print(f"⚡ Текст {', '.join(upload.filename for upload in uploads)} взят из кэша")
+        return text
+    text = extract()
+    if text and len(text.strip()) >= 10 and not text.startswith(('Ошибка чтения', '❌')):
+        text_cache.put(key, text)
+    return text
+
 # Обновляем endpoint анализа для работы с user_id
 # ... предыдущий код ...
 
-@app.route('/analyze', methods=['POST'])
-def analyze_document():
-    real_ip = get_client_ip()
-    print(f"🔍 Анализ запущен для IP: {real_ip}")
-    # Получаем user_id из формы или используем default
-    user_id = request.form.get('user_id', 'default')
+# Асинхронные анализы: /analyze?async=1 сразу отдает id задачи, извлечение и анализ
+# идут в ограниченном пуле потоков, результат забирается через GET /jobs/<id>.
+# Завершенные задачи хранятся JOB_TTL секунд, затем их удаляет планировщик
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 64))
+JOB_TTL = int(os.getenv('JOB_TTL', 15 * 60))  # секунд
+
+class JobManager:
+    """Очередь задач анализа с фиксированным числом потоков-исполнителей"""
     
-    # Проверяем лимиты
-    if not can_analyze(user_id):
-        user = get_user(user_id)
-        plan = PLANS[user['plan']]
-        return jsonify({
-            'success': False,
-            'error': f'❌ Бесплатный лимит исчерпан! Сегодня использовано {user["used_today"]}/{plan["daily_limit"]} анализов.',
-            'upgrade_required': True
-        }), 402
+    def __init__(self, workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE, ttl=JOB_TTL):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(max_queued)
+        self.ttl = ttl
+        self.counters = {'submitted': 0, 'rejected': 0, 'done': 0, 'failed': 0, 'evicted': 0}
+        for i in range(workers):
+            threading.Thread(target=self.worker, name=f'job-{i}', daemon=True).start()
+        print(f"⚙️ Пул задач анализа: {workers} потоков, очередь до {max_queued}, результаты хранятся {ttl} с")
+    
+    def submit(self, func, *args):
+        """Ставит func(*args, progress=...) в очередь. Возвращает id задачи
+        или None, если очередь заполнена. func возвращает (ответ, HTTP-статус)"""
+        now = time.time()
+        job = {'id': uuid.uuid4().hex, 'status': 'queued', 'stage': 'queued',
+               'created': now, 'updated': now, 'response': None, 'http_status': None}
+        with self.lock:
+            self.jobs[job['id']] = job
+        try:
+            self.queue.put_nowait((job, func, args))
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job['id']]
+                self.counters['rejected'] += 1
+            return None
+        with self.lock:
+            self.counters['submitted'] += 1
+        return job['id']
+    
+    def update(self, job, **fields):
+        with self.lock:
+            job.update(fields, updated=time.time())
+    
+    def worker(self):
+        while True:
+            job, func, args = self.queue.get()
+            self.update(job, status='running')
+            try:
+                response, http_status = func(*args, progress=lambda stage: self.update(job, stage=stage))
+            except Exception as e:
+                response, http_status = {'error': f'Ошибка обработки: {str(e)}'}, 500
+            status = 'done' if http_status < 400 else 'failed'
+            self.update(job, status=status, stage=status, response=response, http_status=http_status)
+            with self.lock:
+                self.counters[status] += 1
+            state.scheduler.schedule(time.time() + self.ttl, self.evict, job['id'])
+    
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+    
+    def evict(self, job_id):
+        with self.lock:
+            if self.jobs.pop(job_id, None) is not None:
+                self.counters['evicted'] += 1
+    
+    def stats(self):
+        with self.lock:
+            active = {'queued': 0, 'running': 0}
+            for job in self.jobs.values():
+                if job['status'] in active:
+                    active[job['status']] += 1
+            return {**self.counters, **active, 'stored': len(self.jobs)}
+
+jobs = JobManager()
+
+class UploadRejected(Exception):
+    """Загрузку нельзя проанализировать: готовый ответ клиенту и HTTP-статус"""
+    
+    def __init__(self, response, http_status):
+        super().__init__(response.get('error'))
+        self.response = response
+        self.http_status = http_status
+
+def read_uploads(uploads):
+    """Читает файлы запроса в uploads (в памяти, большие - во временный файл).
+    Список заполняется по ходу, чтобы при ошибке вызывающий мог закрыть прочитанное"""
+    if 'file' not in request.files:
+        raise UploadRejected({'error': 'Файл не загружен'}, 400)
+    
+    # Фото договора можно прислать постранично - несколькими файлами в поле file
+    files = [file for file in request.files.getlist('file') if file.filename != '']
+    if not files:
+        raise UploadRejected({'error': 'Файл не выбран'}, 400)
+    if len(files) > IMAGE_MAX_PAGES:
+        raise UploadRejected({'error': f'Можно загрузить не больше {IMAGE_MAX_PAGES} файлов за раз'}, 400)
     
-    temp_path = None  # Объявляем переменную заранее
+    for file in files:
+        upload = Upload(file)
+        uploads.append(upload)
+        print(f"📥 {file.filename}: {upload.size} байт, тип {upload.kind}, sha256 {upload.sha256[:12]}")
+        if upload.kind is None:
+            raise UploadRejected({'error': f'Неподдерживаемый формат файла {file.filename}. '
+                                           'Загрузите PDF, DOCX, TXT или фото (JPG, PNG, WEBP, TIFF)'}, 400)
+    if len(uploads) > 1 and any(item.kind != 'image' for item in uploads):
+        raise UploadRejected({'error': 'Несколько файлов можно загрузить только как фото страниц одного документа'}, 400)
+
+def extract_uploads_text(uploads, user_id):
+    """Извлекает текст загрузок, тип определяется по содержимому. Отказ - UploadRejected"""
+    filename = ', '.join(upload.filename for upload in uploads)
+    upload = uploads[0]
+    # Длинные документы на тарифах с map-reduce анализом извлекаются дальше первых страниц
+    max_chars = document_char_limit(get_user(user_id)['plan'])
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'Файл не загружен'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'Файл не выбран'}), 400
-        
-        # Сохраняем временный файл
-        temp_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}_{file.filename}")
-        file.save(temp_path)
-        
-        # Извлекаем текст
-        if file.filename.lower().endswith('.pdf'):
-            text = extract_text_from_pdf(temp_path)
-        elif file.filename.lower().endswith('.docx'):
-            text = extract_text_from_docx(temp_path)
-        elif file.filename.lower().endswith('.txt'):
-            with open(temp_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-        elif file.filename.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
+        text = None
+        if upload.kind == 'pdf':
+            # Страницы-сканы распознаются через OCR только на платных тарифах, как и фото
+            user = get_user(user_id)
+            ocr_tier = image_tier(user['plan']) if user['plan'] != 'free' else None
+            text = extract_cached([upload], lambda: extract_text_from_pdf(
+                upload.source(), max_chars, key=upload.sha256, ocr_tier=ocr_tier),
+                variant=ocr_tier and f'ocr-{ocr_tier}', max_chars=max_chars)
+            if ocr_tier is None and len(text.strip()) < 10 and not text.startswith('Ошибка чтения'):
+                raise UploadRejected({
+                    'success': False,
+                    'error': '📸 Похоже, это скан без текстового слоя. Распознавание сканов доступно только для платных тарифов!',
+                    'upgrade_required': True
+                }, 402)
+        elif upload.kind == 'docx':
+            text = extract_cached([upload], lambda: extract_text_from_docx(upload.source(), max_chars),
+                                  max_chars=max_chars)
+        elif upload.kind == 'txt':
+            text = extract_text_from_txt(upload.data(), max_chars)
+        elif upload.kind == 'image':
             # ПРОВЕРЯЕМ ТАРИФ - фото только для платных пользователей!
             user = get_user(user_id)
             
@@ -1742,59 +4793,210 @@ def analyze_document():
             
             if user['plan'] == 'free':
                 logger.info(f"❌ ДЕБАГ: ОТКАЗАНО - пользователь на бесплатном тарифе")
-                return jsonify({
+                raise UploadRejected({
                     'success': False,
                     'error': '📸 Распознавание фото доступно только для платных тарифов!',
                     'upgrade_required': True,
                     'message': '💎 Перейдите на Базовый тариф (199₽/мес) для анализа фото документов'
-                }), 402
+                }, 402)
             
             # Для платных пользователей - распознаем фото
             logger.info(f"✅ ДЕБАГ: Разрешено - пользователь на платном тарифе")
-            logger.info(f"👤 Пользователь {user_id} (тариф: {user['plan']}) загрузил фото")
-            text = extract_text_from_image(temp_path)
+            logger.info(f"👤 Пользователь {user_id} (тариф: {user['plan']}) загрузил фото: {len(uploads)} шт.")
+            tier = image_tier(user['plan'])
+            text = extract_cached(uploads, lambda: extract_text_from_images([item.data() for item in uploads], tier))
             if not text or "Ошибка" in text or len(text.strip()) < 10:
-                return jsonify({'error': f'❌ Не удалось распознать текст с фото. Попробуйте более четкое изображение. Ошибка: {text}'}), 400
-        # Проверяем что текст извлекся
-        if not text or len(text.strip()) < 10:
-            return jsonify({'error': 'Не удалось извлечь текст из файла'}), 400
+                raise UploadRejected({'error': f'❌ Не удалось распознать текст с фото. Попробуйте более четкое изображение. Ошибка: {text}'}, 400)
+    
+    except ExtractionError as e:
+        print(f"💀 Разбор файла {filename} прерван: {e}")
+        raise UploadRejected({
+            'success': False,
+            'error': f'❌ Файл не удалось обработать: {e}. Проверьте, что файл не поврежден, или загрузите его частями'
+        }, 422)
+    
+    # Проверяем что текст извлекся
+    if not text or len(text.strip()) < 10:
+        raise UploadRejected({'error': 'Не удалось извлечь текст из файла'}, 400)
+    return text[:max_chars]
+
+def usage_info(user_id):
+    """Информация о лимитах для ответа на анализ"""
+    user = get_user(user_id)
+    plan = PLANS[user['plan']]
+    return {
+        'used_today': user['used_today'],
+        'daily_limit': plan['daily_limit'],
+        'plan_name': plan['name'],
+        'remaining': plan['daily_limit'] - user['used_today']
+    }
+
+def analyze_uploads(uploads, user_id, real_ip, reservation, progress=lambda stage: None):
+    """Извлекает текст загрузок и анализирует его. Возвращает (ответ, HTTP-статус).
+    Владеет резервом и загрузками: подтверждает или возвращает резерв, закрывает файлы"""
+    try:
+        progress('extracting')
+        text = extract_uploads_text(uploads, user_id)
         
         # Анализируем текст
+        progress('analyzing')
         analysis_result = analyze_text(text, user_id)
         
         print(f"✅ АНАЛИЗ УСПЕШЕН для {user_id}, IP: {real_ip}")
         
-        # Записываем использование
-        record_usage(user_id)
-        
-        # Добавляем информацию о лимитах в ответ
-        user = get_user(user_id)
-        plan = PLANS[user['plan']]
-        analysis_result['usage_info'] = {
-            'used_today': user['used_today'],
-            'daily_limit': plan['daily_limit'],
-            'plan_name': plan['name'],
-            'remaining': plan['daily_limit'] - user['used_today']
-        }
+        # Подтверждаем зарезервированный анализ и добавляем информацию о лимитах в ответ
+        commit_quota(reservation)
+        analysis_result['usage_info'] = usage_info(user_id)
         
-        return jsonify({
+        return {
             'success': True,
-            'filename': file.filename,
+            'filename': ', '.join(upload.filename for upload in uploads),
             'user_id': user_id,
             'result': analysis_result
-        })
+        }, 200
+
+    except UploadRejected as e:
+        return e.response, e.http_status
+
+    except Exception as e:
+        return {'error': f'Ошибка обработки: {str(e)}'}, 500
+
+    finally:
+        # Если анализ не дошел до конца - возвращаем резерв
+        release_quota(reservation)
+        close_uploads(uploads)
+
+def close_uploads(uploads):
+    """Освобождает загрузки (и временные файлы, если они были)"""
+    try:
+        for upload in uploads:
+            upload.close()
+    except Exception as e:
+        print(f"Ошибка при удалении временного файла: {e}")
+
+def quota_exceeded_response(user_id):
+    user = get_user(user_id)
+    plan = PLANS[user['plan']]
+    return jsonify({
+        'success': False,
+        'error': f'❌ Бесплатный лимит исчерпан! Сегодня использовано {user["used_today"]}/{plan["daily_limit"]} анализов.',
+        'upgrade_required': True
+    }), 402
+
+@app.route('/analyze', methods=['POST'])
+def analyze_document():
+    real_ip = get_client_ip()
+    print(f"🔍 Анализ запущен для IP: {real_ip}")
+    # Получаем user_id из формы или используем default
+    user_id = request.form.get('user_id', 'default')
+    run_async = request.args.get('async') == '1'
+    
+    # Резервируем анализ до извлечения текста
+    reservation = reserve_quota(user_id, real_ip)
+    if reservation is None:
+        return quota_exceeded_response(user_id)
+    
+    uploads = []  # Объявляем переменную заранее
+    handed_off = False  # резерв и загрузки переданы analyze_uploads
+    try:
+        read_uploads(uploads)
+        
+        if run_async:
+            # Загрузка уже прочитана - дальше работает пул задач, поток веб-сервера свободен
+            job_id = jobs.submit(analyze_uploads, uploads, user_id, real_ip, reservation)
+            if job_id is None:
+                return jsonify({'success': False, 'error': 'Сервер перегружен, попробуйте через минуту'}), 503
+            handed_off = True
+            print(f"📬 Анализ для {user_id} поставлен в очередь: задача {job_id}")
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+        
+        handed_off = True
+        response, http_status = analyze_uploads(uploads, user_id, real_ip, reservation)
+        return jsonify(response), http_status
+
+    except UploadRejected as e:
+        return jsonify(e.response), e.http_status
 
     except Exception as e:  # ← ДОБАВЬ ЭТУ СТРОКУ
         return jsonify({'error': f'Ошибка обработки: {str(e)}'}), 500
 
     finally:
-        # Удаляем временный файл
-        try:
-            if temp_path and os.path.exists(temp_path):
-                os.unlink(temp_path)
-        except Exception as e:
-            print(f"Ошибка при удалении временного файла: {e}")
-            
+        if not handed_off:
+            # Если анализ не дошел до конца - возвращаем резерв
+            release_quota(reservation)
+            close_uploads(uploads)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_analysis_events(text, user_id, real_ip, reservation, filename):
+    """События SSE для потокового анализа. Резерв подтверждается только после
+    итогового результата - если клиент ушел раньше, он возвращается"""
+    try:
+        for event, data in analyze_text_stream(text, user_id):
+            if event != 'result':
+                yield sse_event(event, data)
+                continue
+            print(f"✅ АНАЛИЗ УСПЕШЕН для {user_id}, IP: {real_ip} (поток)")
+            commit_quota(reservation)
+            data['usage_info'] = usage_info(user_id)
+            yield sse_event('result', {'success': True, 'filename': filename, 'user_id': user_id, 'result': data})
+    except Exception as e:
+        yield sse_event('error', {'success': False, 'error': f'Ошибка обработки: {str(e)}'})
+    finally:
+        release_quota(reservation)
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_document_stream():
+    """Как /analyze, но разделы анализа приходят по мере генерации (Server-Sent Events):
+    meta - тип документа, section - готовый раздел, result - итог как у /analyze, error"""
+    real_ip = get_client_ip()
+    print(f"🔍 Потоковый анализ запущен для IP: {real_ip}")
+    user_id = request.form.get('user_id', 'default')
+    
+    reservation = reserve_quota(user_id, real_ip)
+    if reservation is None:
+        return quota_exceeded_response(user_id)
+    
+    uploads = []
+    handed_off = False  # резерв передан потоку событий
+    try:
+        read_uploads(uploads)
+        text = extract_uploads_text(uploads, user_id)
+        filename = ', '.join(upload.filename for upload in uploads)
+        handed_off = True
+        return Response(stream_analysis_events(text, user_id, real_ip, reservation, filename),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    except UploadRejected as e:
+        return jsonify(e.response), e.http_status
+
+    except Exception as e:
+        return jsonify({'error': f'Ошибка обработки: {str(e)}'}), 500
+
+    finally:
+        if not handed_off:
+            release_quota(reservation)
+        close_uploads(uploads)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Статус асинхронного анализа; у завершенной задачи - ответ, как у /analyze"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Задача не найдена или ее результат уже удален'}), 404
+    
+    result = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'elapsed': round(job['updated'] - job['created'], 1)
+    }
+    if job['response'] is not None:
+        result.update(job['response'], http_status=job['http_status'])
+    return jsonify(result)
+
 # Обновляем endpoint использования
 @app.route('/usage', methods=['GET'])
 def get_usage():
@@ -1838,10 +5040,10 @@ def admin_login():
         if username in ADMINS and ADMINS[username] == password:
             # Создаем сессию
             session_id = secrets.token_hex(16)
-            admin_sessions[session_id] = {
+            state.create_session(session_id, {
                 'username': username,
                 'login_time': datetime.now().isoformat()
-            }
+            })
             response = jsonify({'success': True, 'session_id': session_id})
             response.set_cookie('admin_session', session_id, httponly=True)
             return response
@@ -1902,7 +5104,7 @@ def require_admin_auth(f):
     def decorated_function(*args, **kwargs):
         session_id = request.cookies.get('admin_session')
         
-        if not session_id or session_id not in admin_sessions:
+        if not session_id or state.get_session(session_id) is None:
             return jsonify({'error': 'Требуется авторизация'}), 401
         
         return f(*args, **kwargs)
@@ -1913,7 +5115,7 @@ def require_admin_auth(f):
 def admin_panel():
     """Защищенная админ-панель"""
     session_id = request.cookies.get('admin_session')
-    admin_info = admin_sessions.get(session_id, {})
+    admin_info = state.get_session(session_id) or {}
     
     return """
     <!DOCTYPE html>
@@ -2086,21 +5288,27 @@ def admin_panel():
 @require_admin_auth
 def admin_stats():
     """Статистика для админ-панели"""
-    total_users = len(users_db)
-    total_analyses = sum(user['total_used'] for user in users_db.values())
-    today_analyses = sum(user['used_today'] for user in users_db.values())
+    total_users, total_analyses, today_analyses = state.user_stats()
     
     return jsonify({
         'total_users': total_users,
         'total_analyses': total_analyses,
-        'today_analyses': today_analyses
+        'today_analyses': today_analyses,
+        'tracked_ips': state.tracked_ips(),
+        'extractor_restarts': extractor_pool.restarts,
+        'cache': {'text': text_cache.stats(), 'analysis': analysis_cache.stats()},
+        'near_duplicates': near_duplicates.stats(),
+        'ocr': ocr_stats_summary(),
+        'upstream': upstream.stats(),
+        'jobs': jobs.stats(),
+        'tokens': token_stats_summary()
     })
 
 @app.route('/admin/users')
 @require_admin_auth
 def get_all_users():
     """Получить всех пользователей"""
-    return jsonify(users_db)
+    return jsonify(state.all_users())
 
 @app.route('/admin/set-plan', methods=['POST'])
 @require_admin_auth
@@ -2114,15 +5322,12 @@ def admin_set_plan():
         if not user_id:
             return jsonify({'success': False, 'error': 'Укажите ID пользователя'})
         
-        if user_id not in users_db:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         if plan not in PLANS:
             return jsonify({'success': False, 'error': 'Неверный тариф'})
         
-        # Обновляем тариф
-        users_db[user_id]['plan'] = plan
-        users_db[user_id]['used_today'] = 0  # Сбрасываем дневной лимит
+        # Обновляем тариф и сбрасываем дневной лимит
+        if state.update_user(user_id, plan=plan, used_today=0) is None:
+            return jsonify({'success': False, 'error': 'Пользователь не найден'})
         
         return jsonify({
             'success': True,
@@ -2144,18 +5349,18 @@ def admin_create_user():
         if not user_id:
             user_id = generate_user_id()
         
-        if user_id in users_db:
-            return jsonify({'success': False, 'error': 'Пользователь уже существует'})
-        
         # Создаем пользователя
-        users_db[user_id] = {
+        created = state.create_user({
             'user_id': user_id,
             'plan': 'free',
             'used_today': 0,
             'last_reset': date.today().isoformat(),
             'total_used': 0,
-            'created_at': datetime.now().isoformat()
-        }
+            'created_at': datetime.now().isoformat(),
+            'plan_expires': None
+        })
+        if not created:
+            return jsonify({'success': False, 'error': 'Пользователь уже существует'})
         
         return jsonify({
             'success': True,
@@ -2544,17 +5749,14 @@ def activate_plan(user_id, plan_type='basic'):
         if plan_type not in PLANS:
             return {'success': False, 'error': 'Неверный тариф'}
         
-        user = get_user(user_id)
+        get_user(user_id)
         
         # Устанавливаем тариф на 30 дней
         from datetime import timedelta
         expire_date = date.today() + timedelta(days=30)
         
-        user['plan'] = plan_type
-        user['plan_expires'] = expire_date.isoformat()
-        user['used_today'] = 0  # Сбрасываем дневной лимит
-        
-        save_users()
+        # Сбрасываем дневной лимит
+        state.update_user(user_id, plan=plan_type, plan_expires=expire_date.isoformat(), used_today=0)
         
         print(f"🎉 Активирован тариф {plan_type} для пользователя {user_id} до {expire_date}")
         
@@ -2578,8 +5780,8 @@ def upgrade_plan():
         
         logger.info(f"🔄 СМЕНА ТАРИФА: user_id={user_id}, новый план={new_plan}")
         
-        user = get_user(user_id)
-        user['plan'] = new_plan
+        get_user(user_id)
+        user = state.update_user(user_id, plan=new_plan)
         
         logger.info(f"✅ ТАРИФ ИЗМЕНЕН: user_id={user_id}, теперь план={user['plan']}")
         
@@ -2613,7 +5815,8 @@ def debug_ip():
         'remote_addr': request.remote_addr,
         'x_forwarded_for': request.headers.get('X-Forwarded-For'),
         'x_real_ip': request.headers.get('X-Real-IP'),
-        'real_ip_detected': get_client_ip()
+        'real_ip_detected': get_client_ip(),
+        'free_analysis_available': can_analyze_by_ip(get_client_ip())
     })
 
 if __name__ == '__main__':
@@ -2623,6 +5826,10 @@ if __name__ == '__main__':
     print("👤 Индивидуальные ID пользователей: Активны")
     print("💰 Бесплатный лимит: 1 анализ в день")
     
+    # Render останавливает сервер через SIGTERM - выходим штатно,
+    # чтобы atexit успел сбросить отложенные изменения
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
     # Для продакшена на Render
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
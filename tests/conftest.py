@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# server.py читает настройки при импорте, поэтому окружение готовится заранее
+TEST_DIR = tempfile.mkdtemp(prefix='docscan-test-')
+os.environ.setdefault('DOCSCAN_SQLITE_DB', os.path.join(TEST_DIR, 'docscan.db'))
+os.environ.setdefault('DOCSCAN_CACHE_DIR', os.path.join(TEST_DIR, 'cache'))
+os.environ.setdefault('EXTRACTOR_WORKERS', '1')
+# Бюджет заметно меньше размера самого процесса сервера
+os.environ.setdefault('EXTRACT_MEMORY_LIMIT_MB', '32')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(params=['local', 'redis'])
+def state(request, tmp_path, monkeypatch):
+    """Оба варианта общего состояния: те же проверки должны проходить и в памяти, и в Redis"""
+    import server
+    if request.param == 'local':
+        monkeypatch.setattr(server, 'SQLITE_DB_FILE', str(tmp_path / 'state.db'))
+        return server.LocalState()
+    # Без fakeredis проверяется только локальный вариант
+    fakeredis = pytest.importorskip('fakeredis')
+    import redis
+    fake_server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url',
+                        lambda url, **kwargs: fakeredis.FakeRedis(server=fake_server, **kwargs))
+    return server.RedisState('redis://fake')
@@ -0,0 +1,34 @@
+import server
+
+CLAUSES = ''.join(f'Пункт {i}. Арендатор вносит плату и соблюдает условие номер {i} договора. '
+                  for i in range(1, 41))
+
+
+def ai_result(marker):
+    result = server.create_fallback_analysis('lease', 'test')
+    result['ai_used'] = True
+    result['marker'] = marker
+    return result
+
+
+def test_analysis_cache_is_keyed_by_output_cap():
+    text = 'Договор аренды квартиры. ' + CLAUSES
+    result, cache_key, fingerprint = server.lookup_analysis(text, 'lease', 'free')
+    assert result is None
+    server.store_analysis(cache_key, fingerprint, ai_result('free'))
+
+    # Ответ, обрезанный потолком бесплатного тарифа, платному не достается
+    assert server.plan_output_cap('free') < server.plan_output_cap('premium')
+    result, _, _ = server.lookup_analysis(text, 'lease', 'premium')
+    assert result is None
+    result, _, _ = server.lookup_analysis(text, 'lease', 'free')
+    assert result['marker'] == 'free'
+
+
+def test_near_duplicate_is_keyed_by_output_cap():
+    _, cache_key, fingerprint = server.lookup_analysis('Договор аренды дома. ' + CLAUSES, 'lease', 'basic')
+    server.store_analysis(cache_key, fingerprint, ai_result('basic'))
+    result, _, _ = server.lookup_analysis('Договор аренды дачи. ' + CLAUSES, 'lease', 'premium')
+    assert result is None
+    result, _, _ = server.lookup_analysis('Договор аренды дачи. ' + CLAUSES, 'lease', 'basic')
+    assert result['marker'] == 'basic'
@@ -0,0 +1,29 @@
+import server
+
+
+def test_unbroken_long_token():
+    text = 'я' * 1000
+    chunks = server.split_into_chunks(text, max_chars=300)
+    assert ''.join(chunks) == text
+    assert all(len(chunk) <= 300 for chunk in chunks)
+
+
+def test_long_line_ending_with_separator():
+    text = 'а' * 500 + '\n'
+    chunks = server.split_into_chunks(text, max_chars=100)
+    assert ''.join(chunks).strip() == text.strip()
+    assert all(len(chunk) <= 100 for chunk in chunks)
+
+
+def test_long_paragraph_ending_with_separator():
+    text = 'Стороны договорились. ' * 40 + '\n\n'
+    chunks = server.split_into_chunks(text, max_chars=200)
+    assert ''.join(chunks).strip() == text.strip()
+    assert all(len(chunk) <= 200 for chunk in chunks)
+
+
+def test_clauses_are_kept_whole():
+    text = '1. Предмет договора.\n' + 'х' * 50 + '\n2. Оплата.\n' + 'у' * 50 + '\n'
+    chunks = server.split_into_chunks(text, max_chars=80)
+    assert ''.join(chunks).strip() == text.strip()
+    assert chunks[1].startswith('2. Оплата')
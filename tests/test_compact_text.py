@@ -0,0 +1,13 @@
+import server
+
+
+def test_table_cells_survive_compaction():
+    # Так PyPDF2 отдает таблицу: каждая ячейка отдельной строкой
+    text = ('Спецификация\nНаименование\nКол-во\nЦена\n'
+            'Стол\n12\n4500\nСтул\n48\n1200\n'
+            '- 2 -\nСтр. 3 из 10\n')
+    compacted = server.compact_text(text).split('\n')
+    for cell in ('12', '4500', '48', '1200'):
+        assert cell in compacted
+    assert '- 2 -' not in compacted
+    assert 'Стр. 3 из 10' not in compacted
@@ -0,0 +1,66 @@
+import io
+import zipfile
+
+import docx
+import pytest
+
+import server
+
+
+def contract_docx():
+    document = docx.Document()
+    document.sections[0].header.paragraphs[0].text = 'ООО «Поставщик» - Договор поставки'
+    document.sections[0].footer.paragraphs[0].text = 'Подписи сторон'
+    document.add_paragraph('1. Поставщик передает Покупателю товар.')
+    table = document.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = 'Сумма'
+    table.cell(0, 1).text = '1 200 000 руб.'
+    table.cell(1, 0).text = 'Срок оплаты'
+    table.cell(1, 1).text = '10 банковских дней'
+    document.add_paragraph('2. Покупатель оплачивает товар.')
+    out = io.BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def test_tables_are_read_row_by_row():
+    lines = server.extract_text_from_docx(contract_docx()).splitlines()
+    assert lines[:4] == ['1. Поставщик передает Покупателю товар.', 'Сумма | 1 200 000 руб.',
+                         'Срок оплаты | 10 банковских дней', '2. Покупатель оплачивает товар.']
+
+
+def test_headers_and_footers_follow_body():
+    lines = server.extract_text_from_docx(contract_docx()).splitlines()
+    assert lines[4:] == ['ООО «Поставщик» - Договор поставки', 'Подписи сторон']
+
+
+def test_reading_stops_at_budget():
+    document = docx.Document()
+    for i in range(500):
+        document.add_paragraph(f'Пункт {i}')
+    out = io.BytesIO()
+    document.save(out)
+    text = server.extract_text_from_docx(out.getvalue(), max_chars=50)
+    assert len(text) == 50
+    assert text.startswith('Пункт 0\nПункт 1\n')
+
+
+def test_zip_bomb_is_rejected():
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('word/document.xml', '<w:document>' + ' ' * (16 * 1024 * 1024) + '</w:document>')
+    with pytest.raises(server.ExtractionError):
+        server.extract_text_from_docx(out.getvalue())
+
+
+def test_archive_without_document_is_an_error():
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w') as archive:
+        archive.writestr('readme.txt', 'not a document')
+    assert server.extract_text_from_docx(out.getvalue()).startswith('Ошибка чтения DOCX')
+
+
+def test_spooled_upload_is_read_from_path(tmp_path):
+    path = tmp_path / 'contract.docx'
+    path.write_bytes(contract_docx())
+    assert server.extract_text_from_docx(str(path)).startswith('1. Поставщик передает Покупателю товар.')
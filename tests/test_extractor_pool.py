@@ -0,0 +1,138 @@
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+import docx
+
+import server
+
+
+def text_pdf(lines):
+    """Минимальный PDF с текстовым слоем: по странице на строку"""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None,
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for line in lines:
+        stream = f'BT /F1 12 Tf 20 100 Td ({line}) Tj ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 300 200] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1')
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    out += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('latin-1')
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1')
+    return out
+
+
+def test_pdf_extraction_fits_memory_budget(tmp_path):
+    # Лимит памяти отсчитывается от размера воркера, унаследованного от сервера
+    path = tmp_path / 'contract.pdf'
+    # Сотни страниц - разбор требует свежей памяти, а не остатков кучи сервера
+    path.write_bytes(text_pdf(['Lease agreement'] + [f'Clause {i}' for i in range(1, 300)]))
+    text = server.extract_text_from_pdf(str(path))
+    assert 'Lease agreement' in text
+    assert 'Clause 100' in text
+
+
+def test_docx_extraction_fits_memory_budget(tmp_path):
+    document = docx.Document()
+    document.add_paragraph('Договор поставки оборудования')
+    for i in range(2000):
+        document.add_paragraph(f'Пункт {i}: поставщик передает покупателю оборудование')
+    path = tmp_path / 'contract.docx'
+    document.save(str(path))
+    assert 'Договор поставки оборудования' in server.extract_text_from_docx(path.read_bytes())
+
+
+def memory_headroom():
+    """Выполняется в воркере: сколько байт адресного пространства осталось до лимита"""
+    soft, _ = resource.getrlimit(resource.RLIMIT_AS)
+    return soft - server.process_vm_size()
+
+
+def test_limit_counts_from_worker_size(monkeypatch):
+    monkeypatch.setitem(server.EXTRACTORS, 'memory_headroom', memory_headroom)
+    pool = server.ExtractorPool(workers=1)
+    budget = server.EXTRACT_MEMORY_LIMIT_MB * 1024 * 1024
+    assert pool.run('memory_headroom') > budget // 2
+
+
+def test_dead_worker_is_replaced_from_template(tmp_path):
+    path = tmp_path / 'contract.pdf'
+    path.write_bytes(text_pdf(['Replacement worker']))
+    worker = server.extractor_pool.workers[0]
+    os.kill(worker.pid, signal.SIGKILL)
+    worker.conn.poll(5)
+    assert 'Replacement worker' in server.extract_text_from_pdf(str(path))
+    with open(f'/proc/{worker.pid}/stat') as file:
+        parent = int(file.read().rsplit(')', 1)[1].split()[1])
+    assert parent == server.extractor_pool.template.process.pid
+
+
+# Сервер в отдельном процессе: считает потоки в момент первого форка и умирает по SIGKILL
+SERVER_SCRIPT = """
+import os, signal, threading
+threads = []
+fork = os.fork
+def counting_fork():
+    threads.append(threading.active_count())
+    return fork()
+os.fork = counting_fork
+import server
+print(threads[0], server.extractor_pool.template.process.pid, server.extractor_pool.workers[0].pid, flush=True)
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+
+def process_exited(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            return file.read().rsplit(')', 1)[1].split()[0] == 'Z'
+    except FileNotFoundError:
+        return True
+
+
+def test_template_forks_before_threads_and_exits_with_server(tmp_path):
+    env = dict(os.environ, DOCSCAN_SQLITE_DB=str(tmp_path / 'docscan.db'), DOCSCAN_CACHE_DIR=str(tmp_path / 'cache'))
+    output = subprocess.run([sys.executable, '-c', SERVER_SCRIPT], cwd=os.path.dirname(server.__file__),
+                            env=env, capture_output=True, text=True, timeout=60).stdout
+    threads, template_pid, worker_pid = map(int, output.split()[-3:])
+    assert threads == 1
+    deadline = time.time() + 5
+    while not (process_exited(template_pid) and process_exited(worker_pid)) and time.time() < deadline:
+        time.sleep(0.1)
+    assert process_exited(template_pid)
+    assert process_exited(worker_pid)
+
+
+def test_parallel_pdf_from_memory_is_sent_once(monkeypatch):
+    monkeypatch.setattr(server, 'PDF_WORKERS', 2)
+    monkeypatch.setattr(server, 'PDF_PARALLEL_MIN_BYTES', 0)
+    monkeypatch.setattr(server, 'PDF_PAGES_PER_TASK', 4)
+    tasks = []
+    submit = server.extractor_pool.submit
+
+    def recording_submit(name, *args, payload=None):
+        tasks.append((name, args[0], payload))
+        return submit(name, *args, payload=payload)
+    monkeypatch.setattr(server.extractor_pool, 'submit', recording_submit)
+
+    data = text_pdf([f'Clause {i}' for i in range(40)])
+    text = server.extract_text_from_pdf(data)
+    assert 'Clause 0' in text and 'Clause 39' in text
+    # Содержимое записано во временный файл один раз, задачи получают только путь
+    assert len([task for task in tasks if task[0] == 'pdf_pages']) == 10
+    assert all(payload is None for _, _, payload in tasks)
+    paths = {path for _, path, _ in tasks}
+    assert len(paths) == 1
+    assert not os.path.exists(paths.pop())
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+import server
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def test_full_queue_rejects_job():
+    manager = server.JobManager(workers=1, max_queued=1)
+    release = threading.Event()
+
+    def blocking(progress):
+        release.wait(5)
+        return {'success': True}, 200
+
+    running = manager.submit(blocking)
+    assert wait_for(lambda: manager.get(running)['status'] == 'running')
+    queued = manager.submit(blocking)
+    assert queued is not None
+    assert manager.submit(blocking) is None
+    stats = manager.stats()
+    assert stats['rejected'] == 1
+    assert stats['running'] == 1 and stats['queued'] == 1
+    release.set()
+    assert wait_for(lambda: manager.get(queued)['status'] == 'done')
+
+
+def test_finished_job_is_evicted_after_ttl():
+    manager = server.JobManager(workers=1, ttl=0.2)
+    job_id = manager.submit(lambda progress: ({'success': True}, 200))
+    assert wait_for(lambda: manager.get(job_id)['status'] == 'done')
+    assert wait_for(lambda: manager.get(job_id) is None)
+    assert manager.stats()['evicted'] == 1
+
+
+def test_job_endpoint_reports_progress_and_result(client, monkeypatch):
+    manager = server.JobManager(workers=1)
+    monkeypatch.setattr(server, 'jobs', manager)
+    release = threading.Event()
+
+    def analysis(progress):
+        progress('analyzing')
+        release.wait(5)
+        return {'success': True, 'result': {'summary': 'ok'}}, 200
+
+    job_id = manager.submit(analysis)
+    assert wait_for(lambda: manager.get(job_id)['stage'] == 'analyzing')
+    body = client.get(f'/jobs/{job_id}').get_json()
+    assert body['status'] == 'running' and body['stage'] == 'analyzing'
+    assert 'result' not in body
+    release.set()
+    assert wait_for(lambda: manager.get(job_id)['status'] == 'done')
+    body = client.get(f'/jobs/{job_id}').get_json()
+    assert body['result'] == {'summary': 'ok'}
+    assert body['http_status'] == 200
+
+
+def test_failed_job_keeps_error(client, monkeypatch):
+    manager = server.JobManager(workers=1)
+    monkeypatch.setattr(server, 'jobs', manager)
+
+    def failing(progress):
+        raise RuntimeError('сбой')
+
+    job_id = manager.submit(failing)
+    assert wait_for(lambda: manager.get(job_id)['status'] == 'failed')
+    body = client.get(f'/jobs/{job_id}').get_json()
+    assert body['http_status'] == 500
+    assert 'сбой' in body['error']
+
+
+def test_unknown_job_is_not_found(client):
+    response = client.get('/jobs/unknown')
+    assert response.status_code == 404
+    assert response.get_json()['success'] is False
@@ -0,0 +1,33 @@
+import os
+
+import server
+
+
+def new_user(user_id, total_used):
+    return {'user_id': user_id, 'plan': 'free', 'used_today': 0, 'total_used': total_used,
+            'last_reset': '2026-01-01'}
+
+
+def test_repeated_failed_compaction_keeps_old_journal(tmp_path, monkeypatch):
+    journal = str(tmp_path / 'users.journal')
+    monkeypatch.setattr(server, 'USER_JOURNAL_FILE', journal)
+    # Каталога снапшота нет - запись снапшота падает после ротации журнала
+    monkeypatch.setattr(server, 'USER_DB_FILE', str(tmp_path / 'missing' / 'users.json'))
+    storage = server.JournalStorage()
+
+    storage.put_users([new_user('first', 1)])
+    storage.compact()
+    assert os.path.exists(journal + '.old')
+    storage.put_users([new_user('second', 2)])
+    storage.compact()
+
+    data, _ = server.read_json_users()
+    assert data['first']['total_used'] == 1
+    assert data['second']['total_used'] == 2
+
+    monkeypatch.setattr(server, 'USER_DB_FILE', str(tmp_path / 'users.json'))
+    storage.put_users([new_user('third', 3)])
+    storage.compact()
+    assert not os.path.exists(journal + '.old')
+    data, _ = server.read_json_users()
+    assert {'first', 'second', 'third'} <= set(data)
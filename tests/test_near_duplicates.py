@@ -0,0 +1,79 @@
+import pytest
+
+import server
+
+CLAUSES = ''.join(f'Пункт {i}. Стороны обязуются соблюдать условие номер {i} настоящего договора '
+                  f'и уведомлять друг друга об изменениях в течение {i} рабочих дней. ' for i in range(1, 41))
+TEMPLATE = ('Договор аренды квартиры. Арендодатель {name} передает арендатору квартиру '
+            'за плату {sum} рублей в месяц до {date}. ') + CLAUSES.replace('{', '{{').replace('}', '}}')
+
+
+@pytest.fixture(autouse=True)
+def near_duplicates(monkeypatch):
+    # Свой индекс на тест: похожим не должен оказаться документ из другого теста
+    monkeypatch.setattr(server, 'near_duplicates', server.NearDuplicateIndex())
+
+
+def ai_result(name, sum, date):
+    result = server.create_fallback_analysis('lease', 'test')
+    result['ai_used'] = True
+    result['executive_summary']['quick_facts'] = [f'Арендодатель: {name}', f'Плата: {sum} руб. до {date}']
+    return result
+
+
+def analyze(text, **facts):
+    result, cache_key, fingerprint = server.lookup_analysis(text, 'lease')
+    if result is None:
+        result = ai_result(**facts)
+        server.store_analysis(cache_key, fingerprint, result)
+    return result
+
+
+def test_near_duplicate_analysis_is_patched_with_new_names_and_numbers():
+    analyze(TEMPLATE.format(name='Иванов', sum='50000', date='01.01.2026'),
+            name='Иванов', sum='50 000', date='01.01.2026')
+    result = analyze(TEMPLATE.format(name='Петров', sum='65000', date='01.03.2026'))
+    assert 'near_duplicate' in result
+    facts = result['executive_summary']['quick_facts']
+    assert 'Арендодатель: Петров' in facts
+    assert 'Плата: 65000 руб. до 01.03.2026' in facts
+    assert 'Иванов' not in str(result) and '50 000' not in str(result)
+
+
+def test_analysis_with_other_word_form_is_not_reused():
+    analyze(TEMPLATE.format(name='Сидоров', sum='70000', date='01.02.2026'),
+            name='Сидорову', sum='70000', date='01.02.2026')
+    result = analyze(TEMPLATE.format(name='Смирнов', sum='70000', date='01.02.2026'),
+                     name='Смирнов', sum='70000', date='01.02.2026')
+    assert 'near_duplicate' not in result
+
+
+def test_inserted_clause_is_not_patched():
+    base = TEMPLATE.format(name='Козлов', sum='30000', date='01.03.2026')
+    analyze(base, name='Козлов', sum='30000', date='01.03.2026')
+    extended = base.replace('Пункт 7.', 'Пункт 7. Животные в квартире запрещены.')
+    result = analyze(extended, name='Козлов', sum='30000', date='01.03.2026')
+    assert 'near_duplicate' not in result
+
+
+def test_replaced_token_still_present_elsewhere_is_not_patched():
+    # 10 заменено на 12 в сумме, но осталось в тексте пунктов - в анализе не понять, о каком речь
+    base = TEMPLATE.format(name='Орлов', sum='10', date='01.04.2026')
+    analyze(base, name='Орлов', sum='10', date='01.04.2026')
+    result = analyze(TEMPLATE.format(name='Орлов', sum='12', date='01.04.2026'),
+                     name='Орлов', sum='12', date='01.04.2026')
+    assert 'near_duplicate' not in result
+
+
+def test_patched_analysis_is_cached_for_exact_text():
+    analyze(TEMPLATE.format(name='Волков', sum='20000', date='01.05.2026'),
+            name='Волков', sum='20000', date='01.05.2026')
+    text = TEMPLATE.format(name='Зайцев', sum='20000', date='01.05.2026')
+    assert 'near_duplicate' in analyze(text)
+    result, _, _ = server.lookup_analysis(text, 'lease')
+    assert 'Арендодатель: Зайцев' in result['executive_summary']['quick_facts']
+
+
+def test_document_patch_pairs_tokens():
+    assert server.document_patch('Иванов платит 100 руб.', 'Петров платит 200 руб.') == {'Иванов': 'Петров', '100': '200'}
+    assert server.document_patch('Иванов платит 100 руб.', 'Петров Иван платит 100 руб.') is None
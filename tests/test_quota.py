@@ -0,0 +1,86 @@
+import threading
+import uuid
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def quota_state(state, monkeypatch):
+    monkeypatch.setattr(server, 'state', state)
+    return state
+
+
+def basic_user(state):
+    user_id = 'quota-' + uuid.uuid4().hex
+    server.get_user(user_id)
+    state.update_user(user_id, plan='basic')
+    return user_id
+
+
+def reserve_concurrently(requests):
+    """Запускает резервирования (пользователь, IP) разом, возвращает число успешных"""
+    barrier = threading.Barrier(len(requests))
+    results = []
+
+    def reserve(user_id, ip_address):
+        barrier.wait()
+        results.append(server.reserve_quota(user_id, ip_address))
+
+    threads = [threading.Thread(target=reserve, args=request) for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(result is not None for result in results)
+
+
+def test_concurrent_reservations_stop_at_daily_limit(quota_state):
+    user_id = basic_user(quota_state)
+    limit = server.PLANS['basic']['daily_limit']
+    assert reserve_concurrently([(user_id, '127.0.0.1')] * (limit * 3)) == limit
+    assert quota_state.get_user(user_id)['used_today'] == limit
+
+
+def test_concurrent_reservations_stop_at_ip_limit(quota_state, monkeypatch):
+    monkeypatch.setitem(server.IP_RATE_RULES, 'basic', {'capacity': 3, 'period': 3600})
+    requests = [(basic_user(quota_state), '203.0.113.7') for _ in range(8)]
+    assert reserve_concurrently(requests) == 3
+
+
+class FailingUpload:
+    filename = 'contract.pdf'
+
+    def close(self):
+        pass
+
+
+def test_upstream_failure_refunds_reservation(quota_state, monkeypatch):
+    monkeypatch.setitem(server.IP_RATE_RULES, 'basic', {'capacity': 1, 'period': 3600})
+    user_id = basic_user(quota_state)
+    reservation = server.reserve_quota(user_id, '198.51.100.9')
+    assert quota_state.get_user(user_id)['used_today'] == 1
+    assert server.reserve_quota(user_id, '198.51.100.9') is None
+
+    def failing_analysis(text, user_id):
+        raise server.YandexGPTError('Ошибка YandexGPT: 503')
+    monkeypatch.setattr(server, 'extract_uploads_text', lambda uploads, user_id: 'Договор аренды')
+    monkeypatch.setattr(server, 'analyze_text', failing_analysis)
+    response, status = server.analyze_uploads([FailingUpload()], user_id, '198.51.100.9', reservation)
+    assert status == 500
+    assert quota_state.get_user(user_id)['used_today'] == 0
+    assert quota_state.get_user(user_id)['total_used'] == 0
+    # И анализ пользователя, и токен IP возвращены - следующий запрос проходит
+    assert server.reserve_quota(user_id, '198.51.100.9') is not None
+
+
+def test_release_after_commit_is_noop(quota_state):
+    user_id = 'quota-' + uuid.uuid4().hex
+    server.get_user(user_id)
+    reservation = server.reserve_quota(user_id, '127.0.0.1')
+    server.commit_quota(reservation)
+    server.release_quota(reservation)
+    user = quota_state.get_user(user_id)
+    assert user['used_today'] == 1
+    assert user['total_used'] == 1
@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import time
+from datetime import date, timedelta
+
+import server
+
+
+def test_idle_bucket_expires():
+    limiter = server.RateLimiter(max_keys=10)
+    assert limiter.try_acquire('free|203.0.113.1', 1, 0.2)
+    assert not limiter.try_acquire('free|203.0.113.1', 1, 0.2)
+    assert len(limiter) == 1
+    time.sleep(0.3)
+    # Истекшая корзина удаляется при следующем обращении к лимитеру
+    assert limiter.try_acquire('free|203.0.113.2', 1, 0.2)
+    assert len(limiter) == 1
+    assert limiter.try_acquire('free|203.0.113.1', 1, 0.2)
+
+
+def test_least_recently_used_bucket_is_evicted():
+    limiter = server.RateLimiter(max_keys=3)
+    for i in range(3):
+        assert limiter.try_acquire(f'free|198.51.100.{i}', 1, 3600)
+    # Обращение переносит ключ в конец очереди - вытесняется следующий по давности
+    limiter.available('free|198.51.100.0', 1, 3600)
+    assert limiter.try_acquire('free|198.51.100.3', 1, 3600)
+    assert len(limiter) == 3
+    assert not limiter.try_acquire('free|198.51.100.0', 1, 3600)
+    # Вытесненный ключ начинает с полной корзины
+    assert limiter.try_acquire('free|198.51.100.1', 1, 3600)
+
+
+def test_persisted_buckets_skip_expired(tmp_path):
+    path = str(tmp_path / 'limits.json')
+    limiter = server.RateLimiter(persist_path=path, persist_interval=3600)
+    assert limiter.try_acquire('free|192.0.2.1', 1, 3600)
+    assert limiter.try_acquire('free|192.0.2.2', 1, 0.1)
+    limiter.save()
+    time.sleep(0.2)
+    restored = server.RateLimiter(persist_path=path, persist_interval=3600)
+    assert len(restored) == 1
+    assert not restored.try_acquire('free|192.0.2.1', 1, 3600)
+
+
+def test_old_ip_limits_are_migrated(tmp_path, monkeypatch):
+    today = date.today().isoformat()
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    json_path = tmp_path / 'docscan_ip_limits.json'
+    json_path.write_text(json.dumps({
+        '203.0.113.10': {'used_today': 1, 'last_reset': today, 'first_seen': today},
+        '203.0.113.11': {'used_today': 1, 'last_reset': yesterday, 'first_seen': yesterday},
+    }))
+    db_path = str(tmp_path / 'state.db')
+    with sqlite3.connect(db_path) as db:
+        db.execute("CREATE TABLE ip_limits (ip TEXT PRIMARY KEY, used_today INTEGER NOT NULL DEFAULT 0, "
+                   "last_reset TEXT NOT NULL, first_seen TEXT)")
+        db.execute("INSERT INTO ip_limits VALUES ('203.0.113.12', 1, ?, ?)", (today, today))
+    monkeypatch.setattr(server, 'IP_LIMITS_FILE', str(json_path))
+    monkeypatch.setattr(server, 'SQLITE_DB_FILE', db_path)
+
+    state = server.LocalState()
+    rule = server.get_ip_rule('free')
+    assert not state.try_acquire_ip('free|203.0.113.10', *rule)
+    assert not state.try_acquire_ip('free|203.0.113.12', *rule)
+    assert state.try_acquire_ip('free|203.0.113.11', *rule)
+    assert not json_path.exists()
+    with sqlite3.connect(db_path) as db:
+        assert not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'ip_limits'").fetchone()
@@ -0,0 +1,114 @@
+import functools
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+
+import pytest
+
+import server
+
+
+class FakeClock:
+    """Часы, которые идут только по команде теста"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_scheduler_runs_tasks_by_injected_clock():
+    clock = FakeClock(1000.0)
+    scheduler = server.Scheduler('test-scheduler', clock=clock)
+    done = []
+    all_done = threading.Event()
+    scheduler.schedule(1010.0, done.append, 'second')
+    scheduler.schedule(1005.0, done.append, 'first')
+    scheduler.schedule(1020.0, lambda: all_done.set())
+    scheduler.schedule(900.0, done.append, 'overdue')
+    assert wait_for(lambda: done == ['overdue'])
+
+    # Реальное время идет, а подменные часы стоят - сроки не наступают
+    time.sleep(0.1)
+    assert done == ['overdue']
+    assert len(scheduler) == 3
+
+    clock.now = 1015.0
+    scheduler.wake()
+    assert wait_for(lambda: len(done) == 3)
+    assert done == ['overdue', 'first', 'second']
+    assert not all_done.is_set()
+    clock.now = 1020.0
+    scheduler.wake()
+    assert all_done.wait(5)
+
+
+def test_scheduler_survives_failing_task():
+    clock = FakeClock(0.0)
+    scheduler = server.Scheduler('test-scheduler', clock=clock)
+    done = threading.Event()
+    scheduler.schedule(1.0, lambda: 1 / 0)
+    scheduler.schedule(2.0, done.set)
+    clock.now = 2.0
+    scheduler.wake()
+    assert done.wait(5)
+
+
+@pytest.fixture
+def clocked_state(tmp_path, monkeypatch):
+    """LocalState, у которого и планировщик, и текущая дата идут по подменным часам"""
+    clock = FakeClock(time.time())
+    monkeypatch.setattr(server, 'SQLITE_DB_FILE', str(tmp_path / 'state.db'))
+    monkeypatch.setattr(server, 'Scheduler', functools.partial(server.Scheduler, clock=clock))
+    monkeypatch.setattr(server, 'today_number', lambda: date.fromtimestamp(clock()).toordinal())
+    return server.LocalState(), clock
+
+
+def new_user(state, **fields):
+    user = {'user_id': uuid.uuid4().hex, 'plan': 'free', 'used_today': 0,
+            'last_reset': date.today().isoformat(), 'total_used': 0,
+            'created_at': '2024-01-01T00:00:00', 'plan_expires': None}
+    user.update(fields)
+    assert state.create_user(user)
+    return user['user_id']
+
+
+def test_midnight_reset_and_plan_expiry(clocked_state):
+    state, clock = clocked_state
+    today = date.today()
+    used = new_user(state, used_today=3)
+    expiring = new_user(state)
+    extended = new_user(state)
+    state.update_user(expiring, plan='premium', plan_expires=today.isoformat())
+    state.update_user(extended, plan='basic', plan_expires=today.isoformat())
+    state.update_user(extended, plan_expires=(today + timedelta(days=30)).isoformat())
+
+    # За секунду до полуночи ничего не меняется
+    clock.now = server.day_start(today.toordinal() + 1) - 1
+    state.scheduler.wake()
+    time.sleep(0.1)
+    assert state.get_user(used)['used_today'] == 3
+    assert state.get_user(expiring)['plan'] == 'premium'
+
+    # Тариф действует по день окончания включительно и снимается в полночь
+    clock.now = server.day_start(today.toordinal() + 1) + 1
+    state.scheduler.wake()
+    tomorrow = (today + timedelta(days=1)).isoformat()
+    assert wait_for(lambda: state.get_user(used)['last_reset'] == tomorrow)
+    assert state.get_user(used)['used_today'] == 0
+    assert wait_for(lambda: state.get_user(expiring)['plan'] == 'free')
+    assert state.get_user(expiring)['plan_expires'] is None
+    # Продленный тариф задача со старой датой не трогает
+    assert state.get_user(extended)['plan'] == 'basic'
+    # Следующий сброс поставлен на следующую полночь
+    next_midnight = server.day_start(today.toordinal() + 2)
+    assert wait_for(lambda: min(task[0] for task in list(state.scheduler.heap)) == next_midnight)
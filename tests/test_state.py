@@ -0,0 +1,117 @@
+import time
+import uuid
+from datetime import date, timedelta
+
+import server
+
+
+def new_user(state, **fields):
+    user = {
+        'user_id': uuid.uuid4().hex,
+        'plan': 'free',
+        'used_today': 0,
+        'last_reset': date.today().isoformat(),
+        'total_used': 0,
+        'created_at': '2024-01-01T00:00:00',
+        'plan_expires': None,
+    }
+    user.update(fields)
+    assert state.create_user(user)
+    return user['user_id']
+
+
+def test_create_user_only_once(state):
+    user_id = new_user(state)
+    assert not state.create_user({'user_id': user_id, 'plan': 'premium', 'used_today': 0, 'total_used': 0,
+                                  'last_reset': date.today().isoformat(), 'created_at': '', 'plan_expires': None})
+    assert state.get_user(user_id)['plan'] == 'free'
+    assert state.user_stats()[0] == 1
+
+
+def test_compare_and_update(state):
+    user_id = new_user(state, plan='premium', plan_expires='2024-05-01')
+    assert not state.compare_and_update_user(user_id, {'plan_expires': '2024-06-01'}, {'plan': 'free'})
+    assert state.get_user(user_id)['plan'] == 'premium'
+    assert state.compare_and_update_user(user_id, {'plan_expires': '2024-05-01'},
+                                         {'plan': 'free', 'plan_expires': None})
+    user = state.get_user(user_id)
+    assert user['plan'] == 'free'
+    assert user['plan_expires'] is None
+    assert not state.compare_and_update_user('missing', {'plan': 'free'}, {'plan': 'premium'})
+
+
+def test_reset_day_clears_old_counters(state):
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    stale = new_user(state, used_today=3, last_reset=yesterday)
+    fresh = new_user(state, used_today=2)
+    state.reset_day()
+    assert state.get_user(stale)['used_today'] == 0
+    assert state.get_user(stale)['last_reset'] == date.today().isoformat()
+    assert state.get_user(fresh)['used_today'] == 2
+
+
+def test_reset_day_expires_plans(state):
+    expired, active = new_user(state), new_user(state)
+    state.update_user(expired, plan='premium', plan_expires=(date.today() - timedelta(days=1)).isoformat())
+    state.update_user(active, plan='basic', plan_expires=date.today().isoformat())
+    state.reset_day()
+    # Локальное состояние снимает тариф задачей планировщика
+    deadline = time.monotonic() + 5
+    while state.get_user(expired)['plan'] != 'free' and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert state.get_user(expired)['plan'] == 'free'
+    assert state.get_user(expired)['plan_expires'] is None
+    assert state.get_user(active)['plan'] == 'basic'
+
+
+def test_reserve_and_refund_usage(state):
+    user_id = new_user(state)
+    today = server.today_number()
+    assert state.reserve_usage(user_id, today, 2) == 1
+    assert state.reserve_usage(user_id, today, 2) == 2
+    assert state.reserve_usage(user_id, today, 2) is None
+    state.refund_usage(user_id, today)
+    assert state.get_user(user_id)['used_today'] == 1
+    # Возврат за прошлый день после сброса ничего не меняет
+    state.refund_usage(user_id, today - 1)
+    assert state.get_user(user_id)['used_today'] == 1
+
+
+def test_reserve_resets_stale_day(state):
+    user_id = new_user(state, used_today=5, last_reset=(date.today() - timedelta(days=1)).isoformat())
+    assert state.reserve_usage(user_id, server.today_number(), 1) == 1
+
+
+def test_commit_usage_counts_analyses(state):
+    user_id = new_user(state)
+    before = state.user_stats()
+    assert state.commit_usage(user_id)['total_used'] == 1
+    after = state.user_stats()
+    assert after[1] == before[1] + 1
+    assert after[2] == before[2] + 1
+
+
+def test_token_bucket(state):
+    key = 'free|203.0.113.' + uuid.uuid4().hex[:4]
+    assert state.ip_available(key, 2, 3600) == 2
+    assert state.try_acquire_ip(key, 2, 3600)
+    assert state.try_acquire_ip(key, 2, 3600)
+    assert not state.try_acquire_ip(key, 2, 3600)
+    assert state.ip_available(key, 2, 3600) < 1
+    state.refund_ip(key, 2, 3600)
+    assert state.try_acquire_ip(key, 2, 3600)
+    assert state.tracked_ips() == 1
+
+
+def test_token_bucket_refills(state):
+    key = 'free|198.51.100.1'
+    assert state.try_acquire_ip(key, 1, 0.2)
+    assert not state.try_acquire_ip(key, 1, 0.2)
+    time.sleep(0.3)
+    assert state.try_acquire_ip(key, 1, 0.2)
+
+
+def test_sessions(state):
+    state.create_session('admin-session', {'admin': True}, ttl=60)
+    assert state.get_session('admin-session') == {'admin': True}
+    assert state.get_session('unknown') is None
@@ -0,0 +1,122 @@
+import io
+import json
+import uuid
+
+import pytest
+
+import server
+
+RESPONSE = """ЮРИДИЧЕСКАЯ ЭКСПЕРТИЗА:
+Договор соответствует ГК РФ.
+Срок аренды указан.
+ФИНАНСОВЫЙ АНАЛИЗ:
+Плата фиксирована.
+КЛЮЧЕВЫЕ РИСКИ:
+HIGH | Штраф | Неустойка 1% в день
+LOW | Пеня | Небольшая пеня
+ПРАКТИЧЕСКИЕ РЕКОМЕНДАЦИИ:
+- Снизить неустойку | Меньше риск | Срочно
+ЭКСПЕРТНОЕ ЗАКЛЮЧЕНИЕ:
+Подписывать после правок."""
+
+SECTION_ORDER = ['legal_expertise', 'financial_analysis', 'key_risks',
+                 'practical_recommendations', 'expert_conclusion']
+
+
+def parse(chunks):
+    parser = server.SmartAnalysisParser()
+    completed = []
+    for chunk in chunks:
+        completed += parser.feed(chunk)
+    completed += parser.finish()
+    return completed, parser.sections
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_parser_result_does_not_depend_on_chunking():
+    expected_order, expected = parse([RESPONSE])
+    assert expected_order == SECTION_ORDER
+    assert expected['legal_expertise'] == 'Договор соответствует ГК РФ. Срок аренды указан.'
+    assert [risk['level'] for risk in expected['key_risks']] == ['HIGH', 'LOW']
+    assert expected['practical_recommendations'][0]['action'] == 'Снизить неустойку'
+    for size in (1, 2, 3, 7, 16, 50):
+        # Куски режут заголовки и строки рисков посередине
+        assert parse(split(RESPONSE, size)) == (expected_order, expected)
+
+
+def test_section_is_reported_when_next_header_arrives():
+    parser = server.SmartAnalysisParser()
+    assert parser.feed('ЮРИДИЧЕСКАЯ ЭКСПЕРТИЗА:\nДоговор в пор') == []
+    assert parser.feed('ядке.\nФИНАНСОВЫЙ АН') == []
+    # Заголовок распознается только целой строкой
+    assert parser.feed('АЛИЗ:\n') == ['legal_expertise']
+    assert parser.sections['legal_expertise'] == 'Договор в порядке.'
+    assert parser.finish() == ['financial_analysis']
+    assert parser.finish() == []
+
+
+def test_sse_event_framing():
+    frame = server.sse_event('section', {'name': 'legal_expertise', 'value': 'Строка 1\nСтрока 2'})
+    assert frame.endswith('\n\n')
+    lines = frame[:-2].split('\n')
+    # Перевод строки внутри данных экранирован JSON - событие из двух строк
+    assert lines[0] == 'event: section'
+    assert lines[1].startswith('data: ')
+    assert len(lines) == 2
+    assert json.loads(lines[1][len('data: '):])['value'] == 'Строка 1\nСтрока 2'
+    assert 'Строка' in frame
+
+
+class StreamingResponse:
+    """Ответ YandexGPT в потоковом режиме: строки JSON с накопленным текстом"""
+    status_code = 200
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_lines(self):
+        text = ''
+        for chunk in self.chunks:
+            text += chunk
+            yield json.dumps({'result': {'alternatives': [{'message': {'text': text}}]}}).encode('utf-8')
+        yield b''
+
+
+def read_events(body):
+    events = []
+    for frame in body.split('\n\n'):
+        if not frame:
+            continue
+        event, data = frame.split('\n')
+        events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setattr(server.upstream, 'post', lambda url, **kwargs: StreamingResponse(split(RESPONSE, 11)))
+
+
+def test_stream_endpoint_sends_sections_then_result(upstream):
+    user_id = 'stream-' + uuid.uuid4().hex
+    text = f'Договор аренды квартиры {user_id}. Арендатор вносит плату ежемесячно. ' * 5
+    response = server.app.test_client().post('/analyze/stream', data={
+        'user_id': user_id, 'file': (io.BytesIO(text.encode('utf-8')), 'contract.txt')})
+    assert response.mimetype == 'text/event-stream'
+    events = read_events(response.get_data(as_text=True))
+    assert events[0][0] == 'meta'
+    assert [data['name'] for event, data in events if event == 'section'] == SECTION_ORDER
+    assert events[-1][0] == 'result'
+    result = events[-1][1]
+    assert result['success'] is True
+    assert result['result']['ai_used'] is True
+    assert result['result']['usage_info']['used_today'] == 1
@@ -0,0 +1,43 @@
+import codecs
+
+import pytest
+
+import server
+
+TEXT = ('Договор аренды нежилого помещения. Арендатор обязуется своевременно вносить арендную плату '
+        'и содержать помещение в надлежащем состоянии. ')
+
+
+@pytest.mark.parametrize('encoding', ['cp1251', 'koi8-r'])
+@pytest.mark.parametrize('text', [TEXT, TEXT.upper(), TEXT.title(), 'ДОГОВОР ПОСТАВКИ N 15. Стороны: ООО "РОМАШКА". '])
+def test_single_byte_cyrillic(encoding, text):
+    assert server.detect_text_encoding(text.encode(encoding), complete=True) == encoding
+
+
+@pytest.mark.parametrize('encoding', ['utf-16-le', 'utf-16-be'])
+def test_utf16_without_bom(encoding):
+    assert server.detect_text_encoding(TEXT.encode(encoding), complete=True) == encoding
+    assert server.detect_text_encoding(('Lease agreement ' * 5).encode(encoding), complete=True) == encoding
+
+
+@pytest.mark.parametrize('bom, encoding, detected', [
+    (codecs.BOM_UTF8, 'utf-8', 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le', 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be', 'utf-16'),
+    (codecs.BOM_UTF32_LE, 'utf-32-le', 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be', 'utf-32'),
+])
+def test_bom(bom, encoding, detected):
+    data = bom + TEXT.encode(encoding)
+    assert server.detect_text_encoding(data, complete=True) == detected
+    assert server.extract_text_from_txt(data).startswith('Договор аренды')
+
+
+def test_utf8_cut_in_the_middle_of_a_letter():
+    head = TEXT.encode('utf-8')[:-1]
+    assert server.detect_text_encoding(head) == 'utf-8'
+
+
+def test_extract_uppercase_koi8r():
+    data = TEXT.upper().encode('koi8-r')
+    assert server.extract_text_from_txt(data) == TEXT.upper()
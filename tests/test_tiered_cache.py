@@ -0,0 +1,59 @@
+import os
+
+import server
+
+
+def make_cache(tmp_path, memory_bytes=100, disk_bytes=1000):
+    return server.TieredCache('test', memory_bytes=memory_bytes, disk_bytes=disk_bytes,
+                              cache_dir=str(tmp_path))
+
+
+def value(i):
+    # 30 байт в JSON: в память помещаются три записи
+    return {'v': f'{i:0>22}'}
+
+
+def test_memory_eviction_keeps_entry_on_disk(tmp_path):
+    cache = make_cache(tmp_path)
+    for i in range(5):
+        cache.put(f'k{i}', value(i))
+    stats = cache.stats()
+    assert stats['memory_items'] == 3
+    assert stats['memory_bytes'] <= 100
+    assert list(cache.memory) == ['k2', 'k3', 'k4']
+    assert stats['disk_items'] == 5
+
+    # Вытесненная из памяти запись читается с диска и поднимается обратно в память
+    assert cache.get('k0') == value(0)
+    assert cache.hits_disk == 1
+    assert list(cache.memory) == ['k3', 'k4', 'k0']
+    assert cache.get('k0') == value(0)
+    assert cache.hits_memory == 1
+    assert cache.hits_disk == 1
+
+
+def test_disk_eviction_drops_oldest_file(tmp_path):
+    cache = make_cache(tmp_path, disk_bytes=100)
+    for i in range(3):
+        cache.put(f'k{i}', value(i))
+    # Обращение к k0 делает его свежим, вытесняется k1
+    assert cache.get('k0') == value(0)
+    cache.put('k3', value(3))
+    assert list(cache.disk) == ['k2', 'k0', 'k3']
+    assert sorted(os.listdir(tmp_path / 'test')) == ['k0', 'k2', 'k3']
+
+    cache.memory.clear()
+    cache.memory_size = 0
+    assert cache.get('k1') is None
+    assert cache.misses == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put('k0', value(0))
+    cache.put('k1', value(1))
+    restarted = make_cache(tmp_path)
+    assert restarted.stats()['disk_items'] == 2
+    assert restarted.get('k1') == value(1)
+    assert restarted.hits_disk == 1
+    assert 'k1' in restarted.memory
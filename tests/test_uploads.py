@@ -0,0 +1,68 @@
+import io
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import server
+
+PDF = b'%PDF-1.4\n1 0 obj\n<< /Type /Catalog >>\nendobj\n'
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 32
+JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 32
+WEBP = b'RIFF\x24\x00\x00\x00WEBPVP8 ' + b'\x00' * 32
+DOCX = b'PK\x03\x04' + b'\x00' * 32
+EXE = b'MZ\x90\x00' + b'\x00' * 32
+
+
+@pytest.mark.parametrize('head, filename, kind', [
+    # Сигнатура важнее расширения
+    (PDF, 'contract.docx', 'pdf'),
+    (PDF, 'contract', 'pdf'),
+    (PNG, 'contract.txt', 'image'),
+    (JPEG, 'scan.pdf', 'image'),
+    (WEBP, 'photo.bin', 'image'),
+    (DOCX, 'contract.PDF', 'docx'),
+    # Без сигнатуры - по расширению, без учета регистра
+    ('Договор аренды'.encode('utf-8'), 'contract.TXT', 'txt'),
+    (b'plain text', 'notes.md', None),
+    (EXE, 'setup.exe', None),
+    (EXE, 'setup', None),
+    (b'', '', None),
+])
+def test_sniff_kind(head, filename, kind):
+    assert server.sniff_kind(head, filename) == kind
+
+
+def test_upload_detects_kind_by_content():
+    upload = server.Upload(FileStorage(io.BytesIO(PDF), filename='contract.docx'))
+    try:
+        assert upload.kind == 'pdf'
+        assert upload.size == len(PDF)
+        assert bytes(upload.data()) == PDF
+        assert upload.path is None
+    finally:
+        upload.close()
+
+
+def test_large_upload_spills_to_disk():
+    data = PNG + os.urandom(200 * 1024)
+    upload = server.Upload(FileStorage(io.BytesIO(data), filename='page.txt'), spool_max=64 * 1024)
+    try:
+        assert upload.kind == 'image'
+        assert upload.path is not None
+        assert upload.source() == upload.path
+        assert bytes(upload.data()) == data
+        assert upload.size == len(data)
+    finally:
+        upload.close()
+    assert not os.path.exists(upload.path)
+
+
+def test_analyze_rejects_unsupported_type():
+    user_id = 'upload-test-user'
+    client = server.app.test_client()
+    response = client.post('/analyze', data={'user_id': user_id, 'file': (io.BytesIO(EXE), 'setup.exe')})
+    assert response.status_code == 400
+    assert 'Неподдерживаемый формат' in response.get_json()['error']
+    # Отказ не расходует дневной лимит
+    assert server.get_user(user_id)['used_today'] == 0
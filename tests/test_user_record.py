@@ -0,0 +1,47 @@
+from datetime import date, timedelta
+
+import pytest
+
+import server
+
+TODAY = date.today()
+
+USERS = [
+    {'user_id': 'free-user', 'plan': 'free', 'used_today': 2, 'last_reset': TODAY.isoformat(),
+     'total_used': 15, 'created_at': '2026-01-02T10:20:30.123456', 'plan_expires': None},
+    {'user_id': 'premium-user', 'plan': 'premium', 'used_today': 0, 'last_reset': TODAY.isoformat(),
+     'total_used': 0, 'created_at': None, 'plan_expires': (TODAY + timedelta(days=30)).isoformat()},
+    {'user_id': 'пользователь', 'plan': 'unlimited', 'used_today': 7, 'last_reset': TODAY.isoformat(),
+     'total_used': 123456, 'created_at': '2025-12-31T23:59:59', 'plan_expires': '2030-01-01'},
+]
+
+
+def test_user_record_round_trip():
+    for user in USERS:
+        record = server.UserRecord.from_dict(user)
+        assert record.to_dict() == user
+        assert server.UserRecord.from_dict(record.to_dict()).values() == record.values()
+        assert record.copy().values() == record.values()
+
+
+@pytest.fixture(params=['journal', 'sqlite'])
+def reopen_storage(request, tmp_path, monkeypatch):
+    """Создает хранилище заново поверх тех же файлов - как после перезапуска"""
+    monkeypatch.setattr(server, 'USER_DB_FILE', str(tmp_path / 'users.json'))
+    monkeypatch.setattr(server, 'USER_JOURNAL_FILE', str(tmp_path / 'users.journal'))
+    if request.param == 'journal':
+        return server.JournalStorage
+    return lambda: server.SQLiteStorage(str(tmp_path / 'users.db'))
+
+
+def test_user_record_round_trip_through_storage(reopen_storage):
+    storage = reopen_storage()
+    storage.put_users([server.UserRecord.from_dict(user).to_dict() for user in USERS])
+    for user in USERS:
+        assert storage.get_user(user['user_id']) == user
+
+    reopened = reopen_storage()
+    for user in USERS:
+        stored = reopened.get_user(user['user_id'])
+        assert stored == user
+        assert server.UserRecord.from_dict(stored).values() == server.UserRecord.from_dict(user).values()
@@ -0,0 +1,66 @@
+import threading
+from datetime import date, timedelta
+
+import server
+
+
+def new_user(user_id, **fields):
+    user = {'user_id': user_id, 'plan': 'free', 'used_today': 0, 'total_used': 0,
+            'last_reset': date.today().isoformat(), 'created_at': None, 'plan_expires': None}
+    user.update(fields)
+    return user
+
+
+def test_concurrent_compare_and_update_across_shards():
+    store = server.UserStore(shards=4)
+    user_ids = [f'user-{i}' for i in range(16)]
+    assert len({id(store.shard(user_id)) for user_id in user_ids}) == 4
+    for user_id in user_ids:
+        store.insert(new_user(user_id))
+    threads_count, increments = 8, 160
+    barrier = threading.Barrier(threads_count)
+
+    def increment():
+        barrier.wait()
+        for i in range(increments):
+            user_id = user_ids[i % len(user_ids)]
+            # Классический цикл CAS: перечитать и повторить, если запись успели изменить
+            while True:
+                used = store.get(user_id).used_today
+                if store.compare_and_update(user_id, {'used_today': used}, {'used_today': used + 1}):
+                    break
+
+    threads = [threading.Thread(target=increment) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    per_user = threads_count * increments // len(user_ids)
+    assert all(store.get(user_id).used_today == per_user for user_id in user_ids)
+    assert sum(len(shard.dirty) for shard in store.shards) == len(user_ids)
+
+
+def test_compare_and_update_rejects_changed_record():
+    store = server.UserStore(shards=2)
+    store.insert(new_user('owner', plan='premium', plan_expires='2024-05-01'))
+    assert not store.compare_and_update('owner', {'plan_expires': '2024-06-01'}, {'plan': 'free'})
+    assert not store.compare_and_update('missing', {'plan': 'free'}, {'plan': 'basic'})
+    assert store.compare_and_update('owner', {'plan_expires': '2024-05-01'}, {'plan': 'free', 'plan_expires': None})
+    assert store.get('owner').to_dict()['plan'] == 'free'
+
+
+def test_expire_plan_skips_extended_plan(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'SQLITE_DB_FILE', str(tmp_path / 'state.db'))
+    state = server.LocalState()
+    yesterday = server.today_number() - 1
+    state.create_user(new_user('extended'))
+    state.create_user(new_user('lapsed'))
+    # Истечение вызывается тестом напрямую, планировщик не должен его опередить
+    monkeypatch.setattr(state, 'schedule_expiry', lambda user_id, expires: None)
+    state.update_user('extended', plan='premium', plan_expires=(date.today() + timedelta(days=30)).isoformat())
+    state.update_user('lapsed', plan='premium', plan_expires=server.day_iso(yesterday))
+    state.expire_plan('extended', yesterday)
+    state.expire_plan('lapsed', yesterday)
+    assert state.get_user('extended')['plan'] == 'premium'
+    assert state.get_user('lapsed')['plan'] == 'free'
+    assert state.get_user('lapsed')['plan_expires'] is None
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import server
+
+
+class MemoryBackend:
+    def __init__(self):
+        self.users = {}
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    def put_users(self, users):
+        for user in users:
+            self.users[user['user_id']] = dict(user)
+
+
+def new_user(user_id):
+    return {'user_id': user_id, 'plan': 'free', 'used_today': 0, 'total_used': 0}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_flusher_survives_concurrent_flush():
+    backend = MemoryBackend()
+    storage = server.WriteBehindStorage(backend, interval=0, max_latency=0)
+    stop = threading.Event()
+
+    def flush_loop():
+        while not stop.is_set():
+            storage.flush()
+
+    threads = [threading.Thread(target=flush_loop) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(2000):
+        storage.insert_user(new_user(f'user-{i}'))
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # Записать новое изменение теперь может только фоновый поток
+    storage.insert_user(new_user('last'))
+    assert wait_for(lambda: 'last' in backend.users)
+
+
+def test_flusher_survives_storage_error():
+    backend = MemoryBackend()
+    storage = server.WriteBehindStorage(backend, interval=0, max_latency=0)
+    flush = storage.flush
+    failures = []
+
+    def failing_flush():
+        if not failures:
+            failures.append(True)
+            raise RuntimeError('сбой записи')
+        flush()
+
+    storage.flush = failing_flush
+    storage.insert_user(new_user('first'))
+    assert wait_for(lambda: 'first' in backend.users)
+    assert failures